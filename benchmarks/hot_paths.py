@@ -0,0 +1,231 @@
+# Benchmarks of the fitting and calculation hot paths on synthetic data, no screen data needed.
+#
+#   python -m benchmarks.hot_paths --output bench_<commit>.json
+#   python -m benchmarks.hot_paths --compare bench_<old>.json bench_<new>.json
+#
+# Every benchmark reports per-call latency percentiles, throughput (traces/s) and the peak memory
+# allocated by one call (measured in a separate tracemalloc pass so it does not distort the timings).
+import argparse
+import contextlib
+import io
+import json
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from pirk.calculations.p700_pam import _calculate_PSI, calculate_PSI_batch
+from pirk.calculations.pam import calculate_fluorescence_values, calculate_fluorescence_batch
+from pirk.calculations.pirk import find_steady_state_pirk_amplitudes, calculate_steady_state_pirk_batch
+from pirk.fitting.fitters import fit_prepared_trace
+from pirk.fitting.models import construct_dirk_pirk, DirkPirkEvaluator
+from pirk.names import *
+from pirk.parsing.group_index import GroupIndex
+from pirk.parsing.prep_data_fit import prep_traces_for_fitting, prep_traces_batch
+from pirk.synthetic import generate_combined_df, DEFAULT_TRUE_PARAMS, P700_TRACE_INDICES
+
+TRUE_PARAMS = [DEFAULT_TRUE_PARAMS[name] for name in DIRK_PIRK_PARAMETERS]
+GUESS = [0.35, 12, 100, 0.1, 0.06, 1.5, 0.06, 0.2, 0.06]
+
+
+def synthetic_traces(trace_label, n_traces, **kwargs):
+    """
+    n_traces traces of one trace label and condition from generate_combined_df, kwargs are passed on.
+    """
+    return generate_combined_df(n_genotypes=1, n_light_intensities=1, n_replicates=n_traces,
+                                trace_labels=[trace_label], **kwargs)
+
+
+def measure(name, func, n_calls, traces_per_call=1):
+    """
+    Time n_calls calls of func() (each processing traces_per_call traces), then measure its peak memory.
+    """
+    latencies = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        func()  # warm up
+        for _ in range(n_calls):
+            start = time.perf_counter()
+            func()
+            latencies.append(time.perf_counter() - start)
+
+        tracemalloc.start()
+        func()
+        _, peak_bytes = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    latencies = np.array(latencies)
+    result = {
+        "calls": len(latencies),
+        "traces_per_call": traces_per_call,
+        "mean_s": float(np.mean(latencies)),
+        "p50_s": float(np.percentile(latencies, 50)),
+        "p90_s": float(np.percentile(latencies, 90)),
+        "p99_s": float(np.percentile(latencies, 99)),
+        "traces_per_s": float(traces_per_call * len(latencies) / np.sum(latencies)),
+        "peak_memory_bytes": int(peak_bytes),
+    }
+    print(f"{name:45} p50 {result['p50_s'] * 1e3:10.3f} ms  p99 {result['p99_s'] * 1e3:10.3f} ms  "
+          f"{result['traces_per_s']:12.1f} traces/s  peak {peak_bytes / 1024:10.1f} KiB")
+    return result
+
+
+def run_benchmarks(trace_lengths=(1000, 5000), n_traces=200, n_fits=10):
+    """
+    Run all benchmarks. Returns dict benchmark name -> result of measure().
+    """
+    results = {}
+
+    for trace_length in trace_lengths:
+        combined_df = synthetic_traces(LABEL_ECS, n_traces, trace_length=trace_length)
+        trace_x, trace_y, pirk_points, _ = prep_traces_for_fitting(combined_df, 0)
+        x_total = np.linspace(0, np.max(trace_x), len(trace_x))
+        model = DirkPirkEvaluator(x_total, pirk_points)
+
+        results[f"construct_dirk_pirk[n={trace_length}]"] = measure(
+            f"construct_dirk_pirk[n={trace_length}]",
+            lambda: construct_dirk_pirk(x_total, pirk_points, *TRUE_PARAMS), n_calls=200)
+        results[f"DirkPirkEvaluator[n={trace_length}]"] = measure(
+            f"DirkPirkEvaluator[n={trace_length}]",
+            lambda: model(x_total, *TRUE_PARAMS), n_calls=200)
+
+        prepared = [prep_traces_for_fitting(combined_df, index)[:3] for index in combined_df.index[:n_fits]]
+        for analytic_jacobian in (False, True):
+            fits = iter(prepared * 1000)
+
+            def fit_next():
+                fit_x, fit_y, fit_pirk_points = next(fits)
+                fit_prepared_trace(fit_x, fit_y, fit_pirk_points, GUESS, analytic_jacobian=analytic_jacobian)
+
+            name = f"curve_fit dirk_pirk[n={trace_length}, jac={'analytic' if analytic_jacobian else '2-point'}]"
+            results[name] = measure(name, fit_next, n_calls=n_fits)
+
+        results[f"prep_traces_for_fitting[n={trace_length}]"] = measure(
+            f"prep_traces_for_fitting[n={trace_length}]",
+            lambda: [prep_traces_for_fitting(combined_df, index, use_cache=False) for index in combined_df.index],
+            n_calls=5, traces_per_call=len(combined_df))
+        results[f"prep_traces_for_fitting[n={trace_length}, cached]"] = measure(
+            f"prep_traces_for_fitting[n={trace_length}, cached]",
+            lambda: [prep_traces_for_fitting(combined_df, index) for index in combined_df.index],
+            n_calls=5, traces_per_call=len(combined_df))
+        results[f"prep_traces_batch[n={trace_length}]"] = measure(
+            f"prep_traces_batch[n={trace_length}]",
+            lambda: prep_traces_batch(combined_df),
+            n_calls=5, traces_per_call=len(combined_df))
+        results[f"find_steady_state_pirk_amplitudes[n={trace_length}]"] = measure(
+            f"find_steady_state_pirk_amplitudes[n={trace_length}]",
+            lambda: [find_steady_state_pirk_amplitudes(combined_df, index) for index in combined_df.index],
+            n_calls=5, traces_per_call=len(combined_df))
+        results[f"calculate_steady_state_pirk_batch[n={trace_length}]"] = measure(
+            f"calculate_steady_state_pirk_batch[n={trace_length}]",
+            lambda: calculate_steady_state_pirk_batch(combined_df, combined_df.index),
+            n_calls=10, traces_per_call=len(combined_df))
+
+    # 52 genotypes x 3 light levels, the traces are kept short as only the metadata is used
+    screen_df = generate_combined_df(n_genotypes=52, n_light_intensities=3, n_replicates=max(1, n_traces // 12),
+                                     trace_labels=[LABEL_ECS, LABEL_P700], trace_length=100, n_baseline=20)
+    screen_keys = [{LABEL_COLUMN: LABEL_ECS, GENOTYPE_COLUMN: genotype, TREATMENT_COLUMN: light}
+                   for genotype in screen_df[GENOTYPE_COLUMN].unique()
+                   for light in screen_df[TREATMENT_COLUMN].unique()]
+    results["group selection, boolean masks"] = measure(
+        "group selection, boolean masks",
+        lambda: [screen_df.index[(screen_df[LABEL_COLUMN] == key[LABEL_COLUMN]) &
+                                 (screen_df[GENOTYPE_COLUMN] == key[GENOTYPE_COLUMN]) &
+                                 (screen_df[TREATMENT_COLUMN] == key[TREATMENT_COLUMN])] for key in screen_keys],
+        n_calls=3, traces_per_call=len(screen_df))
+    results["group selection, GroupIndex"] = measure(
+        "group selection, GroupIndex",
+        lambda: [rows.indexes(key) for rows in [GroupIndex(screen_df)] for key in screen_keys],
+        n_calls=10, traces_per_call=len(screen_df))
+
+    p700_traces = np.stack(synthetic_traces(LABEL_PAM_P700, n_traces)[TRACE_COLUMN].tolist())
+    results["_calculate_PSI"] = measure(
+        "_calculate_PSI",
+        lambda: [_calculate_PSI(trace, P700_TRACE_INDICES) for trace in p700_traces],
+        n_calls=5, traces_per_call=len(p700_traces))
+    results["calculate_PSI_batch"] = measure(
+        "calculate_PSI_batch",
+        lambda: calculate_PSI_batch(p700_traces, P700_TRACE_INDICES),
+        n_calls=20, traces_per_call=len(p700_traces))
+
+    pam_df = synthetic_traces(LABEL_PAM, n_traces)
+    results["calculate_fluorescence_values"] = measure(
+        "calculate_fluorescence_values",
+        lambda: [calculate_fluorescence_values(pam_df, index, plot_all=False) for index in pam_df.index],
+        n_calls=3, traces_per_call=len(pam_df))
+    results["calculate_fluorescence_batch"] = measure(
+        "calculate_fluorescence_batch",
+        lambda: calculate_fluorescence_batch(pam_df, pam_df.index),
+        n_calls=10, traces_per_call=len(pam_df))
+
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def save_results(results, output):
+    report = {
+        "metadata": {
+            "commit": _git_commit(),
+            "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "python": sys.version.split()[0],
+            "numpy": np.__version__,
+            "pandas": pd.__version__,
+            "platform": platform.platform(),
+        },
+        "results": results,
+    }
+    with open(output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Benchmark results saved to {output}")
+
+
+def compare_results(baseline_path, current_path):
+    """
+    Print the p50 latency and throughput of current relative to baseline for every shared benchmark.
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    with open(current_path) as f:
+        current = json.load(f)
+
+    print(f"baseline {baseline['metadata']['commit']} -> current {current['metadata']['commit']}")
+    print(f"{'Benchmark':60} {'p50 base (ms)':>14} {'p50 now (ms)':>14} {'speedup':>9}")
+    print("-" * 100)
+    for name, result in current["results"].items():
+        if name not in baseline["results"]:
+            continue
+        base = baseline["results"][name]
+        speedup = result["traces_per_s"] / base["traces_per_s"]
+        print(f"{name:60} {base['p50_s'] * 1e3:14.3f} {result['p50_s'] * 1e3:14.3f} {speedup:8.2f}x")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the pirk fitting and calculation hot paths.")
+    parser.add_argument("--output", default="bench_output.json", help="JSON file for the results")
+    parser.add_argument("--trace-lengths", type=int, nargs="+", default=[1000, 5000])
+    parser.add_argument("--n-traces", type=int, default=200, help="traces per batch benchmark")
+    parser.add_argument("--n-fits", type=int, default=10, help="traces fitted per curve_fit benchmark")
+    parser.add_argument("--compare", nargs=2, metavar=("BASELINE", "CURRENT"),
+                        help="compare two result files instead of running the benchmarks")
+    args = parser.parse_args(argv)
+
+    if args.compare:
+        compare_results(*args.compare)
+        return
+
+    results = run_benchmarks(args.trace_lengths, args.n_traces, args.n_fits)
+    save_results(results, args.output)
+
+
+if __name__ == "__main__":
+    main()
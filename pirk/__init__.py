@@ -1,17 +1,60 @@
 # pirk/__init__.py
-from scripts import load_data
-from scripts.load_data import load_combined_df
-from .fitting.fitters import fit_pirk_dirk
-from .fitting.model_basic import exp_decay, pirk_amplitude_recovery, exp_decay_with_variable_gH
-from .fitting.models import construct_dirk_pirk, dirk_pirk
-from .parsing.prep_data_fit import prep_traces_for_fitting
-from .parsing.loader import parse_array, parse_indices
-from .plotting.fits import plot_PAM
-from .plotting.summaries import plot_all_dirk_pirk_fits
-from .plotting.traces import plot_traces_genotype_replicate
+import importlib
 
 from .names import *
-from pirk.parsing.helpers import find_closest_index
+
+# The public API is imported on first use (module __getattr__), so `import pirk` and the fitting worker processes
+# do not pay for scipy, matplotlib, seaborn and plotly until a function that needs them is used.
+_LAZY_ATTRIBUTES = {
+    "load_data": ("scripts.load_data", None),
+    "load_combined_df": ("scripts.load_data", "load_combined_df"),
+    "fit_pirk_dirk": ("pirk.fitting.fitters", "fit_pirk_dirk"),
+    "fit_pirk_dirk_batch": ("pirk.fitting.batch", "fit_pirk_dirk_batch"),
+    "FitCache": ("pirk.fitting.cache", "FitCache"),
+    "FitJournal": ("pirk.fitting.journal", "FitJournal"),
+    "fit_curves": ("pirk.fitting.results", "fit_curves"),
+    "expand_fit_results": ("pirk.fitting.results", "expand_fit_results"),
+    "compact_fit_results": ("pirk.fitting.results", "compact_fit_results"),
+    "fit_results_table": ("pirk.fitting.results", "fit_results_table"),
+    "exp_decay": ("pirk.fitting.model_basic", "exp_decay"),
+    "pirk_amplitude_recovery": ("pirk.fitting.model_basic", "pirk_amplitude_recovery"),
+    "exp_decay_with_variable_gH": ("pirk.fitting.model_basic", "exp_decay_with_variable_gH"),
+    "construct_dirk_pirk": ("pirk.fitting.models", "construct_dirk_pirk"),
+    "dirk_pirk": ("pirk.fitting.models", "dirk_pirk"),
+    "prep_traces_for_fitting": ("pirk.parsing.prep_data_fit", "prep_traces_for_fitting"),
+    "prepared_trace": ("pirk.parsing.prep_data_fit", "prepared_trace"),
+    "invalidate_prepared_traces": ("pirk.parsing.prep_data_fit", "invalidate_prepared_traces"),
+    "prep_traces_batch": ("pirk.parsing.prep_data_fit", "prep_traces_batch"),
+    "save_trace_store": ("pirk.parsing.trace_store", "save_trace_store"),
+    "load_trace_store": ("pirk.parsing.trace_store", "load_trace_store"),
+    "parse_array": ("pirk.parsing.loader", "parse_array"),
+    "parse_indices": ("pirk.parsing.loader", "parse_indices"),
+    "materialize_array_columns": ("pirk.parsing.loader", "materialize_array_columns"),
+    "find_closest_index": ("pirk.parsing.helpers", "find_closest_index"),
+    "find_closest_indices": ("pirk.parsing.helpers", "find_closest_indices"),
+    "GroupIndex": ("pirk.parsing.group_index", "GroupIndex"),
+    "group_index": ("pirk.parsing.group_index", "group_index"),
+    "plot_PAM": ("pirk.plotting.fits", "plot_PAM"),
+    "plot_all_dirk_pirk_fits": ("pirk.plotting.summaries", "plot_all_dirk_pirk_fits"),
+    "render_dirk_pirk_fits": ("pirk.plotting.batch", "render_dirk_pirk_fits"),
+    "plot_traces_genotype_replicate": ("pirk.plotting.traces", "plot_traces_genotype_replicate"),
+    "save_combined_df": ("pirk.reporting.export", "save_combined_df"),
+    "print_fit_table": ("pirk.reporting.tables", "print_fit_table"),
+}
+
+
+def __getattr__(name):
+    if name not in _LAZY_ATTRIBUTES:
+        raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+    module_name, attribute = _LAZY_ATTRIBUTES[name]
+    module = importlib.import_module(module_name)
+    value = module if attribute is None else getattr(module, attribute)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_LAZY_ATTRIBUTES))
 
 # -----------------------------
 # Package version
@@ -40,15 +83,31 @@ from .names import (
 
 __all__ = [
     "prep_traces_for_fitting",
+    "prepared_trace",
+    "invalidate_prepared_traces",
+    "prep_traces_batch",
     "parse_array",
     "parse_indices",
+    "materialize_array_columns",
+    "save_trace_store",
+    "load_trace_store",
     "fit_pirk_dirk",
+    "fit_pirk_dirk_batch",
+    "FitCache",
+    "FitJournal",
+    "fit_curves",
+    "expand_fit_results",
+    "compact_fit_results",
+    "fit_results_table",
     "construct_dirk_pirk",
     "dirk_pirk",
     "exp_decay",
     "exp_decay_with_variable_gH",
     "pirk_amplitude_recovery",
     "find_closest_index",
+    "find_closest_indices",
+    "GroupIndex",
+    "group_index",
     "plot_PAM",
     "plot_traces_genotype_replicate",
     "print_fit_table",
@@ -56,6 +115,7 @@ __all__ = [
     "save_combined_df",
     "load_data",
     "plot_all_dirk_pirk_fits",
+    "render_dirk_pirk_fits",
     "TIME_COLUMN",
     "TRACE_COLUMN",
     "PIRK_POINTS_COLUMN",
@@ -77,6 +137,10 @@ __all__ = [
     "MODEL_PREDICTION",
     "TIME_FITTED",
     "TRACE_FITTED",
+    "FIT_COVARIANCE",
+    "FIT_SUCCESS",
+    "FIT_PLAN",
+    "FIT_RMSE",
     "ECS_Y_LABEL",
     "P700_Y_LABEL",
     "TREATMENT_COLUMN",
@@ -87,8 +151,3 @@ __all__ = [
     "LABEL_PAM",
     "LABEL_PAM_P700"
 ]
-
-from .reporting.export import save_combined_df
-
-from .reporting.tables import print_fit_table
-
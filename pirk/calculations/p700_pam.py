@@ -1,10 +1,42 @@
 import numpy as np
-from matplotlib import cm, pyplot as plt
+import pandas as pd
 
+from pirk.parsing.helpers import add_object_column
 from pirk.parsing.loader import parse_array
+from pirk.calculations.protocols import PROTOCOLS, PHOTORIDES_2_P700
 from pirk.names import *
 
-def _calculate_PSI(trace, trace_indices):
+PSI_COLUMNS = [PSI_OX, PSI_ACT, PSI_OPEN, PSI_OR]
+SATURATION_TOP_FRACTION = 0.2  # fraction of the largest saturation pulse values that is averaged
+
+
+def _mean_of_top_values(values):
+    """
+    Mean of the largest SATURATION_TOP_FRACTION of every row of values (n_traces, window_length).
+    The split point is found with a partial selection, the window is not fully sorted.
+    """
+    window_length = values.shape[1]
+    split = int(window_length * (1 - SATURATION_TOP_FRACTION))
+    return np.mean(np.partition(values, split, axis=1)[:, split:], axis=1)
+
+
+def calculate_PSI_batch(traces, trace_indices):
+    """
+    PSI parameters of many P700 traces recorded with the same protocol, in one vectorised pass.
+
+    Parameters
+    ----------
+    traces : array-like
+        2-D array (n_traces, trace_length) of P700 traces.
+    trace_indices : dict
+        Protocol windows, PSI_SS_BEG ... PSI_SAT2_END.
+
+    Returns
+    -------
+    psi : np.ndarray
+        (n_traces, 4) array, columns PSI_ox, PSI_act, PSI_open, PSI_or.
+    """
+    traces = np.asarray(traces, dtype=float)
     PSI_ss_beg = trace_indices.get(PSI_SS_BEG)  # beginning of the trace for P700 steady-state
     PSI_ss_end = trace_indices.get(PSI_SS_END)  # end of the trace for P700 steady-state
     PSI_sat1_beg = trace_indices.get(PSI_SAT1_BEG)  # beginning of the trace for P700 first saturation pulse
@@ -14,44 +46,24 @@ def _calculate_PSI(trace, trace_indices):
     PSI_sat2_beg = trace_indices.get(PSI_SAT2_BEG)  # beginning of the trace for P700 second saturation pulse
     PSI_sat2_end = trace_indices.get(PSI_SAT2_END)  # end of the trace for P700 second saturation pulse
 
-    # transform trace using average trace values of light adapted leaf, photorides 2 protocol
-    trace_Dark = np.mean(trace[PSI_dark_beg:PSI_dark_end])
-
-    PSI_data_absorbance = []
-    for i in trace:
-        PSI_data_absorbance.append(np.log10(trace_Dark / i))
-
-    PSI_ss = np.mean(PSI_data_absorbance[PSI_ss_beg:PSI_ss_end])
-
-    PSI_sat1 = np.mean(PSI_data_absorbance[PSI_sat1_beg:PSI_sat1_end])
-
-    PSI_sat2 = np.mean(PSI_data_absorbance[PSI_sat2_beg:PSI_sat2_end])
-
-    PSI_ss = 1000 * np.mean(PSI_data_absorbance[PSI_ss_beg:PSI_ss_end])
-
-    PSI_sat1_vals = PSI_data_absorbance[PSI_sat1_beg:PSI_sat1_end]
-
-    PSI_sat1_vals.sort()  # sort the saturating light values from low to high
+    # transform traces using average trace values of light adapted leaf, photorides 2 protocol
+    trace_dark = np.mean(traces[:, PSI_dark_beg:PSI_dark_end], axis=1, keepdims=True)
+    PSI_data_absorbance = np.log10(trace_dark / traces)
 
-    length_of_sat1 = PSI_sat1_end - PSI_sat1_beg
-
-    top_20_percent = int(length_of_sat1 * 0.8)
-
-    PSI_sat1 = 1000 * np.mean(
-        PSI_sat1_vals[top_20_percent:length_of_sat1])  # take the top 20% largest values and average them
-
-    PSI_sat2_vals = PSI_data_absorbance[PSI_sat2_beg:PSI_sat2_end]
-    PSI_sat2_vals.sort()  # sort the saturating light values from low to high
-    length_of_sat2 = PSI_sat2_end - PSI_sat2_beg
-    top_20_percent = int(length_of_sat2 * 0.8)
-    PSI_sat2 = 1000 * np.mean(
-        PSI_sat2_vals[top_20_percent:length_of_sat2])  # take the top 20% largest values and average them
+    PSI_ss = 1000 * np.mean(PSI_data_absorbance[:, PSI_ss_beg:PSI_ss_end], axis=1)
+    PSI_sat1 = 1000 * _mean_of_top_values(PSI_data_absorbance[:, PSI_sat1_beg:PSI_sat1_end])
+    PSI_sat2 = 1000 * _mean_of_top_values(PSI_data_absorbance[:, PSI_sat2_beg:PSI_sat2_end])
 
     PSI_ox = PSI_ss / PSI_sat2
     PSI_act = PSI_sat2
     PSI_open = (PSI_sat1 - PSI_ss) / PSI_sat2
     PSI_or = 1 - PSI_sat1 / PSI_sat2
 
+    return np.column_stack([PSI_ox, PSI_act, PSI_open, PSI_or])
+
+
+def _calculate_PSI(trace, trace_indices):
+    PSI_ox, PSI_act, PSI_open, PSI_or = calculate_PSI_batch(np.asarray(trace)[np.newaxis, :], trace_indices)[0]
     return [PSI_ox, PSI_act, PSI_open, PSI_or]
 
 
@@ -72,6 +84,8 @@ def calculate_ps1_all(combined_df, index, trace_indices,plot_all=True):
     print("PS1 Over Reduced Centers", np.round(PSI_or, 3))
     print("PS1 Oxidized Centers", np.round(PSI_ox, 3))
     if plot_all:
+        from matplotlib import cm, pyplot as plt
+
         replicate = combined_df[REPLICATE_COLUMN][index]
         genotype = combined_df[GENOTYPE_COLUMN][index]
         light = combined_df[TREATMENT_COLUMN][index]
@@ -79,4 +93,33 @@ def calculate_ps1_all(combined_df, index, trace_indices,plot_all=True):
         colors = cm.get_cmap('tab10', replicate)  # Or 'viridis', 'plasma', 'rainbow', etc.
         plt.plot(time, trace, color=colors(int(replicate)), label=replicate)
         plt.title(f'Genotype : {genotype} {TREATMENT_NAME} :{light}')
-        plt.show()
\ No newline at end of file
+        plt.show()
+
+
+def calculate_ps1_batch(combined_df, indexes, trace_indices=PHOTORIDES_2_P700):
+    """
+    Calculate PSI_ox, PSI_act, PSI_open and PSI_or of many P700 traces and write them into combined_df.
+    Traces of the same length are stacked and calculated together with calculate_PSI_batch.
+    The protocol is validated and checked against the trace lengths before anything is calculated.
+
+    input: combined_df, indexes of the P700 traces, protocol (name registered in PROTOCOLS, P700Protocol or
+           trace_indices dict)
+    output: DataFrame (indexes x PSI_COLUMNS) with the calculated values
+    """
+    protocol = PROTOCOLS.p700(trace_indices)
+    groups = PROTOCOLS.group_rows_by_length(combined_df, indexes, protocol)
+    for col in PSI_COLUMNS:
+        add_object_column(combined_df, col, default_content=[], replace=False)
+
+    results = []
+    for group_indexes, traces in groups.values():
+        psi = calculate_PSI_batch(np.stack(traces), protocol.trace_indices)
+        for col, values in zip(PSI_COLUMNS, psi.T):
+            combined_df.loc[group_indexes, col] = values
+        results.append(pd.DataFrame(psi, index=group_indexes, columns=PSI_COLUMNS))
+
+    if not results:
+        return pd.DataFrame(columns=PSI_COLUMNS)
+    results = pd.concat(results).loc[list(indexes)]
+    print(f"Calculated PSI parameters of {len(results)} P700 traces")
+    return results
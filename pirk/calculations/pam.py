@@ -1,30 +1,13 @@
+import numpy as np
 import pandas as pd
 
 from pirk.fitting.fitters import fit_fm_values
-from pirk.parsing.loader import parse_array, extract_Fluro_paras
+from pirk.parsing.helpers import add_object_column
+from pirk.parsing.loader import parse_array
+from pirk.calculations.protocols import calculate_indices, PROTOCOLS
 from pirk.names import *
 
 
-import numpy as np
-
-from pirk.plotting.fits import plot_PAM
-
-def calculate_indices(pulses, ramp_lights):
-    indices = {'fs_begin': 0, 'fs_end': pulses[0] - 1}
-    start = indices['fs_end'] + 1
-
-    for i in range(1, len(ramp_lights)  + 1):
-        indices[f'Fm_{i}_begin'] = start
-        indices[f'Fm_{i}_end'] = start + pulses[i] - 1
-        start = indices[f'Fm_{i}_end'] + 1
-
-    # FoPrime
-    FoPrime_begin = indices[f'Fm_{len(ramp_lights) }_end'] + pulses[len(ramp_lights)  + 1]
-    FoPrime_end = FoPrime_begin + pulses[len(ramp_lights)  + 1]
-    indices.update({'FoPrime_begin': FoPrime_begin, 'FoPrime_end': FoPrime_end})
-
-    return indices
-
 def calculate_fluorescence_params ( f_values: dict , FmPrime_corr: float = None ) -> dict :
     """
     Calculate fluorescence parameters with and without MPF correction.
@@ -146,44 +129,113 @@ def check_fluorescence_data_quality(trace, f_values, indices, ramp_lights) -> di
 
     return valid_outs
 
-def calculate_fluorescence_values(combined_df, index, plot_all):
-    pulses = parse_array(combined_df[NUMBER_PULSES][index])
-    ramp_lights = parse_array(combined_df[RAMP_LIGHT][index])
-    trace = parse_array(combined_df[TRACE_COLUMN][index])
-    genotype = combined_df[GENOTYPE_COLUMN][index]
+PAM_COLUMNS = [FS, FO_P, FM_P, PHI_2, NPQ_T, QL, PHI_NO, PHI_NPQ, QP, FV_FM_P]
+PAM_TABLE_LABELS = ["Fs", "Fo_p", "Fm_p", "ΦII", "NPQt", "qL", "ΦNO", "ΦNPQ", "qP", "Fv_Fm_p"]
 
-    indices = calculate_indices(pulses, ramp_lights)
 
-    fit_values = fit_fm_values(trace, indices, ramp_lights)
-    f_values = extract_Fluro_paras(trace, indices,ramp_lights)
-    valid_values = check_fluorescence_data_quality(trace, f_values, indices,ramp_lights)
+def pam_window_statistics(traces, indices, n_ramp_lights):
+    """
+    Window statistics of a stack of PAM traces recorded with the same protocol, as extract_Fluro_paras
+    computes them for a single trace. The order statistics use a partial selection instead of a full sort.
+
+    input: traces (n_traces, trace_length), indices from calculate_indices, number of ramp lights
+    output: dict Fs, AFmP, FoPrime, FmP_step1 ... FmP_step<n_ramp_lights> -> array (n_traces,)
+    """
+    # Fs: mean of the 2nd to 4th smallest values of the Fs window
+    fs_window = traces[:, indices["fs_begin"]:indices["fs_end"]]
+    Fs = np.mean(np.partition(fs_window, [1, 3], axis=1)[:, 1:4], axis=1)
+
+    # AFmP: mean of the 3rd to 20th largest values of the first Fm' window
+    fm_window = traces[:, indices["Fm_1_begin"]:indices["Fm_1_end"]]
+    length = fm_window.shape[1]
+    lo, hi = max(length - 20, 0), length - 2
+    AFmP = np.mean(np.partition(fm_window, [lo, hi - 1], axis=1)[:, lo:hi], axis=1)
+
+    statistics = {"Fs": Fs, "AFmP": AFmP}
+    for i in range(1, n_ramp_lights + 1):
+        begin = indices[f"Fm_{i}_begin"]
+        statistics[f"FmP_step{i}"] = np.mean(traces[:, begin + 2:min(begin + 6, indices[f"Fm_{i}_end"])], axis=1)
+    begin = indices["FoPrime_begin"]
+    statistics["FoPrime"] = np.mean(traces[:, begin + 2:min(begin + 6, indices["FoPrime_end"])], axis=1)
+    return statistics
+
+
+def fit_fm_values_batch(f_values, ramp_lights):
+    """
+    MPF linear regression of the Fm' steps (AFmP for the first step) on the inverse ramp light intensity,
+    in closed form for all traces at once.
+
+    input: f_values from pam_window_statistics, ramp_lights
+    output: slope, intercept (arrays, n_traces); the intercept is the MPF corrected Fm'
+    """
+    inverse_intensity = 1 / np.asarray(ramp_lights, dtype=float)
+    steps = np.column_stack([f_values[AFMP]] + [f_values[f"FmP_step{i}"] for i in range(2, len(ramp_lights) + 1)])
+
+    dx = inverse_intensity - inverse_intensity.mean()
+    step_means = steps.mean(axis=1)
+    slope = (steps - step_means[:, None]) @ dx / np.dot(dx, dx)
+    intercept = step_means - slope * inverse_intensity.mean()
+    return slope, intercept
+
+
+def _warn_out_of_range(noMPF, slope, indexes):
+    """
+    Quality checks of check_fluorescence_data_quality, one line per check listing the failing rows.
+    """
+    checks = [("fv/fm (Phi2)", noMPF["fvfm_noMPF"], 0.10, 0.85),
+              ("PhiNO", noMPF["PhiNO_noMPF"], 0.10, 1.1),
+              ("PhiNPQ", noMPF["PhiNPQ_noMPF"], 0.10, 1.1)]
+    for name, values, low, high in checks:
+        outside = (slope > 0) & ~((low < values) & (values < high))
+        if np.any(outside):
+            print(f"⚠️ {name} is outside expected range for indexes {list(np.asarray(indexes)[outside])}; "
+                  f"consider discarding these measurements.")
+
+
+def calculate_fluorescence_batch(combined_df, indexes):
+    """
+    Calculate the MPF corrected PAM parameters (PAM_COLUMNS) of many PAM traces and write them into combined_df.
+    Traces with the same protocol (pulses and ramp lights, see PROTOCOLS) and length are stacked: the window
+    statistics are computed once per trace and the MPF regression is done for the whole stack at once.
+    Protocols without room for all windows raise a ValueError before anything is calculated.
+
+    input: combined_df, indexes of the PAM traces
+    output: DataFrame (indexes x PAM_COLUMNS) with the calculated values
+    """
+    groups = PROTOCOLS.group_pam_rows(combined_df, indexes)
+    for col in PAM_COLUMNS:
+        add_object_column(combined_df, col, default_content=[], replace=False)
+
+    results = []
+    for (protocol, _), (group_indexes, traces) in groups.items():
+        f_values = pam_window_statistics(np.stack(traces), protocol.indices, len(protocol.ramp_lights))
+        slope, intercept = fit_fm_values_batch(f_values, protocol.ramp_lights)
+
+        _warn_out_of_range(calculate_fluorescence_params(f_values), slope, group_indexes)
+        MPF = calculate_fluorescence_params(f_values, FmPrime_corr=intercept)
+
+        values = np.column_stack(list(MPF.values()))
+        for col, column_values in zip(PAM_COLUMNS, values.T):
+            combined_df.loc[group_indexes, col] = column_values
+        results.append(pd.DataFrame(values, index=group_indexes, columns=PAM_COLUMNS))
+
+    if not results:
+        return pd.DataFrame(columns=PAM_COLUMNS)
+    return pd.concat(results).loc[list(indexes)]
+
+
+def calculate_fluorescence_values(combined_df, index, plot_all):
+    values = calculate_fluorescence_batch(combined_df, [index]).loc[index]
+    genotype = combined_df[GENOTYPE_COLUMN][index]
 
     if plot_all:
+        from pirk.plotting.fits import plot_PAM
+
+        trace = parse_array(combined_df[TRACE_COLUMN][index])
         replicate = combined_df[REPLICATE_COLUMN][index]
-        genotype = combined_df[GENOTYPE_COLUMN][index]
         light_intensity = combined_df[TREATMENT_COLUMN][index]
 
         plot_PAM(trace, light_intensity, genotype, replicate)
 
-    df = pd.DataFrame.from_dict(valid_values["MPF"], orient='index', columns=[f'{genotype}'])
-
-    df.index = [
-        "Fs", "Fo_p", "Fm_p", "ΦII", "NPQt",
-        "qL", "ΦNO", "ΦNPQ", "qP", "Fv_Fm_p"
-    ]
-
+    df = pd.DataFrame({f'{genotype}': values.values}, index=PAM_TABLE_LABELS)
     print(np.round(df, 3))
-
-    add_new_cols = True
-    if add_new_cols:
-        combined_df.at[index, 'Fs'] = df.loc['Fs'].values[0]
-        combined_df.at[index, 'Fo_p'] = df.loc['Fo_p'].values[0]
-        combined_df.at[index, 'Fm_p'] = df.loc['Fm_p'].values[0]
-        combined_df.at[index, 'phi_2'] = df.loc['ΦII'].values[0]
-        combined_df.at[index, 'NPQ_t'] = df.loc['NPQt'].values[0]
-        combined_df.at[index, 'qL'] = df.loc['qL'].values[0]
-        combined_df.at[index, 'phi_NO'] = df.loc['ΦNO'].values[0]
-        combined_df.at[index, 'phi_NPQ'] = df.loc['ΦNPQ'].values[0]
-        combined_df.at[index, 'qP'] = df.loc['qP'].values[0]
-        combined_df.at[index, 'Fv_Fm_p'] = df.loc["Fv_Fm_p"].values[0]
-
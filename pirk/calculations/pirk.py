@@ -1,11 +1,13 @@
 import numpy as np
-from matplotlib import cm
+import pandas as pd
 
 from pirk.parsing.loader import parse_array, parse_indices
-from scipy.stats import linregress
-import matplotlib.pyplot as plt
 
-from pirk.names import DIRK_INDICES_COLUMN, TRACE_COLUMN,TIME_COLUMN,PIRK_POINTS_COLUMN
+from pirk.names import DIRK_INDICES_COLUMN, TRACE_COLUMN,TIME_COLUMN,PIRK_POINTS_COLUMN, STEADY_STATE_PIRK_TIME, \
+    STEADY_STATE_PIRK_AMPLITUDE, STEADY_STATE_PIRK_BASELINE_SLOPE, STEADY_STATE_PIRK_BASELINE_INTERCEPT
+
+STEADY_STATE_PIRK_COLUMNS = [STEADY_STATE_PIRK_TIME, STEADY_STATE_PIRK_AMPLITUDE, STEADY_STATE_PIRK_BASELINE_SLOPE,
+                             STEADY_STATE_PIRK_BASELINE_INTERCEPT]
 
 
 def find_predirk_baseline(combined_df, index, number_baseline_points=10):
@@ -23,6 +25,71 @@ def find_predirk_baseline(combined_df, index, number_baseline_points=10):
     return dirk_begin - number_baseline_points, dirk_begin
 
 
+def steady_state_pirk_batch(window_x, window_y):
+    """ Steady state PIRK of many traces at once. Every row of the windows holds the number_baseline_points before
+    the dirk begin; the last point is the PIRK and the others are the baseline, which is fitted with a straight line
+    by closed-form least squares (as scipy.stats.linregress) for all rows together.
+
+    input: window_x, window_y (n_traces, number_baseline_points)
+    output: steady_state_pirk_measurement_x, steady_state_pirk_amplitude, baseline slope, baseline intercept
+            (arrays of n_traces)
+    """
+    window_x = np.asarray(window_x, dtype=float)
+    window_y = np.asarray(window_y, dtype=float)
+    baseline_x = window_x[:, :-1]
+    baseline_y = window_y[:, :-1]
+
+    dx = baseline_x - baseline_x.mean(axis=1, keepdims=True)
+    dy = baseline_y - baseline_y.mean(axis=1, keepdims=True)
+    slope = np.sum(dx * dy, axis=1) / np.sum(dx * dx, axis=1)
+    intercept = baseline_y.mean(axis=1) - slope * baseline_x.mean(axis=1)
+
+    steady_state_pirk_baseline = slope * window_x[:, -1] + intercept
+    return window_x[:, -1], window_y[:, -1] - steady_state_pirk_baseline, slope, intercept
+
+
+def steady_state_pirk_from_trace(trace_x, trace_y, dirk_begin, number_baseline_points=10):
+    """ Steady state PIRK time and amplitude of a parsed trace, see find_steady_state_pirk_amplitudes.
+    The baseline is a linear fit of the number_baseline_points before dirk_begin (without the last point, the PIRK).
+
+    input: trace_x, trace_y (full trace), dirk_begin index
+    output: steady_state_pirk_measurement_x, steady_state_pirk_amplitude
+    """
+    window = slice(dirk_begin - number_baseline_points, dirk_begin)
+    x, amplitude, slope, intercept = steady_state_pirk_batch(np.asarray(trace_x)[np.newaxis, window],
+                                                             np.asarray(trace_y)[np.newaxis, window])
+
+    if slope[0] <0:
+        print("negative pre-dirk baseline slope", slope[0], intercept[0])
+
+    return x[0], amplitude[0]
+
+
+def calculate_steady_state_pirk_batch(combined_df, indexes, number_baseline_points=10):
+    """ Steady state PIRK of many traces, see find_steady_state_pirk_amplitudes. The baseline windows of all traces are
+    stacked and fitted together with steady_state_pirk_batch. Returns the unscaled values and writes nothing into
+    combined_df.
+
+    input: combined_df, indexes of the pirk traces, number_baseline_points
+    output: DataFrame (indexes x STEADY_STATE_PIRK_COLUMNS), unscaled amplitudes
+    """
+    window_x = np.empty((len(indexes), number_baseline_points))
+    window_y = np.empty((len(indexes), number_baseline_points))
+    rows = combined_df.loc[list(indexes), [DIRK_INDICES_COLUMN, TIME_COLUMN, TRACE_COLUMN]]
+    for row, (dirk_indices, time, trace) in enumerate(zip(*(rows[col].values for col in rows.columns))):
+        dirk_begin = np.min(parse_indices(dirk_indices))
+        window = slice(dirk_begin - number_baseline_points, dirk_begin)
+        window_x[row] = parse_array(time)[window]
+        window_y[row] = parse_array(trace)[window]
+
+    results = pd.DataFrame(np.column_stack(steady_state_pirk_batch(window_x, window_y)), index=list(indexes),
+                           columns=STEADY_STATE_PIRK_COLUMNS)
+    n_negative = int(np.sum(results[STEADY_STATE_PIRK_BASELINE_SLOPE] < 0))
+    print(f"Calculated the steady state PIRK of {len(results)} traces "
+          f"({n_negative} with a negative pre-dirk baseline slope)")
+    return results
+
+
 def find_steady_state_pirk_amplitudes(combined_df, index, dirk_par=0, number_baseline_points=10, plot_it=False):
     """ Find the amplitude of the steady state PIRK signal in the experiment.
     Note: The Dirk protocol is defined by the actinic intensity that is set to the value of the Dirk parameter.
@@ -45,27 +112,21 @@ def find_steady_state_pirk_amplitudes(combined_df, index, dirk_par=0, number_bas
     trace_x =  parse_array(combined_df[TIME_COLUMN][index])
 
     base_b, base_e = find_predirk_baseline(combined_df, index) # n points before dirk begin =base_b,base_e=dirk_begin
-    baseline_x = trace_x[base_b: base_e - 1]
-    baseline_y = trace_y[base_b: base_e - 1]
-
-    fitlin = linregress(baseline_x, baseline_y)
+    steady_state_pirk_measurement_x, steady_state_pirk_amplitude = steady_state_pirk_from_trace(
+        trace_x, trace_y, base_e, number_baseline_points=base_e - base_b)
 
-    steady_state_pirk_measurement_x = trace_x[base_e-1]
-    steady_state_pirk_measurement = trace_y[base_e-1]
-
-    if fitlin.slope <0:
-        print(fitlin, fitlin.slope, fitlin.intercept)
-
-    steady_state_pirk_baseline_fit = fitlin.slope * trace_x[base_b: base_e] + fitlin.intercept
-    steady_state_pirk_baseline_fit_offset = steady_state_pirk_baseline_fit[-1]
-    steady_state_pirk_baseline_fit_line = fitlin.slope * trace_x[base_b: base_e] + fitlin.intercept
-
-    steady_state_pirk_amplitude = steady_state_pirk_measurement - steady_state_pirk_baseline_fit_line[-1]
     # print(trace_y[base_e-1],trace_y[base_e],trace_y[base_e+1],steady_state_pirk_amplitude)
     # print(base_e-1,base_e,base_e+1,steady_state_pirk_amplitude)
     # print(combined_df[PIRK_POINTS_COLUMN][index])
 
     if plot_it:
+        import matplotlib.pyplot as plt
+
+        _, _, slope, intercept = steady_state_pirk_batch(trace_x[np.newaxis, base_b: base_e],
+                                                         trace_y[np.newaxis, base_b: base_e])
+        steady_state_pirk_measurement = trace_y[base_e-1]
+        steady_state_pirk_baseline_fit_line = slope[0] * trace_x[base_b: base_e] + intercept[0]
+
         plt.figure()
         plt.plot(trace_x[b: b + 20], trace_y[b: b + 20], color='blue',label='trace, 20pts')
 
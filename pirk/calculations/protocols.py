@@ -0,0 +1,212 @@
+# Registry of the measurement protocols (window layouts) of the PAM and P700 traces. A protocol is validated once
+# when it is registered or first seen, and the rows of a DataFrame are grouped by protocol so that every group is
+# processed with one precompiled set of windows.
+import numpy as np
+
+from pirk.parsing.loader import parse_array
+from pirk.names import *
+
+P700_WINDOWS = [(PSI_SS_BEG, PSI_SS_END), (PSI_SAT1_BEG, PSI_SAT1_END), (PSI_DARK_BEG, PSI_DARK_END),
+                (PSI_SAT2_BEG, PSI_SAT2_END)]
+
+PHOTORIDES_2_P700 = "photorides 2.0"
+PHOTORIDES_2_P700_INDICES = {
+    PSI_SS_BEG: 1,      # beginning of the trace for P700 steady-state
+    PSI_SS_END: 18,     # end of the trace for P700 steady-state
+    PSI_SAT1_BEG: 25,   # beginning of the trace for P700 first saturation pulse
+    PSI_SAT1_END: 170,  # end of the trace for P700 first saturation pulse
+    PSI_DARK_BEG: 195,  # beginning of the trace for P700 steady-state
+    PSI_DARK_END: 205,  # end of the trace for P700 steady-state
+    PSI_SAT2_BEG: 220,  # beginning of the trace for P700 second saturation pulse
+    PSI_SAT2_END: 270,  # end of the trace for P700 second saturation pulse
+}
+
+
+def calculate_indices(pulses, ramp_lights):
+    indices = {'fs_begin': 0, 'fs_end': pulses[0] - 1}
+    start = indices['fs_end'] + 1
+
+    for i in range(1, len(ramp_lights)  + 1):
+        indices[f'Fm_{i}_begin'] = start
+        indices[f'Fm_{i}_end'] = start + pulses[i] - 1
+        start = indices[f'Fm_{i}_end'] + 1
+
+    # FoPrime
+    FoPrime_begin = indices[f'Fm_{len(ramp_lights) }_end'] + pulses[len(ramp_lights)  + 1]
+    FoPrime_end = FoPrime_begin + pulses[len(ramp_lights)  + 1]
+    indices.update({'FoPrime_begin': FoPrime_begin, 'FoPrime_end': FoPrime_end})
+
+    return indices
+
+
+class P700Protocol:
+    """
+    Windows of a P700 protocol (trace_indices as used by calculate_PSI_batch), validated on construction.
+
+    Attributes
+    ----------
+    name : str
+    trace_indices : dict
+        PSI_SS_BEG ... PSI_SAT2_END -> index.
+    min_trace_length : int
+        Shortest trace that contains all windows.
+    """
+
+    def __init__(self, name, trace_indices):
+        missing = [key for window in P700_WINDOWS for key in window if key not in trace_indices]
+        if missing:
+            raise ValueError(f"P700 protocol {name!r} has no {missing}")
+        for begin, end in P700_WINDOWS:
+            if not 0 <= trace_indices[begin] < trace_indices[end]:
+                raise ValueError(f"P700 protocol {name!r}: window {begin}={trace_indices[begin]}, "
+                                 f"{end}={trace_indices[end]} is empty or negative")
+
+        self.name = name
+        self.trace_indices = {key: int(trace_indices[key]) for window in P700_WINDOWS for key in window}
+        self.min_trace_length = max(self.trace_indices[end] for _, end in P700_WINDOWS)
+
+    def __repr__(self):
+        return f"P700Protocol({self.name!r})"
+
+
+class PAMProtocol:
+    """
+    A PAM pulse layout (number_pulses and RAMP_light) with its windows from calculate_indices, validated on
+    construction so that every window of pam_window_statistics is non-empty.
+
+    Attributes
+    ----------
+    pulses, ramp_lights : tuple
+    indices : dict
+        Window indices, see calculate_indices.
+    min_trace_length : int
+        Shortest trace that contains all windows.
+    """
+
+    def __init__(self, pulses, ramp_lights):
+        pulses = tuple(int(pulse) for pulse in pulses)
+        ramp_lights = tuple(float(light) for light in ramp_lights)
+        if len(ramp_lights) < 2:
+            raise ValueError(f"PAM protocol needs at least 2 ramp lights for the MPF regression, got {ramp_lights}")
+        if len(pulses) != len(ramp_lights) + 2:
+            raise ValueError(f"PAM protocol with {len(ramp_lights)} ramp lights needs {len(ramp_lights) + 2} "
+                             f"pulse counts (Fs, one per ramp light, FoPrime), got {pulses}")
+        if min(ramp_lights) <= 0 or len(set(ramp_lights)) < 2:
+            raise ValueError(f"PAM ramp lights must be positive and not all equal, got {ramp_lights}")
+        # Fs takes the 2nd to 4th smallest values, the Fm' and FoPrime means start 2 points into their window
+        if pulses[0] < 5 or min(pulses[1:]) < 4:
+            raise ValueError(f"PAM protocol pulses {pulses} are too short for the Fs, Fm' and FoPrime windows")
+
+        self.pulses = pulses
+        self.ramp_lights = ramp_lights
+        self.indices = calculate_indices(pulses, ramp_lights)
+        self.min_trace_length = min(self.indices["FoPrime_begin"] + 6, self.indices["FoPrime_end"])
+
+    @property
+    def key(self):
+        return self.pulses, self.ramp_lights
+
+    def __repr__(self):
+        return f"PAMProtocol(pulses={list(self.pulses)}, ramp_lights={list(self.ramp_lights)})"
+
+
+def _layout_key(cell):
+    """
+    Hashable key of a number_pulses or RAMP_light cell without parsing it (stringified lists are their own key).
+    """
+    if isinstance(cell, str):
+        return cell
+    return tuple(np.asarray(cell).tolist())
+
+
+class ProtocolRegistry:
+    """
+    Named P700 protocols and the PAM pulse layouts seen so far, each validated once.
+    """
+
+    def __init__(self):
+        self._p700 = {}
+        self._pam = {}
+        self._pam_by_cells = {}
+
+    def register_p700(self, name, trace_indices):
+        self._p700[name] = P700Protocol(name, trace_indices)
+        return self._p700[name]
+
+    def p700(self, protocol):
+        """
+        P700 protocol by name; a P700Protocol is returned as is and a trace_indices dict is validated.
+        """
+        if isinstance(protocol, P700Protocol):
+            return protocol
+        if isinstance(protocol, dict):
+            key = tuple(sorted(protocol.items()))
+            if key not in self._p700:
+                self._p700[key] = P700Protocol("custom", protocol)
+            return self._p700[key]
+        if protocol not in self._p700:
+            raise KeyError(f"Unknown P700 protocol {protocol!r}, registered: "
+                           f"{[name for name in self._p700 if isinstance(name, str)]}")
+        return self._p700[protocol]
+
+    def pam(self, pulses, ramp_lights):
+        """
+        The PAMProtocol of a pulse layout, shared by all rows with the same layout.
+        """
+        cells_key = (_layout_key(pulses), _layout_key(ramp_lights))
+        protocol = self._pam_by_cells.get(cells_key)
+        if protocol is None:
+            protocol = PAMProtocol(parse_array(pulses), parse_array(ramp_lights))
+            protocol = self._pam.setdefault(protocol.key, protocol)
+            self._pam_by_cells[cells_key] = protocol
+        return protocol
+
+    def group_pam_rows(self, combined_df, indexes):
+        """
+        Group PAM rows by protocol and trace length and check that the traces contain all windows.
+
+        Returns
+        -------
+        groups : dict
+            (PAMProtocol, trace length) -> (list of indexes, list of traces)
+        """
+        rows = combined_df.loc[list(indexes), [NUMBER_PULSES, RAMP_LIGHT, TRACE_COLUMN]]
+        groups = {}
+        for index, pulses, ramp_lights, trace in zip(rows.index, *(rows[col].values for col in rows.columns)):
+            trace = parse_array(trace)
+            group = groups.setdefault((self.pam(pulses, ramp_lights), len(trace)), ([], []))
+            group[0].append(index)
+            group[1].append(trace)
+        for (protocol, length), (group_indexes, _) in groups.items():
+            _check_trace_length(protocol, length, group_indexes)
+        return groups
+
+    def group_rows_by_length(self, combined_df, indexes, protocol):
+        """
+        Group P700 rows by trace length and check that the traces contain all windows of the protocol.
+
+        Returns
+        -------
+        groups : dict
+            trace length -> (list of indexes, list of traces)
+        """
+        protocol = self.p700(protocol)
+        groups = {}
+        for index, trace in zip(indexes, combined_df.loc[list(indexes), TRACE_COLUMN].values):
+            trace = parse_array(trace)
+            group = groups.setdefault(len(trace), ([], []))
+            group[0].append(index)
+            group[1].append(trace)
+        for length, (group_indexes, _) in groups.items():
+            _check_trace_length(protocol, length, group_indexes)
+        return groups
+
+
+def _check_trace_length(protocol, length, indexes):
+    if length < protocol.min_trace_length:
+        raise ValueError(f"{protocol} needs traces of at least {protocol.min_trace_length} points, "
+                         f"the traces of indexes {list(indexes)} have {length}")
+
+
+PROTOCOLS = ProtocolRegistry()
+PROTOCOLS.register_p700(PHOTORIDES_2_P700, PHOTORIDES_2_P700_INDICES)
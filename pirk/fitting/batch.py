@@ -0,0 +1,302 @@
+# Fit many DIRK/PIRK traces in parallel. The DataFrame stays in the parent process: only the prepared trace
+# arrays are sent to the workers and the results are written back into combined_df as they come in.
+import os
+import time
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
+import numpy as np
+
+from pirk.names import *
+from pirk.fitting.fitters import fit_prepared_trace, failed_fit_outputs, initial_guess_from_dict, \
+    add_steady_state_pirk, update_combined_df_with_fit, fit_cache_key_for_trace, construct_fit_outputs, \
+    model_time_axis
+from pirk.fitting.journal import FitJournal
+from pirk.parsing.prep_data_fit import prep_traces_for_fitting, precompute_steady_state_pirk
+from pirk.parsing.helpers import add_object_column
+
+
+def prepare_fit_tasks(combined_df, indexes, guess_dict):
+    """
+    Prepare the traces of the given indexes for fitting.
+
+    Returns
+    -------
+    tasks : list of tuple
+        (index, trace_x, trace_y, pirk_points, p0) for every index, picklable and independent of combined_df.
+    """
+    p0 = initial_guess_from_dict(guess_dict)
+    tasks = []
+    for index in indexes:
+        trace_x, trace_y, pirk_points, _ = prep_traces_for_fitting(combined_df, index)
+        tasks.append((index, trace_x, trace_y, pirk_points, list(p0)))
+    return tasks
+
+
+def fit_task(task, **fit_options):
+    """
+    Fit a single task from prepare_fit_tasks. Runs in a worker process.
+    fit_options are passed to fit_prepared_trace.
+
+    Returns
+    -------
+    result : dict
+        index, fit, pcov, perr, fit_success, postprocessed (without steady state pirk values),
+        elapsed (fit time in seconds) and error (None, or the exception raised by the fit).
+    """
+    index, trace_x, trace_y, pirk_points, p0 = task
+    start = time.perf_counter()
+    error = None
+    try:
+        fit, pcov, perr, fit_success, postprocessed = fit_prepared_trace(trace_x, trace_y, pirk_points, p0,
+                                                                         **fit_options)
+    except Exception as e:  # a single bad trace must not stop the batch
+        fit, pcov, perr, postprocessed = failed_fit_outputs(trace_x, trace_y, len(p0))
+        fit_success = False
+        error = repr(e)
+
+    return {
+        "index": index,
+        "fit": fit,
+        "pcov": pcov,
+        "perr": perr,
+        "fit_success": fit_success,
+        "postprocessed": postprocessed,
+        "elapsed": time.perf_counter() - start,
+        "error": error
+    }
+
+
+def result_from_journal(record, trace_x, trace_y, pirk_points):
+    """
+    Rebuild a fit_task result from a journal record, the model outputs are recomputed from the fitted parameters.
+    """
+    if record["fit_success"]:
+        fit = record["fit"]
+        postprocessed = construct_fit_outputs(fit, pirk_points, model_time_axis(trace_x))
+    else:
+        fit, _, _, postprocessed = failed_fit_outputs(trace_x, trace_y, len(record["fit"]))
+
+    return {
+        "index": record["index"],
+        "fit": fit,
+        "pcov": record["pcov"],
+        "perr": record["perr"],
+        "fit_success": record["fit_success"],
+        "postprocessed": postprocessed,
+        "elapsed": record["elapsed"],
+        "error": record["error"]
+    }
+
+
+def merge_fit_result(combined_df, result, trace_x, trace_y, pirk_points=None, compact=False):
+    """
+    Add the steady state pirk values to a worker result and write it into combined_df.
+    Returns: fit, pcov, perr, postprocessed (as fit_pirk_dirk, without the DIRK_PIRK_CURVE_COLUMNS if compact)
+    """
+    index = result["index"]
+    postprocessed = result["postprocessed"]
+    if result["fit_success"]:
+        postprocessed = add_steady_state_pirk(postprocessed, combined_df, index)
+
+    update_combined_df_with_fit(combined_df, index, result["fit"], postprocessed, trace_x, trace_y,
+                                pcov=result["pcov"], fit_success=result["fit_success"], pirk_points=pirk_points,
+                                compact=compact)
+    if compact:
+        postprocessed = {key: value for key, value in postprocessed.items() if key not in DIRK_PIRK_CURVE_COLUMNS}
+    return result["fit"], result["pcov"], result["perr"], postprocessed
+
+
+def warm_start_groups(combined_df, tasks):
+    """
+    Group tasks by WARM_START_COLUMNS (trace label, genotype, treatment), keeping the task order in each group.
+
+    Returns
+    -------
+    groups : dict
+        group key -> list of tasks, ordered by group key.
+    """
+    groups = {}
+    for task in tasks:
+        key = tuple(combined_df.at[task[0], col] for col in WARM_START_COLUMNS)
+        groups.setdefault(key, []).append(task)
+    return dict(sorted(groups.items(), key=lambda item: tuple(str(v) for v in item[0])))
+
+
+def warm_start_guess(converged_fits, p0):
+    """
+    Initial guess from the converged fits of neighbouring traces (element-wise median), p0 if there are none.
+    """
+    if not converged_fits:
+        return list(p0)
+    return list(np.median(np.asarray(converged_fits, dtype=float), axis=0))
+
+
+def fit_pirk_dirk_batch(combined_df, indexes, guess_dict, workers=None, analytic_jacobian=False, multistart=False,
+                        warm_start=False, cache=None, journal=None, resume=False, compact=False):
+    """
+    Fit the DIRK/PIRK model to many traces in parallel and update combined_df.
+
+    Parameters
+    ----------
+    combined_df : pd.DataFrame
+        DataFrame with the traces, the result columns are added if missing.
+    indexes : iterable
+        Row indexes of the traces to fit, a repeated index is fitted once.
+    guess_dict : dict
+        Initial guess, see DIRK_PIRK_PARAMETERS.
+    workers : int, optional
+        Number of worker processes, default os.cpu_count(). With workers=1 the fits run in this process.
+    analytic_jacobian : bool, optional
+        Use the analytic Jacobian of the model instead of finite differences.
+    multistart : bool, optional
+        Use the multi-start search (run_multistart_dirk_pirk_fit) instead of the retry loop.
+    warm_start : bool, optional
+        Fit the traces of each (trace label, genotype, treatment) group one after the other, starting every fit
+        from the median of the converged fits of the group; the first trace of a group starts from guess_dict.
+        Groups are fitted in parallel.
+    cache : FitCache, optional
+        Cache of fit results, traces found in the cache are not refitted and new fits are added to it.
+    journal : str or FitJournal, optional
+        Run journal, every completed fit is appended to it as soon as it is merged.
+    resume : bool, optional
+        Skip the indexes already in the journal and rebuild their result columns from it.
+    compact : bool, optional
+        Only store DIRK_PIRK_COMPACT_RESULT_COLUMNS; the model curves are rebuilt on demand by
+        pirk.fitting.results.fit_curves instead of being kept for every row.
+
+    Returns
+    -------
+    results : dict
+        index -> (fit, pcov, perr, postprocessed), as returned by fit_pirk_dirk. With compact=True the
+        DIRK_PIRK_CURVE_COLUMNS are left out of postprocessed as well, use fit_curves to get them.
+
+    Notes
+    -----
+    Scripts calling this with workers > 1 need an `if __name__ == "__main__":` guard on platforms that
+    start worker processes with spawn (macOS, Windows).
+    On KeyboardInterrupt the pending fits are cancelled; the fits completed so far are in combined_df
+    and in the journal.
+    """
+    workers = workers or os.cpu_count() or 1
+    fit_options = {"analytic_jacobian": analytic_jacobian, "multistart": multistart}
+    if isinstance(journal, str):
+        journal = FitJournal(journal)
+    if resume and journal is None:
+        raise ValueError("resume=True needs a journal")
+
+    for col in DIRK_PIRK_COMPACT_RESULT_COLUMNS + ([] if compact else DIRK_PIRK_CURVE_COLUMNS):
+        add_object_column(combined_df, col, default_content=[], replace=False)
+
+    indexes = list(dict.fromkeys(indexes))
+    tasks = prepare_fit_tasks(combined_df, indexes, guess_dict)
+    precompute_steady_state_pirk(combined_df, [task[0] for task in tasks])
+    traces = {task[0]: (task[1], task[2], task[3]) for task in tasks}
+    if warm_start:
+        groups = list(warm_start_groups(combined_df, tasks).values())
+    else:
+        groups = [[task] for task in tasks]
+    group_of = {task[0]: group_id for group_id, group in enumerate(groups) for task in group}
+    converged = {group_id: [] for group_id in range(len(groups))}
+    cache_keys = {}
+
+    start = time.perf_counter()
+    results = {}
+    n_failed = 0
+    n_fitted = 0
+    n_cached = 0
+
+    def merge(result, journaled=False):
+        nonlocal n_failed
+        index = result["index"]
+        if not result["fit_success"]:
+            n_failed += 1
+            if result["error"] is not None:
+                print(f"Fit of index {index} failed: {result['error']}")
+        else:
+            converged[group_of[index]].append(result["fit"])
+        if cache is not None and result["error"] is None and index in cache_keys:
+            cache.put(cache_keys.pop(index), (result["fit"], result["pcov"], result["perr"],
+                                              result["fit_success"], result["postprocessed"]))
+        if journal is not None and not journaled:
+            journal.append(result)
+        trace_x, trace_y, pirk_points = traces.pop(index)
+        results[index] = merge_fit_result(combined_df, result, trace_x, trace_y, pirk_points, compact=compact)
+
+    if journal is not None:
+        completed = journal.completed_fits() if resume else {}
+        journal.start_run(guess_dict, dict(fit_options, warm_start=warm_start))
+
+        n_restored = 0
+        for group in groups:
+            for task in list(group):
+                index, trace_x, trace_y, pirk_points, _ = task
+                if index in completed:
+                    merge(result_from_journal(completed[index], trace_x, trace_y, pirk_points), journaled=True)
+                    group.remove(task)
+                    n_restored += 1
+        if resume:
+            print(f"Resuming: {n_restored} of {len(tasks)} fits restored from {journal.path}")
+
+    queues = [deque(group) for group in groups]
+
+    def next_fit(group_id, executor=None):
+        """
+        Start the next fit of a group that is not in the cache. Runs it directly if there is no executor.
+        Returns the future, or None when the group is done.
+        """
+        nonlocal n_fitted, n_cached
+        queue = queues[group_id]
+        while queue:
+            index, trace_x, trace_y, pirk_points, p0 = queue.popleft()
+            if warm_start:
+                p0 = warm_start_guess(converged[group_id], p0)
+            task = (index, trace_x, trace_y, pirk_points, p0)
+
+            if cache is not None:
+                key = fit_cache_key_for_trace(trace_x, trace_y, pirk_points, p0, **fit_options)
+                cached = cache.get(key)
+                if cached is not None:
+                    fit, pcov, perr, fit_success, postprocessed = cached
+                    merge({"index": index, "fit": fit, "pcov": pcov, "perr": perr, "fit_success": fit_success,
+                           "postprocessed": postprocessed, "elapsed": 0.0, "error": None})
+                    n_cached += 1
+                    continue
+                cache_keys[index] = key
+
+            n_fitted += 1
+            if executor is None:
+                merge(fit_task(task, **fit_options))
+                continue
+            return executor.submit(fit_task, task, **fit_options)
+        return None
+
+    if workers == 1 or len(tasks) <= 1:
+        for group_id in range(len(groups)):
+            next_fit(group_id)
+    else:
+        with ProcessPoolExecutor(max_workers=min(workers, len(tasks))) as executor:
+            pending = {}
+            for group_id in range(len(groups)):
+                future = next_fit(group_id, executor)
+                if future is not None:
+                    pending[future] = group_id
+            try:
+                while pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        group_id = pending.pop(future)
+                        merge(future.result())
+                        future = next_fit(group_id, executor)
+                        if future is not None:
+                            pending[future] = group_id
+            except KeyboardInterrupt:
+                print(f"Interrupted, {len(results)} fits merged")
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise
+
+    if cache is not None:
+        print(f"{n_cached} fits found in the cache")
+    elapsed = time.perf_counter() - start
+    print(f"Fitted {n_fitted} traces ({n_failed} failed) in {elapsed:.1f} s using {workers} workers")
+    return results
@@ -0,0 +1,149 @@
+# Content-addressed on-disk cache of DIRK/PIRK fit results.
+# A fit is fully determined by the prepared trace, the initial guess, the fitter settings and the model,
+# so the hash of these is used as key and an unchanged trace is never refitted.
+import hashlib
+import os
+import pickle
+
+import numpy as np
+
+from pirk.fitting.models import DIRK_PIRK_MODEL_VERSION
+
+DEFAULT_CACHE_SIZE = 2 * 1024 ** 3  # bytes
+CACHE_FILE_EXTENSION = ".pkl"
+
+
+def fit_cache_key(trace_x, trace_y, pirk_points, p0, settings=None, model_version=DIRK_PIRK_MODEL_VERSION):
+    """
+    Hash of everything that determines the outcome of fit_prepared_trace.
+
+    Parameters
+    ----------
+    trace_x, trace_y, pirk_points : array-like
+        Prepared trace, as returned by prep_traces_for_fitting.
+    p0 : list
+        Initial guess, see initial_guess_from_dict.
+    settings : dict, optional
+        Fitter settings (e.g. analytic_jacobian).
+    model_version : str, optional
+        Version tag of the model, bumped whenever construct_dirk_pirk changes.
+
+    Returns
+    -------
+    key : str
+        Hex digest.
+    """
+    h = hashlib.sha256()
+    h.update(str(model_version).encode())
+    for values in (trace_x, trace_y, pirk_points, p0):
+        arr = np.ascontiguousarray(values, dtype=np.float64)
+        h.update(str(arr.shape).encode())
+        h.update(arr.tobytes())
+    h.update(repr(sorted((settings or {}).items())).encode())
+    return h.hexdigest()
+
+
+class FitCache:
+    """
+    Directory of pickled fit results with size-bounded LRU eviction.
+    The modification time of an entry is its last use; the least recently used entries are removed
+    once the total size exceeds max_bytes.
+
+    Parameters
+    ----------
+    path : str
+        Cache directory, created if missing.
+    max_bytes : int, optional
+        Size limit of the cache directory.
+    """
+
+    def __init__(self, path, max_bytes=DEFAULT_CACHE_SIZE):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._size = sum(size for _, _, size in self._entries())
+
+    def _file(self, key):
+        return os.path.join(self.path, key + CACHE_FILE_EXTENSION)
+
+    def _entries(self):
+        entries = []
+        with os.scandir(self.path) as it:
+            for entry in it:
+                if entry.name.endswith(CACHE_FILE_EXTENSION):
+                    stat = entry.stat()
+                    entries.append((entry.path, stat.st_mtime, stat.st_size))
+        return entries
+
+    def __contains__(self, key):
+        return os.path.exists(self._file(key))
+
+    def __len__(self):
+        return len(self._entries())
+
+    @property
+    def size(self):
+        return self._size
+
+    def get(self, key, default=None):
+        """
+        Cached value of key, or default. A hit marks the entry as recently used.
+        """
+        full_path = self._file(key)
+        try:
+            with open(full_path, "rb") as f:
+                value = pickle.load(f)
+        except FileNotFoundError:
+            self.misses += 1
+            return default
+        except (pickle.UnpicklingError, EOFError) as e:
+            print(f"Removing unreadable cache entry {full_path}: {e}")
+            self._remove(full_path)
+            self.misses += 1
+            return default
+
+        os.utime(full_path)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Store value under key, then evict least recently used entries if the cache is too large.
+        """
+        full_path = self._file(key)
+        tmp_path = f"{full_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        if os.path.exists(full_path):
+            self._size -= os.path.getsize(full_path)
+        os.replace(tmp_path, full_path)
+        self._size += os.path.getsize(full_path)
+
+        if self._size > self.max_bytes:
+            self.evict()
+
+    def evict(self, max_bytes=None):
+        """
+        Remove least recently used entries until the cache is at most max_bytes (default self.max_bytes).
+        """
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        self._size = sum(size for _, _, size in entries)
+        for full_path, _, _ in entries:
+            if self._size <= max_bytes:
+                break
+            self._remove(full_path)
+
+    def clear(self):
+        self.evict(max_bytes=0)
+
+    def _remove(self, full_path):
+        try:
+            size = os.path.getsize(full_path)
+            os.remove(full_path)
+            self._size -= size
+        except FileNotFoundError:
+            pass
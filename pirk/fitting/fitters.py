@@ -1,39 +1,72 @@
 # Fitting all the experimental data using the same initial guess could lead to unreliable fit
+
 import numpy as np
 from scipy.optimize import curve_fit
 from pirk.names import *
 
-from pirk.calculations.pirk import find_steady_state_pirk_amplitudes
-from pirk.fitting.models import construct_dirk_pirk, dirk_pirk
-from pirk.parsing.prep_data_fit import prep_traces_for_fitting
+from pirk.fitting.cache import fit_cache_key
+from pirk.fitting.models import construct_dirk_pirk, DirkPirkEvaluator, N_DIRK_PIRK_PARAMS
+from pirk.parsing.prep_data_fit import prep_traces_for_fitting, prepared_trace
 from pirk.parsing.loader import extract_Fluro_paras
-from pirk.plotting.fits import plot_trace_fits
-from pirk.reporting.printing import print_fit_table
+from pirk.parsing.helpers import add_object_column
+
+MAX_FIT_ATTEMPTS = 10
+REL_ERR_THRESHOLD = 0.5
+
+# multi-start search: number of screened starting points, number of full fits and log10 spread around p0
+MULTISTART_STARTS = 32
+MULTISTART_FITS = 4
+MULTISTART_SPREAD = 1.0
+
+
+def fit_weights(trace_y):
+    """
+    sigma passed to curve_fit for a trace.
+    """
+    weights = np.ones_like(trace_y)
+    peak_indices = np.where(trace_y > np.percentile(trace_y, 95))[0]  # top 5% as peaks
+    weights[peak_indices] = 1  # smaller sigma → higher weight
+    return weights
+
+
+def relative_error_accepted(rel_err, threshold=REL_ERR_THRESHOLD):
+    """
+    Acceptance criterion of a fit on the relative standard error of the amplitude.
+    """
+    return not (rel_err > threshold or np.round(rel_err, 3) == 0)
 
-def run_dirk_pirk_fit(x_total, trace_y, p0, pirk_points, max_attempts=10, threshold=0.5):
+
+def run_dirk_pirk_fit(x_total, trace_y, p0, pirk_points, max_attempts=MAX_FIT_ATTEMPTS, threshold=REL_ERR_THRESHOLD,
+                      analytic_jacobian=False):
     """
     Run curve_fit with retry logic.
+    If analytic_jacobian is True, the Jacobian is propagated through the segment chain of the model
+    instead of being estimated by finite differences.
     Returns: fit, pcov, perr, fit_success
     """
     n = len(p0)
     bounds = ([0] * n, [np.inf] * n)
 
+    fit, pcov, perr = None, None, None
     fit_success = False
     rel_err = float('inf')
     attempt = 0
 
-    weights = np.ones_like(trace_y)
-    peak_indices = np.where(trace_y > np.percentile(trace_y, 95))[0]  # top 5% as peaks
-    weights[peak_indices] = 1  # smaller sigma → higher weight
+    weights = fit_weights(trace_y)
+
+    # segment layout is fixed for the trace, only the parameters change between model evaluations
+    model = DirkPirkEvaluator(x_total, pirk_points)
+    jac = model.jacobian if analytic_jacobian else None
 
     try:
         fit, pcov = curve_fit(
-            lambda x, *params: dirk_pirk(x, *params, pirk_points),
+            model,
             x_total,
             trace_y,
             p0=p0,
             bounds=bounds,
             sigma = weights,
+            jac=jac,
             maxfev=100_000,
             method='trf'
         )
@@ -45,18 +78,19 @@ def run_dirk_pirk_fit(x_total, trace_y, p0, pirk_points, max_attempts=10, thresh
         p0[0] = 0  # Reset first parameter for retries
 
     # Retry loop
-    while (rel_err > threshold or np.round(rel_err, 3) == 0) and p0[0] < 5 and attempt < max_attempts:
+    while not relative_error_accepted(rel_err, threshold) and p0[0] < 5 and attempt < max_attempts:
         print("Fitting with retry loop")
         p0[0] += 0.1*p0[0] # new initial guess
 
         try:
             fit, pcov = curve_fit(
-                lambda x, *params: dirk_pirk(x, *params, pirk_points),
+                model,
                 x_total,
                 trace_y,
                 p0=p0,
                 bounds=bounds,
                 sigma = weights,
+                jac=jac,
                 maxfev=100_000,
                 method='trf'
             )
@@ -70,90 +104,328 @@ def run_dirk_pirk_fit(x_total, trace_y, p0, pirk_points, max_attempts=10, thresh
 
     return fit, pcov, perr, fit_success
 
-def postprocess_dirk_pirk_fit(fit, pirk_points, x_total, trace_y, combined_df, index):
+def space_filling_starts(p0, n_starts=MULTISTART_STARTS, spread=MULTISTART_SPREAD, seed=0):
     """
-    Compute model outputs, time constants, relative amplitudes.
+    Latin hypercube of starting points, log-uniform within spread decades around p0 for every parameter.
+    The first row is p0 itself; parameters with p0 == 0 are kept at 0.
+
+    Returns: array of shape (n_starts, len(p0))
     """
-    dirk_pirk_x, dirk_pirk_y, gH_values, pirk_times, relative_pirk_amplitudes = construct_dirk_pirk(
-        x_total, pirk_points, *fit
-    )
+    p0 = np.asarray(p0, dtype=float)
+    rng = np.random.default_rng(seed)
+    n_params = len(p0)
 
-    steady_state_pirk_x, steady_state_pirk_amplitude = find_steady_state_pirk_amplitudes(
-        combined_df, index, dirk_par=0, number_baseline_points=10
-    )
-    pirk_times = [0] + pirk_times
+    # one sample in each of n_starts strata per parameter, strata shuffled independently
+    strata = np.argsort(rng.random((n_starts, n_params)), axis=0)
+    unit = (strata + rng.random((n_starts, n_params))) / n_starts
 
-    steady_state_pirk_amplitude = steady_state_pirk_amplitude*1000 if combined_df.at[index,LABEL_COLUMN] in [LABEL_ECS,LABEL_P700] else steady_state_pirk_amplitude
+    starts = p0 * 10 ** (spread * (2 * unit - 1))
+    starts[0] = p0
+    return starts
 
-    relative_pirk_amplitudes = [steady_state_pirk_amplitude] + relative_pirk_amplitudes
+
+def _fit_from_start(x_total, trace_y, pirk_points, start, weights, analytic_jacobian, bounds):
+    """
+    Single TRF fit from start. Returns fit, pcov, perr, rel_err, cost or None if curve_fit failed.
+    The model evaluator is built per fit: its output and Jacobian buffers are reused between calls, so
+    fits running concurrently (run_multistart_dirk_pirk_fit with an executor) must not share one.
+    """
+    model = DirkPirkEvaluator(x_total, pirk_points)
+    jac = model.jacobian if analytic_jacobian else None
+    try:
+        fit, pcov = curve_fit(
+            model,
+            x_total,
+            trace_y,
+            p0=start,
+            bounds=bounds,
+            sigma=weights,
+            jac=jac,
+            maxfev=100_000,
+            method='trf'
+        )
+    except (RuntimeError, ValueError) as e:
+        print(f"Fit from start {np.round(start, 3)} failed: {e}")
+        return None
+
+    perr = np.sqrt(np.diag(pcov))
+    rel_err = abs(perr[0] / fit[0]) if fit[0] != 0 else float('inf')
+    cost = np.sum(((model(x_total, *fit) - trace_y) / weights) ** 2)
+    return fit, pcov, perr, rel_err, cost
+
+
+def run_multistart_dirk_pirk_fit(x_total, trace_y, p0, pirk_points, n_starts=MULTISTART_STARTS,
+                                 n_fits=MULTISTART_FITS, spread=MULTISTART_SPREAD, threshold=REL_ERR_THRESHOLD,
+                                 analytic_jacobian=False, seed=0, executor=None):
+    """
+    Multi-start alternative to the retry loop of run_dirk_pirk_fit.
+
+    A Latin hypercube of n_starts starting points over all parameters (see space_filling_starts) is screened
+    with a single model evaluation each. Full TRF fits are then run from p0 and from the n_fits - 1 starts with
+    the lowest cost, best first, stopping at the first fit that meets the relative error criterion of
+    run_dirk_pirk_fit. If none does, the successful fit with the lowest cost is returned.
+
+    If executor (a concurrent.futures executor) is given, the n_fits fits run concurrently on it. The results
+    are still taken in the order above, so the returned fit is the same as without an executor; the fits
+    ranked after the accepted one are cancelled.
+
+    Returns: fit, pcov, perr, fit_success
+    """
+    n = len(p0)
+    bounds = ([0] * n, [np.inf] * n)
+    weights = fit_weights(trace_y)
+    model = DirkPirkEvaluator(x_total, pirk_points)
+
+    starts = space_filling_starts(p0, n_starts=n_starts, spread=spread, seed=seed)
+    with np.errstate(over='ignore', invalid='ignore'):
+        costs = np.array([np.sum(((model(x_total, *start) - trace_y) / weights) ** 2) for start in starts])
+    costs[~np.isfinite(costs)] = np.inf
+
+    # p0 is always fitted first, as in run_dirk_pirk_fit, the screened starts replace the retries
+    retry_order = 1 + np.argsort(costs[1:], kind='stable')
+    selected_starts = starts[np.concatenate([[0], retry_order[:n_fits - 1]])]
+    if executor is None:
+        results = (_fit_from_start(x_total, trace_y, pirk_points, start, weights, analytic_jacobian, bounds)
+                   for start in selected_starts)
+    else:
+        futures = [executor.submit(_fit_from_start, x_total, trace_y, pirk_points, start, weights,
+                                   analytic_jacobian, bounds)
+                   for start in selected_starts]
+        results = (future.result() for future in futures)
+
+    best = None
+    for result in results:
+        if result is None:
+            continue
+        if best is None or result[4] < best[4]:
+            best = result
+        if relative_error_accepted(result[3], threshold):
+            best = result
+            break
+
+    if executor is not None:
+        for future in futures:
+            future.cancel()
+
+    if best is None:
+        return None, None, None, False
+
+    fit, pcov, perr, _, _ = best
+    return fit, pcov, perr, True
+
+
+def construct_fit_outputs(fit, pirk_points, x_total):
+    """
+    Compute model outputs, time constants and relative pirk amplitudes of a fit.
+    Does not need the DataFrame, so it can run in a worker process.
+    """
+    dirk_pirk_x, dirk_pirk_y, gH_values, pirk_times, relative_pirk_amplitudes = construct_dirk_pirk(
+        x_total, pirk_points, *fit
+    )
 
     return {
         MODEL_TIME: dirk_pirk_x,
         MODEL_PREDICTION: dirk_pirk_y,
         TIME_CONSTANTS: gH_values,
-        PIRK_TIMES: pirk_times,
-        PIRK_AMPLITUDES: relative_pirk_amplitudes,
-        STEADY_STATE_PIRK_TIME: steady_state_pirk_x,
-        STEADY_STATE_PIRK_AMPLITUDE: steady_state_pirk_amplitude
+        PIRK_TIMES: [0] + pirk_times,
+        PIRK_AMPLITUDES: relative_pirk_amplitudes
     }
 
 
-def update_combined_df_with_fit(combined_df, index, fit, postprocessed, trace_x, trace_y):
+def add_steady_state_pirk(postprocessed, combined_df, index):
+    """
+    Add the steady state pirk time and amplitude of the trace to the outputs of construct_fit_outputs.
+    """
+    prepared = prepared_trace(combined_df, index)
+    steady_state_pirk_x, steady_state_pirk_amplitude = prepared.steady_state_pirk()
+
+    steady_state_pirk_amplitude = steady_state_pirk_amplitude*prepared.scale
+
+    postprocessed[PIRK_AMPLITUDES] = [steady_state_pirk_amplitude] + postprocessed[PIRK_AMPLITUDES]
+    postprocessed[STEADY_STATE_PIRK_TIME] = steady_state_pirk_x
+    postprocessed[STEADY_STATE_PIRK_AMPLITUDE] = steady_state_pirk_amplitude
+    return postprocessed
+
+
+def postprocess_dirk_pirk_fit(fit, pirk_points, x_total, trace_y, combined_df, index):
+    """
+    Compute model outputs, time constants, relative amplitudes.
+    """
+    postprocessed = construct_fit_outputs(fit, pirk_points, x_total)
+    return add_steady_state_pirk(postprocessed, combined_df, index)
+
+
+def failed_fit_outputs(trace_x, trace_y, n_params=N_DIRK_PIRK_PARAMS):
+    """
+    NaN placeholders for fit, pcov, perr and postprocessed outputs of a failed fit.
+    """
+    fit = [np.nan] * n_params
+    pcov = np.full((n_params, n_params), np.nan)
+    perr = [np.nan] * n_params
+    postprocessed = {
+        MODEL_TIME: np.full_like(trace_x, np.nan),
+        MODEL_PREDICTION: np.full_like(trace_y, np.nan),
+        TIME_CONSTANTS: [np.nan] * n_params,
+        PIRK_TIMES: [np.nan] * n_params,
+        PIRK_AMPLITUDES: [np.nan] * n_params,
+        STEADY_STATE_PIRK_TIME: np.nan,
+        STEADY_STATE_PIRK_AMPLITUDE: np.nan
+    }
+    return fit, pcov, perr, postprocessed
+
+
+def fit_plan(trace_x, pirk_points):
+    """
+    What the model curves of a fit are built on: the model time axis (model_time_axis) and the pirk points.
+    With the fitted parameters it is enough to rebuild the curves, see pirk.fitting.results.
+    """
+    return {"x_end": float(np.max(trace_x)), "n_points": len(trace_x), "pirk_points": [float(p) for p in pirk_points]}
+
+
+def fit_summary(postprocessed, trace_y):
+    """
+    Scalar summaries of a fit (DIRK_PIRK_SUMMARY_COLUMNS), taken from the model curves while they are at hand.
+    """
+    model_prediction = np.asarray(postprocessed[MODEL_PREDICTION], dtype=float)
+    time_constants = np.asarray(postprocessed[TIME_CONSTANTS], dtype=float)
+    return {
+        FIT_RMSE: float(np.sqrt(np.mean((np.asarray(trace_y, dtype=float) - model_prediction) ** 2))),
+        STEADY_STATE_GH: float(time_constants[0]),
+        RELAXED_GH: float(time_constants[-1]),
+        ECST: float(model_prediction[0])
+    }
+
+
+def update_combined_df_with_fit(combined_df, index, fit, postprocessed, trace_x, trace_y, pcov=None,
+                                fit_success=None, pirk_points=None, compact=False):
+    """
+    Write a fit into combined_df. With compact=True only DIRK_PIRK_COMPACT_RESULT_COLUMNS are written, the
+    curves (DIRK_PIRK_CURVE_COLUMNS) are rebuilt when needed by pirk.fitting.results.fit_curves.
+    """
+    for col in (FIT_COVARIANCE, FIT_SUCCESS, FIT_PLAN):
+        add_object_column(combined_df, col, default_content=[], replace=False)
+    for col in DIRK_PIRK_SUMMARY_COLUMNS:
+        if col not in combined_df.columns:
+            combined_df[col] = np.nan
+
     combined_df.at[index, FIT_PARAMS] = fit
+    combined_df.at[index, FIT_COVARIANCE] = pcov
+    combined_df.at[index, FIT_SUCCESS] = fit_success
+    combined_df.at[index, FIT_PLAN] = fit_plan(trace_x, pirk_points) if pirk_points is not None else None
     combined_df.at[index, STEADY_STATE_PIRK_TIME] = postprocessed[STEADY_STATE_PIRK_TIME]
     combined_df.at[index, STEADY_STATE_PIRK_AMPLITUDE] = postprocessed[STEADY_STATE_PIRK_AMPLITUDE]
+    combined_df.at[index, PIRK_AMPLITUDES] = postprocessed[PIRK_AMPLITUDES]
+    combined_df.at[index, PIRK_TIMES] = postprocessed[PIRK_TIMES]
+    for col, value in fit_summary(postprocessed, trace_y).items():
+        combined_df.at[index, col] = value
+    if compact:
+        # curves of an earlier full fit of the row are stale, fit_curves rebuilds them from the new fit
+        for col in DIRK_PIRK_CURVE_COLUMNS:
+            if col in combined_df.columns:
+                combined_df.at[index, col] = []
+        return
     combined_df.at[index, TIME_CONSTANTS] = postprocessed[TIME_CONSTANTS]
     combined_df.at[index, MODEL_TIME] = postprocessed[MODEL_TIME]
     combined_df.at[index, MODEL_PREDICTION] = postprocessed[MODEL_PREDICTION]
-    combined_df.at[index, PIRK_AMPLITUDES] = postprocessed[PIRK_AMPLITUDES]
-    combined_df.at[index, PIRK_TIMES] = postprocessed[PIRK_TIMES]
-    combined_df.at[index, TIME_FITTED] = trace_x
-    combined_df.at[index, TRACE_FITTED] = trace_y
+    # copies: trace_x and trace_y may be read-only arrays of the prepared trace cache
+    combined_df.at[index, TIME_FITTED] = np.array(trace_x)
+    combined_df.at[index, TRACE_FITTED] = np.array(trace_y)
 
 
-def fit_pirk_dirk(combined_df, index, guess_dict):
+def initial_guess_from_dict(guess_dict):
     """
-    Compute DIRK/PIRK fit and update DataFrame.
-    No plotting or printing.
+    Initial guess p0 for dirk_pirk, in the order of DIRK_PIRK_PARAMETERS.
     """
+    return [guess_dict[name] for name in DIRK_PIRK_PARAMETERS]
 
-    trace_x, trace_y, pirk_points, dirk_point_indexes = prep_traces_for_fitting(combined_df, index)
+
+def model_time_axis(trace_x):
+    """
+    Evenly spaced time axis the model is fitted on, from 0 to the end of trace_x.
+    """
     x_end = np.max(trace_x)
     x_total_points = len(trace_x)
-    x_total = np.linspace(0, x_end, x_total_points)
+    return np.linspace(0, x_end, x_total_points)
+
 
-    p0 = [
-        guess_dict[AMPLITUDE],
-        guess_dict[GH_START],
-        guess_dict[GH_END],
-        guess_dict[GH_LIFETIME],
-        guess_dict[PIRK_BEGIN_AMPLITUDE],
-        guess_dict[PIRK_END_AMPLITUDE],
-        guess_dict[PIRK_AMPLITUDE_RECOVERY_LIFETIME],
-        guess_dict[OFFSET_AMPLITUDE],
-        guess_dict[OFFSET_LIFETIME]
-    ]
+def fit_prepared_trace(trace_x, trace_y, pirk_points, p0, analytic_jacobian=False, multistart=False):
+    """
+    Fit the DIRK/PIRK model to a trace prepared by prep_traces_for_fitting.
+    Only works on arrays (no DataFrame), so it can be shipped to a worker process.
+    With multistart=True run_multistart_dirk_pirk_fit is used instead of the retry loop of run_dirk_pirk_fit.
 
+    Returns: fit, pcov, perr, fit_success, postprocessed
+    postprocessed holds the outputs of construct_fit_outputs, without the steady state pirk values.
+    """
+    x_total = model_time_axis(trace_x)
 
-    fit, pcov, perr, fit_success = run_dirk_pirk_fit(x_total, trace_y, p0, pirk_points)
+    if multistart:
+        fit, pcov, perr, fit_success = run_multistart_dirk_pirk_fit(x_total, trace_y, list(p0), pirk_points,
+                                                                    analytic_jacobian=analytic_jacobian)
+    else:
+        fit, pcov, perr, fit_success = run_dirk_pirk_fit(x_total, trace_y, list(p0), pirk_points,
+                                                         analytic_jacobian=analytic_jacobian)
 
     if not fit_success:
-        fit = [np.nan] * len(p0)
-        pcov = np.full((len(p0), len(p0)), np.nan)
-        perr = [np.nan] * len(p0)
-        postprocessed = {
-            "dirk_pirk_x": np.full_like(trace_x, np.nan),
-            "dirk_pirk_y": np.full_like(trace_y, np.nan),
-            "gH_values": [np.nan] * len(p0),
-            "pirk_times": [np.nan] * len(p0),
-            "relative_pirk_amplitudes": [np.nan] * len(p0),
-            "steady_state_pirk_x": np.nan,
-            "steady_state_pirk_amplitude": np.nan
-        }
+        fit, pcov, perr, postprocessed = failed_fit_outputs(trace_x, trace_y, len(p0))
     else:
-        postprocessed = postprocess_dirk_pirk_fit(fit, pirk_points, x_total, trace_y, combined_df, index)
+        postprocessed = construct_fit_outputs(fit, pirk_points, x_total)
+
+    return fit, pcov, perr, fit_success, postprocessed
+
+
+def fit_cache_key_for_trace(trace_x, trace_y, pirk_points, p0, analytic_jacobian=False, multistart=False):
+    """
+    Key of a fit_prepared_trace result in a FitCache.
+    """
+    settings = {
+        "analytic_jacobian": analytic_jacobian,
+        "multistart": multistart,
+        "max_attempts": MAX_FIT_ATTEMPTS,
+        "threshold": REL_ERR_THRESHOLD
+    }
+    if multistart:
+        settings.update(starts=MULTISTART_STARTS, fits=MULTISTART_FITS, spread=MULTISTART_SPREAD)
+    return fit_cache_key(trace_x, trace_y, pirk_points, p0, settings=settings)
+
+
+def fit_prepared_trace_cached(trace_x, trace_y, pirk_points, p0, cache=None, **fit_options):
+    """
+    fit_prepared_trace, looking the result up in (and adding it to) cache, a FitCache.
+    fit_options are passed to fit_prepared_trace.
+    """
+    if cache is None:
+        return fit_prepared_trace(trace_x, trace_y, pirk_points, p0, **fit_options)
+
+    key = fit_cache_key_for_trace(trace_x, trace_y, pirk_points, p0, **fit_options)
+    result = cache.get(key)
+    if result is None:
+        result = fit_prepared_trace(trace_x, trace_y, pirk_points, p0, **fit_options)
+        cache.put(key, result)
+    return result
+
+
+def fit_pirk_dirk(combined_df, index, guess_dict, analytic_jacobian=False, multistart=False, cache=None,
+                  compact=False):
+    """
+    Compute DIRK/PIRK fit and update DataFrame.
+    No plotting or printing.
+    If cache (a FitCache) is given, an unchanged trace is not refitted.
+    With compact=True the model curves are not stored in combined_df, see update_combined_df_with_fit.
+    """
+
+    trace_x, trace_y, pirk_points, dirk_point_indexes = prep_traces_for_fitting(combined_df, index)
+    p0 = initial_guess_from_dict(guess_dict)
+
+    fit, pcov, perr, fit_success, postprocessed = fit_prepared_trace_cached(trace_x, trace_y, pirk_points, p0,
+                                                                            cache=cache,
+                                                                            analytic_jacobian=analytic_jacobian,
+                                                                            multistart=multistart)
+    if fit_success:
+        postprocessed = add_steady_state_pirk(postprocessed, combined_df, index)
 
-    update_combined_df_with_fit(combined_df, index, fit, postprocessed, trace_x, trace_y)
+    update_combined_df_with_fit(combined_df, index, fit, postprocessed, trace_x, trace_y, pcov=pcov,
+                                fit_success=fit_success, pirk_points=pirk_points, compact=compact)
 
     return fit, pcov, perr, postprocessed
 
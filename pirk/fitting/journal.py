@@ -0,0 +1,116 @@
+# Append-only journal of a batch fitting run, one JSON record per line.
+# Every completed fit is written (and flushed to disk) as soon as it is merged, so an interrupted run
+# can be resumed without refitting the traces that were already done.
+import json
+import os
+import time
+
+import numpy as np
+
+from pirk.fitting.models import DIRK_PIRK_MODEL_VERSION
+
+RECORD_RUN = "run"
+RECORD_FIT = "fit"
+
+
+def _to_json_value(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    return value
+
+
+class FitJournal:
+    """
+    Journal of a batch fitting run.
+
+    The file starts with one "run" record per (re)start, holding the initial guess and fitter settings,
+    followed by one "fit" record per completed trace: index, fit, pcov, perr, fit_success, elapsed and error.
+    A record cut off by a crash is ignored when the journal is read back.
+
+    Parameters
+    ----------
+    path : str
+        Journal file, created if missing and appended to otherwise.
+    """
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+
+    def _write(self, record):
+        line = json.dumps({k: _to_json_value(v) for k, v in record.items()})
+        with open(self.path, "a") as f:
+            f.write(line + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def start_run(self, guess_dict, settings):
+        """
+        Append a run record. Warns if the journal already holds fits made with another guess or settings.
+        """
+        previous = [record for record in self.records() if record["type"] == RECORD_RUN]
+        if previous and (previous[-1]["guess_dict"] != guess_dict or previous[-1]["settings"] != settings
+                         or previous[-1]["model_version"] != DIRK_PIRK_MODEL_VERSION):
+            print(f"⚠️ Journal {self.path} was written with a different initial guess, settings or model version.")
+
+        self._write({
+            "type": RECORD_RUN,
+            "started": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "guess_dict": {k: _to_json_value(v) for k, v in guess_dict.items()},
+            "settings": settings,
+            "model_version": DIRK_PIRK_MODEL_VERSION
+        })
+
+    def append(self, result):
+        """
+        Append a completed fit, result as returned by fit_task.
+        """
+        self._write({
+            "type": RECORD_FIT,
+            "index": result["index"],
+            "fit": result["fit"],
+            "pcov": result["pcov"],
+            "perr": result["perr"],
+            "fit_success": bool(result["fit_success"]),
+            "elapsed": result["elapsed"],
+            "error": result["error"]
+        })
+
+    def records(self):
+        """
+        All complete records of the journal, in the order they were written.
+        """
+        if not os.path.exists(self.path):
+            return []
+
+        records = []
+        with open(self.path) as f:
+            for line_number, line in enumerate(f, start=1):
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    print(f"Skipping incomplete record on line {line_number} of {self.path}")
+        return records
+
+    def completed_fits(self):
+        """
+        Last fit record of every journaled index, with fit, pcov and perr as arrays.
+
+        Returns
+        -------
+        fits : dict
+            index -> record
+        """
+        fits = {}
+        for record in self.records():
+            if record["type"] != RECORD_FIT:
+                continue
+            record["fit"] = np.array(record["fit"], dtype=float)
+            record["pcov"] = np.array(record["pcov"], dtype=float)
+            record["perr"] = np.array(record["perr"], dtype=float)
+            fits[record["index"]] = record
+        return fits
@@ -1,7 +1,7 @@
 import numpy as np
 
 from pirk.fitting.model_basic import pirk_amplitude_recovery, exp_decay, exp_decay_with_variable_gH
-from pirk.parsing.helpers import find_closest_index
+from pirk.parsing.helpers import find_closest_indices
 
 def construct_dirk_pirk (x_total, pirk_points, dirk_amplitude,
                          gH_start, gH_end, gH_lifetime,
@@ -43,14 +43,12 @@ def construct_dirk_pirk (x_total, pirk_points, dirk_amplitude,
     relative_pirk_amplitudes = []
     pirk_times = []
 
-    for i, pirk_begin in enumerate(pirk_points):
-        if i == len(pirk_points) - 1:
-            pirk_end = x_total[-1]
-        else:
-            pirk_end = pirk_points[i + 1]
+    # segment i runs from pirk point i to pirk point i + 1, the last one to the end of x_total
+    boundary_indices = find_closest_indices(x_total, list(pirk_points) + [x_total[-1]]).tolist()
 
-        pirk_begin_index = find_closest_index(x_total, pirk_begin)
-        pirk_end_index = find_closest_index(x_total, pirk_end)
+    for i, pirk_begin in enumerate(pirk_points):
+        pirk_begin_index = boundary_indices[i]
+        pirk_end_index = boundary_indices[i + 1]
         # print(pirk_begin, pirk_end, pirk_begin_index, pirk_end_index)
 
         x = np.linspace(x_total[pirk_begin_index], x_total[pirk_end_index], pirk_end_index - pirk_begin_index)
@@ -108,4 +106,305 @@ def dirk_pirk (x_total, amplitude, gH_start, gH_end, gH_lifetime,
                                                                       pirk_amplitude_recovery_lifetime,
                                                                       offset_amplitude, offset_lifetime)
 
-       return dirk_pirk_y
\ No newline at end of file
+       return dirk_pirk_y
+
+N_DIRK_PIRK_PARAMS = 9
+
+# bump whenever the model output changes, cached fits of older versions are then ignored
+DIRK_PIRK_MODEL_VERSION = "1"
+
+
+class SegmentPlan:
+    """
+    Precompiled segment layout of a Dirk Pirk protocol for a fixed time axis.
+
+    construct_dirk_pirk locates every pirk segment in x_total and builds its local time vector on each call,
+    although neither depends on the fit parameters. The plan does this once per trace so that the model can be
+    evaluated many times (e.g. inside curve_fit) without repeating the index search and linspace construction.
+
+    input:
+        x_total: array, x values for the total decay time
+        pirk_points: array, x values for the pirk points
+
+    attributes:
+        begin_indices, end_indices: array of int, begin and end index of each segment in x_total
+        segment_x: list of arrays, x values of each segment (as built by construct_dirk_pirk)
+        segment_t: list of arrays, time of each segment relative to its pirk point
+        pirk_times: array, first x value of each segment
+        dirk_pirk_x: array, model x values for the whole trace (independent of the fit parameters)
+        local_t: array, time relative to the pirk point for every sample of the trace
+        segment_ids: array of int, segment that owns each sample, -1 where no segment is written
+    """
+
+    def __init__(self, x_total, pirk_points):
+        x_total = np.asarray(x_total, dtype=float)
+        n_total = len(x_total)
+        n_segments = len(pirk_points)
+
+        begin_indices = np.zeros(n_segments, dtype=int)
+        end_indices = np.zeros(n_segments, dtype=int)
+        segment_x = []
+        segment_t = []
+
+        dirk_pirk_x = np.zeros(n_total)
+        local_t = np.zeros(n_total)
+        segment_ids = np.full(n_total, -1, dtype=int)
+
+        # segment i runs from pirk point i to pirk point i + 1, the last one to the end of x_total
+        boundary_indices = find_closest_indices(x_total, list(pirk_points) + [x_total[-1]]).tolist()
+
+        for i, pirk_begin in enumerate(pirk_points):
+            pirk_begin_index = boundary_indices[i]
+            pirk_end_index = boundary_indices[i + 1]
+            if pirk_end_index <= pirk_begin_index:
+                raise ValueError(f"Pirk segment {i} starting at {pirk_begin} contains no points of x_total")
+
+            x = np.linspace(x_total[pirk_begin_index], x_total[pirk_end_index], pirk_end_index - pirk_begin_index)
+            t = x - pirk_begin
+
+            # later segments overwrite earlier ones, exactly as in construct_dirk_pirk
+            window = slice(pirk_begin_index, pirk_begin_index + len(x))
+            dirk_pirk_x[window] = x
+            local_t[window] = t
+            segment_ids[window] = i
+
+            begin_indices[i] = pirk_begin_index
+            end_indices[i] = pirk_end_index
+            segment_x.append(x)
+            segment_t.append(t)
+
+        dirk_pirk_x[-1] = dirk_pirk_x[-2]
+
+        self.x_total = x_total
+        self.pirk_points = list(pirk_points)
+        self.begin_indices = begin_indices
+        self.end_indices = end_indices
+        self.segment_x = segment_x
+        self.segment_t = segment_t
+        self.pirk_times = np.array([x[0] for x in segment_x])
+        self.segment_last_t = np.array([t[-1] for t in segment_t])
+        self.dirk_pirk_x = dirk_pirk_x
+        self.local_t = local_t
+        self.segment_ids = segment_ids
+        self.unwritten_indices = np.flatnonzero(segment_ids < 0)
+
+    def __len__(self):
+        return len(self.x_total)
+
+    @property
+    def n_segments(self):
+        return len(self.segment_x)
+
+
+def build_segment_plan(x_total, pirk_points):
+    """
+    Build the SegmentPlan of a trace, see SegmentPlan.
+    """
+    return SegmentPlan(x_total, pirk_points)
+
+
+class DirkPirkEvaluator:
+    """
+    Allocation-free evaluator of the Dirk Pirk model on a SegmentPlan.
+
+    The chain of segment amplitudes and gH+ start values only involves the last point of each segment, so it is
+    propagated with scalars and the whole trace is then evaluated in a single vectorised pass into preallocated
+    buffers. The result agrees with construct_dirk_pirk to within float rounding.
+
+    The arrays returned by evaluate() and __call__() are internal buffers that are overwritten by the next call;
+    copy them if they have to be kept. construct() returns fresh arrays.
+
+    input:
+        plan: SegmentPlan, or x_total when pirk_points is given
+        pirk_points: array, x values for the pirk points (only when a plan is not passed)
+    """
+
+    def __init__(self, plan, pirk_points=None):
+        if not isinstance(plan, SegmentPlan):
+            plan = SegmentPlan(plan, pirk_points)
+        self.plan = plan
+
+        n_total = len(plan)
+        self._neg_t = -plan.local_t
+        self._neg_x = -plan.dirk_pirk_x
+        self._segment_ids = np.where(plan.segment_ids < 0, 0, plan.segment_ids)
+
+        self.y = np.empty(n_total)
+        self.gH = np.empty(n_total)
+        self._work = np.empty(n_total)
+        self.segment_amplitudes = np.empty(plan.n_segments)
+        self.segment_gH_start = np.empty(plan.n_segments)
+        self.relative_pirk_amplitudes = np.empty(max(plan.n_segments - 1, 0))
+
+        self.jac = np.empty((n_total, N_DIRK_PIRK_PARAMS))
+        self._decay = np.empty(n_total)
+        self._signal = np.empty(n_total)
+        self.segment_amplitude_grads = np.zeros((plan.n_segments, N_DIRK_PIRK_PARAMS))
+        self.segment_gH_start_grads = np.zeros((plan.n_segments, N_DIRK_PIRK_PARAMS))
+
+    def _propagate_segments(self, dirk_amplitude, gH_start, gH_end, gH_lifetime,
+                            pirk_begin_amplitude, pirk_end_amplitude, pirk_amplitude_recovery_lifetime):
+        """
+        Propagate the amplitude and gH+ start value from each segment to the next one.
+        """
+        pirk_times = self.plan.pirk_times
+        last_t = self.plan.segment_last_t
+
+        amplitude = dirk_amplitude
+        gH_start_use = gH_start
+        for i in range(self.plan.n_segments):
+            if i > 0:
+                relative_pirk_amplitude = pirk_amplitude_recovery(pirk_times[i], pirk_begin_amplitude,
+                                                                  pirk_end_amplitude, pirk_amplitude_recovery_lifetime)
+                self.relative_pirk_amplitudes[i - 1] = relative_pirk_amplitude
+                amplitude = y_last + relative_pirk_amplitude
+                gH_start_use = gH_last
+
+            self.segment_amplitudes[i] = amplitude
+            self.segment_gH_start[i] = gH_start_use
+
+            gH_last = (gH_start_use - gH_end) * np.exp(-last_t[i] / gH_lifetime) + gH_end
+            y_last = amplitude * np.exp(-last_t[i] * gH_last)
+
+    def evaluate(self, dirk_amplitude, gH_start, gH_end, gH_lifetime,
+                 pirk_begin_amplitude, pirk_end_amplitude, pirk_amplitude_recovery_lifetime,
+                 offset_amplitude, offset_lifetime):
+        """
+        Evaluate the model, returns (y_total, gH_values_total) as internal buffers.
+        """
+        self._propagate_segments(dirk_amplitude, gH_start, gH_end, gH_lifetime,
+                                 pirk_begin_amplitude, pirk_end_amplitude, pirk_amplitude_recovery_lifetime)
+        y, gH, work = self.y, self.gH, self._work
+        unwritten = self.plan.unwritten_indices
+
+        # gH = (gH_start_segment - gH_end) * exp(-t / gH_lifetime) + gH_end
+        np.divide(self._neg_t, gH_lifetime, out=gH)
+        np.exp(gH, out=gH)
+        np.take(self.segment_gH_start, self._segment_ids, out=work)
+        work -= gH_end
+        gH *= work
+        gH += gH_end
+
+        # y = amplitude_segment * exp(-t * gH)
+        np.multiply(self._neg_t, gH, out=y)
+        np.exp(y, out=y)
+        np.take(self.segment_amplitudes, self._segment_ids, out=work)
+        y *= work
+
+        y[unwritten] = 0.0
+        gH[unwritten] = 0.0
+
+        # slow phase, not associated with gH+ changes
+        np.divide(self._neg_x, offset_lifetime, out=work)
+        np.exp(work, out=work)
+        work *= offset_amplitude
+        y += work
+
+        y[-1] = y[-2]
+        gH[-1] = gH[-2]
+        return y, gH
+
+    def _propagate_segment_gradients(self, dirk_amplitude, gH_start, gH_end, gH_lifetime,
+                                     pirk_begin_amplitude, pirk_end_amplitude, pirk_amplitude_recovery_lifetime):
+        """
+        Forward-propagate the gradients of the segment amplitudes and gH+ start values through the segment chain.
+        Row i of segment_amplitude_grads / segment_gH_start_grads holds the derivatives with respect to the nine
+        model parameters (the slow phase parameters do not enter the chain and keep a zero gradient).
+        """
+        pirk_times = self.plan.pirk_times
+        last_t = self.plan.segment_last_t
+        dA = self.segment_amplitude_grads
+        dS = self.segment_gH_start_grads
+        dA[:] = 0.0
+        dS[:] = 0.0
+
+        amplitude = dirk_amplitude
+        gH_start_use = gH_start
+        dA[0, 0] = 1.0
+        dS[0, 1] = 1.0
+        for i in range(self.plan.n_segments):
+            if i > 0:
+                recovery_decay = np.exp(-pirk_times[i] / pirk_amplitude_recovery_lifetime)
+                relative_pirk_amplitude = (pirk_begin_amplitude - pirk_end_amplitude) * recovery_decay + pirk_end_amplitude
+                amplitude = y_last + relative_pirk_amplitude
+                gH_start_use = gH_last
+
+                dA[i] = dy_last
+                dA[i, 4] += recovery_decay
+                dA[i, 5] += 1.0 - recovery_decay
+                dA[i, 6] += ((pirk_begin_amplitude - pirk_end_amplitude) * recovery_decay
+                             * pirk_times[i] / pirk_amplitude_recovery_lifetime ** 2)
+                dS[i] = dgH_last
+
+            self.segment_amplitudes[i] = amplitude
+            self.segment_gH_start[i] = gH_start_use
+
+            decay_last = np.exp(-last_t[i] / gH_lifetime)
+            gH_last = (gH_start_use - gH_end) * decay_last + gH_end
+            signal_last = np.exp(-last_t[i] * gH_last)
+            y_last = amplitude * signal_last
+
+            dgH_last = decay_last * dS[i]
+            dgH_last[2] += 1.0 - decay_last
+            dgH_last[3] += (gH_start_use - gH_end) * decay_last * last_t[i] / gH_lifetime ** 2
+            dy_last = signal_last * dA[i] - amplitude * signal_last * last_t[i] * dgH_last
+
+    def jacobian(self, x_total, dirk_amplitude, gH_start, gH_end, gH_lifetime,
+                 pirk_begin_amplitude, pirk_end_amplitude, pirk_amplitude_recovery_lifetime,
+                 offset_amplitude, offset_lifetime):
+        """
+        Analytic Jacobian of the model output with respect to the nine parameters, shape (len(x_total), 9).
+        Signature matches the jac argument of curve_fit; returns an internal buffer like evaluate().
+        """
+        self._propagate_segment_gradients(dirk_amplitude, gH_start, gH_end, gH_lifetime,
+                                          pirk_begin_amplitude, pirk_end_amplitude, pirk_amplitude_recovery_lifetime)
+        jac, decay, signal, work = self.jac, self._decay, self._signal, self._work
+        segment_ids = self._segment_ids
+        neg_t = self._neg_t
+        unwritten = self.plan.unwritten_indices
+
+        # decay = exp(-t / gH_lifetime), work = gH_start_segment - gH_end, signal = exp(-t * gH)
+        np.divide(neg_t, gH_lifetime, out=decay)
+        np.exp(decay, out=decay)
+        np.take(self.segment_gH_start, segment_ids, out=work)
+        work -= gH_end
+        np.multiply(work, decay, out=signal)
+        signal += gH_end
+        signal *= neg_t
+        np.exp(signal, out=signal)
+
+        # dy/dp = dA/dp * signal - A * signal * t * dgH/dp, with dgH/dp = decay * dS/dp + direct terms
+        amplitude_signal_t = np.take(self.segment_amplitudes, segment_ids)
+        amplitude_signal_t *= signal
+        amplitude_signal_t *= neg_t
+
+        jac[:, :7] = self.segment_amplitude_grads[segment_ids, :7] * signal[:, None]
+        jac[:, :7] += self.segment_gH_start_grads[segment_ids, :7] * (amplitude_signal_t * decay)[:, None]
+        jac[:, 2] += amplitude_signal_t * (1.0 - decay)
+        jac[:, 3] += amplitude_signal_t * work * decay * (-neg_t) / gH_lifetime ** 2
+        jac[unwritten, :7] = 0.0
+
+        # slow phase
+        np.divide(self._neg_x, offset_lifetime, out=work)
+        np.exp(work, out=work)
+        jac[:, 7] = work
+        jac[:, 8] = offset_amplitude * work * (-self._neg_x) / offset_lifetime ** 2
+
+        jac[-1] = jac[-2]
+        return jac
+
+    def __call__(self, x_total, *params):
+        """
+        Model function for curve_fit, x_total must be the axis the plan was built for.
+        """
+        y, _ = self.evaluate(*params)
+        return y
+
+    def construct(self, *params):
+        """
+        Same outputs as construct_dirk_pirk, as freshly allocated arrays and lists.
+        """
+        y, gH = self.evaluate(*params)
+        pirk_times = list(self.plan.pirk_times[1:])
+        relative_pirk_amplitudes = list(self.relative_pirk_amplitudes)
+        return self.plan.dirk_pirk_x.copy(), y.copy(), gH.copy(), pirk_times, relative_pirk_amplitudes
@@ -0,0 +1,203 @@
+# Model curves of stored DIRK/PIRK fits, rebuilt on demand.
+# A compact fit (fit_pirk_dirk_batch(..., compact=True)) only keeps the parameters, covariance, status and
+# the fit plan (model time axis and pirk points); the full-length curves are recomputed from these when a
+# trace is plotted or exported, and the last DEFAULT_CURVE_CACHE_SIZE curves are kept in memory.
+from functools import lru_cache
+
+import numpy as np
+import pandas as pd
+
+from pirk.names import *
+from pirk.fitting.fitters import fit_plan, fit_summary
+from pirk.fitting.models import construct_dirk_pirk
+from pirk.parsing.prep_data_fit import prep_traces_for_fitting
+from pirk.parsing.helpers import add_object_column
+
+DEFAULT_CURVE_CACHE_SIZE = 256
+
+
+def _read_only(values):
+    values = np.array(values, dtype=float)
+    values.flags.writeable = False
+    return values
+
+
+@lru_cache(maxsize=DEFAULT_CURVE_CACHE_SIZE)
+def model_curves(fit, x_end, n_points, pirk_points):
+    """
+    Model time axis, prediction and gH+ values of a fit, as stored by update_combined_df_with_fit.
+    Cached, so the arguments are hashable (tuples) and the returned arrays are read-only.
+
+    input: fit (tuple of the fitted parameters), x_end and n_points of the model time axis, pirk_points (tuple)
+    output: model_time, model_prediction, time_constants
+    """
+    if not np.all(np.isfinite(fit)):
+        nan_curve = _read_only(np.full(n_points, np.nan))
+        return nan_curve, nan_curve, _read_only([np.nan] * len(fit))
+
+    x_total = np.linspace(0, x_end, n_points)
+    dirk_pirk_x, dirk_pirk_y, gH_values, _, _ = construct_dirk_pirk(x_total, list(pirk_points), *fit)
+    return _read_only(dirk_pirk_x), _read_only(dirk_pirk_y), _read_only(gH_values)
+
+
+def _stored_plan(combined_df, index):
+    plan = combined_df.at[index, FIT_PLAN] if FIT_PLAN in combined_df.columns else None
+    if not isinstance(plan, dict):
+        # fitted before the plan was stored, or the plan was lost: it only depends on the prepared trace
+        trace_x, _, pirk_points, _ = prep_traces_for_fitting(combined_df, index)
+        plan = fit_plan(trace_x, pirk_points)
+    return plan
+
+
+def _has_curve(combined_df, index, col):
+    if col not in combined_df.columns:
+        return False
+    values = combined_df.at[index, col]
+    return values is not None and not isinstance(values, float) and len(values) > 0
+
+
+def fit_curves(combined_df, index):
+    """
+    Curves of the fit of one trace, taken from the DIRK_PIRK_CURVE_COLUMNS if they were stored and rebuilt
+    from the fit parameters and plan otherwise.
+
+    Returns
+    -------
+    curves : dict
+        DIRK_PIRK_CURVE_COLUMNS -> array
+    """
+    if all(_has_curve(combined_df, index, col) for col in DIRK_PIRK_CURVE_COLUMNS):
+        return {col: combined_df.at[index, col] for col in DIRK_PIRK_CURVE_COLUMNS}
+
+    plan = _stored_plan(combined_df, index)
+    fit = tuple(float(p) for p in combined_df.at[index, FIT_PARAMS])
+    model_time, model_prediction, time_constants = model_curves(fit, plan["x_end"], plan["n_points"],
+                                                                tuple(plan["pirk_points"]))
+    trace_x, trace_y, _, _ = prep_traces_for_fitting(combined_df, index)
+    return {
+        TIME_CONSTANTS: time_constants,
+        MODEL_TIME: model_time,
+        MODEL_PREDICTION: model_prediction,
+        TIME_FITTED: trace_x,
+        TRACE_FITTED: trace_y
+    }
+
+
+def expand_fit_results(combined_df, indexes=None):
+    """
+    Add (or fill in) the DIRK_PIRK_CURVE_COLUMNS of compact fits, e.g. before exporting combined_df.
+
+    input: combined_df, indexes (default: all rows with a fit)
+    output: combined_df
+    """
+    if indexes is None:
+        indexes = [index for index, fit in combined_df[FIT_PARAMS].items() if fit is not None and len(fit) > 0]
+    for col in DIRK_PIRK_CURVE_COLUMNS:
+        add_object_column(combined_df, col, default_content=[], replace=False)
+    for index in indexes:
+        for col, values in fit_curves(combined_df, index).items():
+            combined_df.at[index, col] = np.array(values)
+    return combined_df
+
+
+def compact_fit_results(combined_df):
+    """
+    Drop the DIRK_PIRK_CURVE_COLUMNS of combined_df, storing the fit plan first where it is missing so that
+    the curves can still be rebuilt with fit_curves.
+
+    input: combined_df
+    output: combined_df without the curve columns
+    """
+    add_object_column(combined_df, FIT_PLAN, default_content=[], replace=False)
+    for index, fit in combined_df[FIT_PARAMS].items():
+        if fit is not None and len(fit) > 0 and not isinstance(combined_df.at[index, FIT_PLAN], dict):
+            combined_df.at[index, FIT_PLAN] = _stored_plan(combined_df, index)
+    return combined_df.drop(columns=[col for col in DIRK_PIRK_CURVE_COLUMNS if col in combined_df.columns])
+
+
+def _stack(cells, shape):
+    """
+    Stack the cells of an object column into one float64 array, NaN for missing or malformed cells.
+    """
+    stacked = np.full((len(cells),) + shape, np.nan)
+    for position, cell in enumerate(cells):
+        if cell is not None and np.shape(cell) == shape:
+            stacked[position] = cell
+    return stacked
+
+
+def _scalars(cells):
+    return np.array([float(cell) if np.isscalar(cell) else np.nan for cell in cells])
+
+
+def _end_values(cells):
+    first = np.full(len(cells), np.nan)
+    last = np.full(len(cells), np.nan)
+    for position, cell in enumerate(cells):
+        if cell is not None and not isinstance(cell, float) and len(cell) > 0:
+            first[position], last[position] = cell[0], cell[-1]
+    return first, last
+
+
+def fit_results_table(combined_df, indexes=None, confidence_z=1.96):
+    """
+    Flat, typed table of DIRK/PIRK fits: one row per trace and one float64 column per value, so summary
+    statistics are plain vectorised pandas operations instead of loops over object-array columns.
+
+    Parameters
+    ----------
+    combined_df : pd.DataFrame
+        DataFrame with fit results (full or compact).
+    indexes : iterable, optional
+        Row indexes, default all rows with a fit.
+    confidence_z : float, optional
+        z value of the confidence interval, default 1.96 (95%, as print_fit_table).
+
+    Returns
+    -------
+    table : pd.DataFrame
+        Indexed by the METADATA_COLUMNS, with TRACE_INDEX (the row of combined_df), FIT_SUCCESS, and for every
+        parameter in DIRK_PIRK_PARAMETERS its value, STD_ERROR_SUFFIX, CI_LOWER_SUFFIX and CI_UPPER_SUFFIX
+        columns, followed by the DIRK_PIRK_SUMMARY_COLUMNS, STEADY_STATE_PIRK, RELAXED_PIRK and
+        TOTAL_FIT_AMPLITUDE.
+    """
+    if indexes is None:
+        indexes = [index for index, fit in combined_df[FIT_PARAMS].items() if fit is not None and len(fit) > 0]
+    rows = combined_df.loc[list(indexes)]
+    n_params = len(DIRK_PIRK_PARAMETERS)
+
+    params = _stack(rows[FIT_PARAMS].values, (n_params,))
+    if FIT_COVARIANCE in rows.columns:
+        pcov = _stack(rows[FIT_COVARIANCE].values, (n_params, n_params))
+    else:
+        pcov = np.full((len(rows), n_params, n_params), np.nan)
+    with np.errstate(invalid="ignore"):
+        perr = np.sqrt(np.diagonal(pcov, axis1=1, axis2=2))
+
+    columns = {TRACE_INDEX: rows.index.values}
+    if FIT_SUCCESS in rows.columns:
+        columns[FIT_SUCCESS] = rows[FIT_SUCCESS].map(lambda success: bool(success) is True).values
+    else:
+        columns[FIT_SUCCESS] = np.all(np.isfinite(params), axis=1)
+    for position, name in enumerate(DIRK_PIRK_PARAMETERS):
+        columns[name] = params[:, position]
+        columns[name + STD_ERROR_SUFFIX] = perr[:, position]
+        columns[name + CI_LOWER_SUFFIX] = params[:, position] - confidence_z * perr[:, position]
+        columns[name + CI_UPPER_SUFFIX] = params[:, position] + confidence_z * perr[:, position]
+
+    for col in DIRK_PIRK_SUMMARY_COLUMNS:
+        columns[col] = _scalars(rows[col].values) if col in rows.columns else np.full(len(rows), np.nan)
+    for position in np.flatnonzero(np.isnan(columns[FIT_RMSE]) & np.all(np.isfinite(params), axis=1)):
+        # fitted before the summaries were stored
+        curves = fit_curves(combined_df, rows.index[position])
+        for col, value in fit_summary(curves, curves[TRACE_FITTED]).items():
+            columns[col][position] = value
+
+    columns[STEADY_STATE_PIRK], columns[RELAXED_PIRK] = _end_values(rows[PIRK_AMPLITUDES].values)
+    columns[TOTAL_FIT_AMPLITUDE] = columns[AMPLITUDE] + columns[OFFSET_AMPLITUDE]
+
+    table = pd.DataFrame(columns)
+    metadata = [col for col in METADATA_COLUMNS if col in rows.columns]
+    if metadata:
+        table.index = pd.MultiIndex.from_frame(rows[metadata].reset_index(drop=True))
+    return table
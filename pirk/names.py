@@ -21,6 +21,12 @@ LABEL_FLURO = "fluro-pirk"
 LABEL_PAM = "PAM"
 LABEL_PAM_P700 = "PAM-P700"
 NUMBER_PULSES="number_pulses"
+
+# per trace metadata, small enough to load for the whole screen
+METADATA_COLUMNS = [LABEL_COLUMN, GENOTYPE_COLUMN, TREATMENT_COLUMN, REPLICATE_COLUMN]
+
+# traces sharing these columns are similar enough to start each other's fits
+WARM_START_COLUMNS = [LABEL_COLUMN, GENOTYPE_COLUMN, TREATMENT_COLUMN]
 # -----------------------------
 # Column names in combined_df after fitting
 # -----------------------------
@@ -30,11 +36,63 @@ PIRK_TIMES="pirk_times"
 PIRK_AMPLITUDES= "pirk_amplitudes"
 STEADY_STATE_PIRK_TIME="steady_state_pirk_x"
 STEADY_STATE_PIRK_AMPLITUDE="steady_state_pirk_amplitude"
+STEADY_STATE_PIRK_BASELINE_SLOPE="steady_state_pirk_baseline_slope"
+STEADY_STATE_PIRK_BASELINE_INTERCEPT="steady_state_pirk_baseline_intercept"
 TIME_CONSTANTS="tau_values"
 MODEL_TIME="dirk_pirk_x"
 MODEL_PREDICTION="dirk_pirk_y"
 TIME_FITTED="trace_x"
 TRACE_FITTED="trace_y"
+FIT_COVARIANCE="dirk_pirk_fit_covariance"
+FIT_SUCCESS="dirk_pirk_fit_success"
+FIT_PLAN="dirk_pirk_fit_plan"  # model time axis and pirk points, see pirk.fitting.results
+
+# scalar summaries of a fit, stored as float columns (the curves they come from may not be stored)
+FIT_RMSE="dirk_pirk_fit_rmse"
+STEADY_STATE_GH="steady state gH+"
+RELAXED_GH="relaxed gH+"
+ECST="ECSt"
+
+# parameters a synthetic trace was generated with, see pirk.synthetic
+TRUE_FIT_PARAMS = "true_dirk_pirk_fit_params"
+
+# compact results: everything but the full-length curves, which can be rebuilt from them
+DIRK_PIRK_COMPACT_RESULT_COLUMNS = [
+    FIT_PARAMS,
+    FIT_COVARIANCE,
+    FIT_SUCCESS,
+    FIT_PLAN,
+    PIRK_TIMES,
+    PIRK_AMPLITUDES,
+    STEADY_STATE_PIRK_TIME,
+    STEADY_STATE_PIRK_AMPLITUDE
+]
+
+DIRK_PIRK_CURVE_COLUMNS = [
+    TIME_CONSTANTS,
+    MODEL_TIME,
+    MODEL_PREDICTION,
+    TIME_FITTED,
+    TRACE_FITTED
+]
+
+DIRK_PIRK_SUMMARY_COLUMNS = [
+    FIT_RMSE,
+    STEADY_STATE_GH,
+    RELAXED_GH,
+    ECST
+]
+
+DIRK_PIRK_RESULT_COLUMNS = DIRK_PIRK_COMPACT_RESULT_COLUMNS + DIRK_PIRK_SUMMARY_COLUMNS + DIRK_PIRK_CURVE_COLUMNS
+
+# further columns of the fit results table (pirk.fitting.results.fit_results_table)
+STEADY_STATE_PIRK="steady state pirk"
+RELAXED_PIRK="relaxed pirk"
+TOTAL_FIT_AMPLITUDE="total_fit_amplitude"
+STD_ERROR_SUFFIX="_std_error"
+CI_LOWER_SUFFIX="_ci_lower"
+CI_UPPER_SUFFIX="_ci_upper"
+TRACE_INDEX="trace_index"
 
 # -----------------------------
 # Parameters for fitting
@@ -50,6 +108,19 @@ PIRK_AMPLITUDE_RECOVERY_LIFETIME = "pirk_amplitude_recovery_lifetime"
 OFFSET_AMPLITUDE = "offset_amplitude"
 OFFSET_LIFETIME = "offset_lifetime"
 
+# order of the parameters of dirk_pirk and of the fitted values in FIT_PARAMS
+DIRK_PIRK_PARAMETERS = [
+    AMPLITUDE,
+    GH_START,
+    GH_END,
+    GH_LIFETIME,
+    PIRK_BEGIN_AMPLITUDE,
+    PIRK_END_AMPLITUDE,
+    PIRK_AMPLITUDE_RECOVERY_LIFETIME,
+    OFFSET_AMPLITUDE,
+    OFFSET_LIFETIME
+]
+
 # -----------------------------
 # Fluorescence Parameters for fitting
 # -----------------------------
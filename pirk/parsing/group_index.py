@@ -0,0 +1,155 @@
+# Index of the rows of combined_df by their metadata (trace label, genotype, treatment, replicate).
+# Built once per DataFrame, it returns the rows of any full or partial key with a dict lookup instead of a
+# boolean mask over all rows per key, and iterates over the groups of any subset of its columns.
+import weakref
+
+import numpy as np
+
+from pirk.names import *
+
+_group_indexes = {}
+
+
+def _same_values(cached, current):
+    """
+    Whether two .values of a column are the same data. numpy columns return a new view on every access, so
+    these are compared by their buffer; the cached view keeps the buffer alive, so its address is not reused.
+    """
+    if cached is current:
+        return True
+    if isinstance(cached, np.ndarray) and isinstance(current, np.ndarray):
+        return (cached.__array_interface__["data"][0] == current.__array_interface__["data"][0]
+                and cached.shape == current.shape and cached.strides == current.strides
+                and cached.dtype == current.dtype)
+    return False
+
+
+class GroupIndex:
+    """
+    Row positions of combined_df by the values of columns.
+
+    The lookup table of a set of columns (key -> row positions) is built with one groupby the first time the
+    set is queried; every later query of the same set is a dict lookup.
+
+    Parameters
+    ----------
+    combined_df : pd.DataFrame
+    columns : list of str, optional
+        Columns to index, default METADATA_COLUMNS.
+    """
+
+    def __init__(self, combined_df, columns=None):
+        self.columns = list(METADATA_COLUMNS if columns is None else columns)
+        missing = [col for col in self.columns if col not in combined_df.columns]
+        if missing:
+            raise KeyError(f"GroupIndex columns {missing} are not in the DataFrame")
+        self.index = combined_df.index
+        self.sources = tuple(combined_df[col].values for col in self.columns)
+        self._frame = combined_df[self.columns].reset_index(drop=True)
+        self._lookups = {}
+
+    def is_current(self, combined_df):
+        """
+        Whether combined_df still has the rows and indexed columns this index was built from. Changes of single
+        cells in place are not detected, see invalidate_group_index.
+        """
+        return combined_df.index is self.index and all(
+            _same_values(source, combined_df[col].values) for col, source in zip(self.columns, self.sources))
+
+    def __len__(self):
+        return len(self.index)
+
+    def _key_columns(self, columns):
+        unknown = [col for col in columns if col not in self.columns]
+        if unknown:
+            raise KeyError(f"{unknown} are not indexed, the index has {self.columns}")
+        return tuple(col for col in self.columns if col in columns)
+
+    def _lookup(self, columns):
+        """
+        key tuple (values of columns, in index column order) -> row positions, in order of first appearance.
+        """
+        lookup = self._lookups.get(columns)
+        if lookup is None:
+            grouped = self._frame.groupby(list(columns), sort=False, dropna=False).indices
+            lookup = {key if isinstance(key, tuple) else (key,): positions for key, positions in grouped.items()}
+            self._lookups[columns] = lookup
+        return lookup
+
+    def positions(self, key):
+        """
+        Row positions (0 based, ascending) of the rows matching key.
+
+        input: key, dict column -> value for any subset of the indexed columns ({} matches all rows)
+        output: np.ndarray of int
+        """
+        if not key:
+            return np.arange(len(self.index))
+        columns = self._key_columns(key)
+        positions = self._lookup(columns).get(tuple(key[col] for col in columns))
+        return np.empty(0, dtype=np.intp) if positions is None else positions
+
+    def indexes(self, key):
+        """
+        Index labels of combined_df of the rows matching key, see positions.
+        """
+        return self.index[self.positions(key)]
+
+    def values(self, column, key=None):
+        """
+        Distinct values of an indexed column (of the rows matching key), in order of first appearance.
+        """
+        columns = self._key_columns(list(key or {}) + [column])
+        position = columns.index(column)
+        selected = [columns.index(col) for col in (key or {})]
+        wanted = tuple(key[columns[i]] for i in selected)
+        values = {}
+        for group_key in self._lookup(columns):
+            if tuple(group_key[i] for i in selected) == wanted:
+                values.setdefault(group_key[position], None)
+        return list(values)
+
+    def groups(self, columns, key=None):
+        """
+        Iterate over the groups of columns (of the rows matching key), in order of first appearance.
+
+        Yields
+        ------
+        group_key : tuple
+            Values of columns, in the order given.
+        indexes : pd.Index
+            Index labels of the rows of the group.
+        """
+        key = key or {}
+        lookup_columns = self._key_columns(list(key) + list(columns))
+        order = [lookup_columns.index(col) for col in columns]
+        selected = [lookup_columns.index(col) for col in key]
+        wanted = tuple(key[lookup_columns[i]] for i in selected)
+        for group_key, positions in self._lookup(lookup_columns).items():
+            if tuple(group_key[i] for i in selected) == wanted:
+                yield tuple(group_key[i] for i in order), self.index[positions]
+
+
+def group_index(combined_df, columns=None):
+    """
+    The GroupIndex of combined_df, built on first use and dropped with the DataFrame.
+    It is rebuilt when rows are added or removed or an indexed column is replaced; after changing metadata
+    cells in place call invalidate_group_index.
+    """
+    columns = tuple(METADATA_COLUMNS if columns is None else columns)
+    indexes = _group_indexes.get(id(combined_df))
+    if indexes is None:
+        indexes = _group_indexes[id(combined_df)] = {}
+        weakref.finalize(combined_df, _group_indexes.pop, id(combined_df), None)
+
+    index = indexes.get(columns)
+    if index is None or not index.is_current(combined_df):
+        index = indexes[columns] = GroupIndex(combined_df, list(columns))
+    return index
+
+
+def invalidate_group_index(combined_df):
+    """
+    Drop the GroupIndex of combined_df, e.g. after changing a metadata column in place.
+    """
+    _group_indexes.get(id(combined_df), {}).clear()
@@ -1,5 +1,7 @@
 import bisect
 
+import numpy as np
+
 
 def find_closest_index(arr, target):
     """
@@ -27,6 +29,51 @@ def find_closest_index(arr, target):
         return pos - 1
 
 
+def find_closest_indices(arr, targets, lengths=None):
+    """
+    Vectorised find_closest_index: the index of the closest value for many targets at once, with the same
+    tie-breaking (the lower index wins a tie).
+
+    :param arr: Array of floats in ascending order, or 2-D array with one ascending axis per row
+    :param targets: Target value(s). For a 1-D arr any shape. For a 2-D arr a scalar (the same target for every
+        row), one target per row (n_rows,) or several targets per row (n_rows, n_targets)
+    :param lengths: Number of valid values of every row of a 2-D arr whose rows are padded, default all
+    :return: Index array of the shape of targets (n_rows for a scalar target and a 2-D arr)
+    """
+    arr = np.asarray(arr, dtype=float)
+    targets = np.asarray(targets, dtype=float)
+    if arr.ndim == 1:
+        if len(arr) == 0:
+            raise ValueError("find_closest_indices needs a non-empty array")
+        pos = np.searchsorted(arr, targets, side="left")
+        before = np.maximum(pos - 1, 0)
+        after = np.minimum(pos, len(arr) - 1)
+        return np.where(arr[after] - targets < targets - arr[before], after, before)
+
+    n_rows, width = arr.shape
+    lengths = np.full(n_rows, width) if lengths is None else np.asarray(lengths, dtype=int)
+    flat_targets = np.broadcast_to(targets, (n_rows,)) if targets.ndim == 0 else targets
+    row_targets = flat_targets.reshape(n_rows, -1)
+    rows = np.arange(n_rows)[:, None]
+    row_lengths = lengths[:, None]
+
+    # bisect_left of all targets at once, every target only compared with the values of its own row
+    low = np.zeros(row_targets.shape, dtype=int)
+    high = np.broadcast_to(row_lengths, row_targets.shape).copy()
+    for _ in range(max(width, 1).bit_length()):
+        active = low < high
+        middle = (low + high) // 2
+        right = active & (arr[rows, np.minimum(middle, width - 1)] < row_targets)
+        low = np.where(right, middle + 1, low)
+        high = np.where(active & ~right, middle, high)
+    pos = low
+
+    # at the ends before and after are the same index, as the first and last return of find_closest_index
+    before = np.maximum(pos - 1, 0)
+    after = np.minimum(pos, np.maximum(row_lengths - 1, 0))
+    closest = np.where(arr[rows, after] - row_targets < row_targets - arr[rows, before], after, before)
+    return closest.reshape(flat_targets.shape)
+
 
 def add_object_column(df, col_name, default_content=None, replace=False):
     """
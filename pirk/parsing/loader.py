@@ -2,13 +2,49 @@
 import ast
 import numpy as np
 
+from pirk.names import TRACE_COLUMN, TIME_COLUMN, PIRK_POINTS_COLUMN, DIRK_INDICES_COLUMN
+
+ARRAY_COLUMNS = [TRACE_COLUMN, TIME_COLUMN, PIRK_POINTS_COLUMN, DIRK_INDICES_COLUMN]
+INDEX_COLUMNS = [PIRK_POINTS_COLUMN, DIRK_INDICES_COLUMN]  # materialized as integer arrays
+
+
+def parse_numeric_list(text):
+    """
+    Parse a stringified flat list or tuple of numbers, e.g. "[0.1, 0.2, None]", without building an AST.
+    None entries are dropped, as in parse_array.
+
+    Raises ValueError if the text is not a flat list of numbers.
+    """
+    body = text.strip()
+    if body[:1] in "[(" and body[-1:] in "])":
+        body = body[1:-1]
+    if any(bracket in body for bracket in "[]()"):
+        raise ValueError(f"not a flat list: {text}")
+    if not body.strip():
+        return np.array([])
+    tokens = body.split(",")
+    if tokens[-1].strip() == "":  # trailing comma, e.g. "(400,)"
+        tokens = tokens[:-1]
+    if "None" in body:
+        tokens = [token for token in tokens if token.strip() != "None"]
+    if "." not in body and all(token.strip().lstrip("+-").isdigit() for token in tokens):
+        return np.array(tokens, dtype=np.int64)  # keep integer lists (indices) integer, as literal_eval does
+    return np.array(tokens, dtype=float)
+
+
 def parse_array(value):
     """
     Safely parse a value (possibly a stringified list) into a NumPy array.
+    Numeric arrays (e.g. from materialize_array_columns) are returned as they are.
     """
     try:
+        if isinstance(value, np.ndarray) and value.dtype != object:
+            return value
         if isinstance(value, str):
-            parsed = ast.literal_eval(value)
+            try:
+                return parse_numeric_list(value)
+            except ValueError:
+                parsed = ast.literal_eval(value)
         else:
             parsed = value
         return np.array([x for x in parsed if x is not None])
@@ -22,7 +58,10 @@ def parse_indices(value):
     """
     try:
         if isinstance(value, str):
-            b, e = ast.literal_eval(value)
+            try:
+                b, e = parse_numeric_list(value)
+            except ValueError:
+                b, e = ast.literal_eval(value)
         else:
             b, e = value
         return int(b), int(e)
@@ -31,6 +70,30 @@ def parse_indices(value):
         return 0, 0  # Fallback to 0,0 on failure
 
 
+def materialize_array_columns(combined_df, columns=None):
+    """
+    Convert the stringified or list cells of the array columns into NumPy arrays once, in place,
+    so downstream code does not parse text again. Float columns become float64 arrays, the index columns
+    (INDEX_COLUMNS) int64 arrays. None elements are dropped, missing cells (None or NaN) are left as they are.
+
+    input: combined_df, columns (default ARRAY_COLUMNS, columns missing from combined_df are skipped)
+    output: combined_df
+    """
+    columns = ARRAY_COLUMNS if columns is None else columns
+    for col in columns:
+        if col not in combined_df.columns:
+            continue
+        dtype = np.int64 if col in INDEX_COLUMNS else np.float64
+        values = []
+        for value in combined_df[col]:
+            if value is None or (isinstance(value, float) and np.isnan(value)):
+                values.append(value)
+            else:
+                values.append(parse_array(value).astype(dtype, copy=False))
+        combined_df[col] = values
+    return combined_df
+
+
 def extract_Fluro_paras(trace, indices,ramp_lights):
     # get trace and sort it from low to high
     Fs_trace = np.sort(trace[indices["fs_begin"]:indices["fs_end"]])[::-1]
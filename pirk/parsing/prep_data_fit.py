@@ -1,14 +1,16 @@
 # extract x and y values for fitting using baseline_begin_time and baseline_end_time obtained through visual inspection
+import weakref
+
 import numpy as np
 import pandas as pd
-from matplotlib import pyplot as plt
 
+from pirk.calculations.pirk import steady_state_pirk_from_trace, steady_state_pirk_batch
 from pirk.parsing.loader import parse_indices, parse_array
-from pirk.parsing.helpers import find_closest_index
+from pirk.parsing.helpers import find_closest_indices
 from pirk.names import *
 
 
-def prep_traces_for_fitting(combined_df, index):
+def prep_traces_for_fitting(combined_df, index, use_cache=True):
     """
     Prepare ECS traces for fitting by selecting the dirk period, baseline-correcting
     the signal, and identifying pirk points.
@@ -17,6 +19,8 @@ def prep_traces_for_fitting(combined_df, index):
         combined_df (pd.DataFrame): DataFrame containing time and signal traces,
                                     as well as metadata like 'pps' and 'pirk_indexes'.
         index (int): Index of the trace to process from the DataFrame.
+        use_cache (bool): Take the trace from the prepared trace cache of combined_df (see prepared_trace),
+                          so every trace is parsed and baseline-corrected once. The arrays are read-only.
 
     Returns:
         trace_x (np.ndarray): Time values for the trimmed and baseline-aligned trace.
@@ -27,24 +31,79 @@ def prep_traces_for_fitting(combined_df, index):
     Notes:
         - Baseline is computed as the mean value between `baseline_begin_time` and `baseline_end_time`.
         - If 'pps' (pre-pulse points) is empty, fallback is to use 'pirk_indexes' for stimulation points.
-        - Returned y-values are scaled by 1000.
+        - Returned y-values of ECS and P700 traces are scaled by 1000.
+    """
+
+    if use_cache:
+        prepared = prepared_trace(combined_df, index)
+    else:
+        prepared = _prepare_trace(combined_df, index)
+    return prepared.trace_x, prepared.trace_y, list(prepared.pirk_points), list(prepared.dirk_point_indexes)
+
+
+class PreparedTrace:
+    """
+    A trace of combined_df prepared for fitting: the dirk period, baseline-corrected and scaled.
+
+    Attributes
+    ----------
+    trace_x, trace_y : np.ndarray
+        Trimmed time (starting at 0) and baseline-corrected, scaled signal (read-only).
+    pirk_points : list of float
+        0 and the times of the pirk points in the dirk period.
+    dirk_point_indexes : list of int
+        Indexes of the pirk points in the trimmed trace.
+    baseline : float
+        Mean signal between BASELINE_BEGIN_TIME and BASELINE_END_TIME, subtracted from trace_y.
+    scale : float
+        Factor trace_y was scaled with (1000 for ECS and P700 traces).
+    raw_x, raw_y : np.ndarray
+        Parsed full trace.
+    dirk_begin : int
+        Index of the beginning of the dirk period in the full trace.
     """
 
+    def __init__(self, trace_x, trace_y, pirk_points, dirk_point_indexes, baseline, scale, raw_x, raw_y, dirk_begin):
+        trace_x.flags.writeable = False
+        trace_y.flags.writeable = False
+        self.trace_x = trace_x
+        self.trace_y = trace_y
+        self.pirk_points = pirk_points
+        self.dirk_point_indexes = dirk_point_indexes
+        self.baseline = baseline
+        self.scale = scale
+        self.raw_x = raw_x
+        self.raw_y = raw_y
+        self.dirk_begin = dirk_begin
+        self._steady_state_pirk = None
+
+    def steady_state_pirk(self):
+        """
+        Steady state PIRK time and amplitude (unscaled, see find_steady_state_pirk_amplitudes), computed once.
+        """
+        if self._steady_state_pirk is None:
+            self._steady_state_pirk = steady_state_pirk_from_trace(self.raw_x, self.raw_y, self.dirk_begin)
+        return self._steady_state_pirk
+
+
+def _prepare_trace(combined_df, index):
     b, e = parse_indices(combined_df[DIRK_INDICES_COLUMN][index])
-    trace_y = parse_array(combined_df[TRACE_COLUMN][index])[b:e]
-    trace_x =  parse_array(combined_df[TIME_COLUMN][index])[b:e]
+    raw_y = parse_array(combined_df[TRACE_COLUMN][index])
+    raw_x = parse_array(combined_df[TIME_COLUMN][index])
+    trace_y = raw_y[b:e]
+    trace_x = raw_x[b:e]
     trace_x = trace_x - trace_x[0]  # np.min(trace_x)
 
     # must be a better way of finding the baseline!
-    bb = find_closest_index(trace_x, BASELINE_BEGIN_TIME)
-    be = find_closest_index(trace_x, BASELINE_END_TIME)
+    bb, be = find_closest_indices(trace_x, [BASELINE_BEGIN_TIME, BASELINE_END_TIME])
 
     baseline = np.mean(trace_y[bb:be])
 
     trace_y = trace_y - baseline  # calc_min #baseline #calc_min #baseline
 
     #  ECS and P700 PIRK need scaling for robust fitting
-    trace_y = trace_y*1000 if combined_df.at[index,LABEL_COLUMN] in [LABEL_ECS,LABEL_P700] else trace_y
+    scale = 1000 if combined_df.at[index,LABEL_COLUMN] in [LABEL_ECS,LABEL_P700] else 1
+    trace_y = trace_y*scale
 
     # trace_y = trace_y/np.max(trace_y)
     # If pre pulses were not used, dirk_point_indexes = [], pirk_points are then calculated from light intensities
@@ -60,6 +119,214 @@ def prep_traces_for_fitting(combined_df, index):
     # plt.plot(pirk_points,trace_y_peak,'o',color='red',label='prik points')
     # plt.xlabel('TIme (s)')
     # plt.show()
-    return trace_x, trace_y, pirk_points, dirk_point_indexes
+    dirk_begin = int(np.min(parse_array(combined_df[DIRK_INDICES_COLUMN][index])))
+    return PreparedTrace(trace_x, trace_y, pirk_points, dirk_point_indexes, baseline, scale, raw_x, raw_y, dirk_begin)
+
+
+# Prepared traces are cached per DataFrame (by identity). An entry is recomputed when one of the source cells of
+# its row is replaced; cells changed in place need invalidate_prepared_traces.
+PREPARED_TRACE_SOURCE_COLUMNS = [TRACE_COLUMN, TIME_COLUMN, DIRK_INDICES_COLUMN, PIRK_POINTS_COLUMN, LABEL_COLUMN]
+_prepared_trace_caches = {}
+
+
+def _same_cell(cached, current):
+    if cached is current:
+        return True
+    if isinstance(cached, (np.ndarray, list, tuple)) or isinstance(current, (np.ndarray, list, tuple)):
+        return False
+    return cached == current  # strings and scalars, which pandas may box anew on every access
+
+
+class PreparedTraceCache:
+    """
+    Prepared traces of one DataFrame by index, with hit/miss counts.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, combined_df, index):
+        sources = tuple(combined_df.at[index, col] for col in PREPARED_TRACE_SOURCE_COLUMNS)
+        entry = self._entries.get(index)
+        if entry is not None and all(_same_cell(a, b) for a, b in zip(entry[0], sources)):
+            self.hits += 1
+            return entry[1]
+
+        self.misses += 1
+        prepared = _prepare_trace(combined_df, index)
+        self._entries[index] = (sources, prepared)
+        return prepared
+
+    def invalidate(self, indexes=None):
+        if indexes is None:
+            self._entries.clear()
+        else:
+            for index in indexes:
+                self._entries.pop(index, None)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+def prepared_trace_cache(combined_df):
+    """
+    The prepared trace cache of combined_df, created on first use and dropped with the DataFrame.
+    """
+    key = id(combined_df)
+    cache = _prepared_trace_caches.get(key)
+    if cache is None:
+        cache = _prepared_trace_caches[key] = PreparedTraceCache()
+        weakref.finalize(combined_df, _prepared_trace_caches.pop, key, None)
+    return cache
+
+
+def prepared_trace(combined_df, index):
+    """
+    PreparedTrace of a row of combined_df, computed once per DataFrame and row.
+    """
+    return prepared_trace_cache(combined_df).get(combined_df, index)
+
+
+def invalidate_prepared_traces(combined_df, indexes=None):
+    """
+    Drop the cached prepared traces of the given indexes (default all) of combined_df,
+    e.g. after changing a trace array in place.
+    """
+    prepared_trace_cache(combined_df).invalidate(indexes)
+
+
+def precompute_steady_state_pirk(combined_df, indexes, number_baseline_points=10):
+    """
+    Compute the steady state PIRK of the prepared traces of the given indexes in one steady_state_pirk_batch call,
+    so that PreparedTrace.steady_state_pirk does not fit the baselines one trace at a time during the fits.
+    """
+    pending = [prepared for prepared in (prepared_trace(combined_df, index) for index in indexes)
+               if prepared._steady_state_pirk is None]
+    if not pending:
+        return
+    windows = [slice(prepared.dirk_begin - number_baseline_points, prepared.dirk_begin) for prepared in pending]
+    x, amplitude, slope, _ = steady_state_pirk_batch(
+        np.stack([prepared.raw_x[window] for prepared, window in zip(pending, windows)]),
+        np.stack([prepared.raw_y[window] for prepared, window in zip(pending, windows)]))
+    for prepared, steady_state_pirk in zip(pending, zip(x, amplitude)):
+        prepared._steady_state_pirk = steady_state_pirk
+    n_negative = int(np.sum(slope < 0))
+    if n_negative:
+        print(f"{n_negative} of {len(pending)} traces with a negative pre-dirk baseline slope")
+
+
+class PreparedTraceBatch:
+    """
+    Traces of many rows prepared for fitting together, as prep_traces_for_fitting prepares a single row.
+    Rows of different length are padded with NaN.
+
+    Attributes
+    ----------
+    indexes : np.ndarray
+        Row indexes in combined_df, one per row of the arrays.
+    trace_x, trace_y : np.ndarray
+        (n_traces, max_length) trimmed time and baseline-corrected, scaled signal.
+    lengths : np.ndarray
+        Number of valid points of every trace.
+    mask : np.ndarray
+        (n_traces, max_length) True for the valid points.
+    baseline, scale : np.ndarray
+        Baseline subtracted from and factor applied to every trace.
+    pirk_points : np.ndarray
+        (n_traces, max_pirk_points) pirk point times starting with 0, NaN-padded.
+    dirk_point_indexes : np.ndarray
+        (n_traces, max_pirk_points - 1) indexes of the pirk points in the trimmed traces, padded with -1.
+    n_pirk_points : np.ndarray
+        Number of valid entries of every row of pirk_points (one more than of dirk_point_indexes).
+    """
+
+    def __init__(self, indexes, trace_x, trace_y, lengths, baseline, scale, pirk_points, dirk_point_indexes,
+                 n_pirk_points):
+        self.indexes = indexes
+        self.trace_x = trace_x
+        self.trace_y = trace_y
+        self.lengths = lengths
+        self.mask = np.arange(trace_x.shape[1]) < lengths[:, None]
+        self.baseline = baseline
+        self.scale = scale
+        self.pirk_points = pirk_points
+        self.dirk_point_indexes = dirk_point_indexes
+        self.n_pirk_points = n_pirk_points
+
+    def __len__(self):
+        return len(self.indexes)
+
+    def trace(self, position):
+        """
+        Row position of the batch as returned by prep_traces_for_fitting:
+        trace_x, trace_y, pirk_points, dirk_point_indexes.
+        """
+        length = self.lengths[position]
+        n_pirk = self.n_pirk_points[position]
+        return (self.trace_x[position, :length], self.trace_y[position, :length],
+                self.pirk_points[position, :n_pirk].tolist(),
+                self.dirk_point_indexes[position, :n_pirk - 1].tolist())
+
+
+def _pad(arrays, fill, dtype):
+    lengths = np.array([len(array) for array in arrays], dtype=int)
+    padded = np.full((len(arrays), lengths.max(initial=0)), fill, dtype=dtype)
+    for row, array in enumerate(arrays):
+        padded[row, :len(array)] = array
+    return padded, lengths
+
+
+def prep_traces_batch(combined_df, indexes=None, trace_label=None):
+    """
+    Prepare many traces for fitting at once, see prep_traces_for_fitting: select the dirk period, subtract the
+    mean between BASELINE_BEGIN_TIME and BASELINE_END_TIME, scale ECS and P700 traces by 1000 and find the pirk
+    points. The baseline windows (find_closest_indices), baselines and pirk points are computed for all traces
+    together.
+
+    input: combined_df, indexes (default all rows), trace_label (only rows with this label)
+    output: PreparedTraceBatch
+    """
+    indexes = combined_df.index if indexes is None else pd.Index(indexes)
+    if trace_label is not None:
+        indexes = indexes[(combined_df.loc[indexes, LABEL_COLUMN] == trace_label).values]
+
+    rows = combined_df.loc[indexes]
+    dirk_indices = np.array([parse_indices(cell) for cell in rows[DIRK_INDICES_COLUMN].values],
+                            dtype=int).reshape(-1, 2)
+    b, e = dirk_indices[:, 0], dirk_indices[:, 1]
+    trace_y, lengths = _pad([parse_array(cell)[begin:end]
+                             for cell, begin, end in zip(rows[TRACE_COLUMN].values, b, e)], np.nan, float)
+    trace_x, _ = _pad([parse_array(cell)[begin:end]
+                       for cell, begin, end in zip(rows[TIME_COLUMN].values, b, e)], np.nan, float)
+    if len(indexes) == 0:
+        return PreparedTraceBatch(np.asarray(indexes), trace_x, trace_y, lengths, np.empty(0), np.empty(0),
+                                  np.empty((0, 1)), np.empty((0, 0), dtype=int), np.empty(0, dtype=int))
+    trace_x = trace_x - trace_x[:, :1]
+
+    # baseline: mean between the points closest to BASELINE_BEGIN_TIME and BASELINE_END_TIME
+    bb, be = find_closest_indices(trace_x, [[BASELINE_BEGIN_TIME, BASELINE_END_TIME]] * len(indexes), lengths).T
+    cumulative = np.zeros((len(indexes), trace_y.shape[1] + 1))
+    np.cumsum(np.nan_to_num(trace_y), axis=1, out=cumulative[:, 1:])
+    positions = np.arange(len(indexes))
+    with np.errstate(invalid="ignore", divide="ignore"):
+        baseline = (cumulative[positions, be] - cumulative[positions, bb]) / (be - bb)
+    baseline[be <= bb] = np.nan  # empty window, as np.mean of an empty slice
+
+    labels = rows[LABEL_COLUMN].values
+    scale = np.where(np.isin(labels, [LABEL_ECS, LABEL_P700]), 1000.0, 1.0)
+    trace_y = (trace_y - baseline[:, None]) * scale[:, None]
 
+    # pirk points inside the dirk period, in their original order
+    pps, n_pps = _pad([parse_array(cell) for cell in rows[PIRK_POINTS_COLUMN].values], -1, int)
+    valid = (np.arange(pps.shape[1]) < n_pps[:, None]) & (pps >= b[:, None]) & (pps < e[:, None])
+    order = np.argsort(~valid, axis=1, kind="stable")
+    n_valid = valid.sum(axis=1)
+    dirk_point_indexes = np.take_along_axis(pps - b[:, None], order, axis=1)
+    dirk_point_indexes[np.arange(pps.shape[1]) >= n_valid[:, None]] = -1
+    pirk_times = np.take_along_axis(trace_x, np.clip(dirk_point_indexes, 0, None), axis=1)
+    pirk_points = np.column_stack([np.zeros(len(indexes)), np.where(dirk_point_indexes >= 0, pirk_times, np.nan)])
 
+    return PreparedTraceBatch(np.asarray(indexes), trace_x, trace_y, lengths, baseline, scale, pirk_points,
+                              dirk_point_indexes, n_valid + 1)
@@ -0,0 +1,171 @@
+# Columnar on-disk store of a combined_df. Every ragged array column (one trace per row) is kept as one
+# contiguous buffer with an offsets array and is memory-mapped when loaded, so opening a screen does not read
+# the traces and only the pages of the rows that are actually used are loaded.
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from pirk.parsing.loader import parse_array, ARRAY_COLUMNS, INDEX_COLUMNS
+
+TRACE_STORE_VERSION = 1
+MANIFEST_FILE = "manifest.json"
+FRAME_FILE = "frame.pkl"
+
+
+class RaggedColumn:
+    """
+    Ragged column: row i is values[offsets[i]:offsets[i + 1]], or None if missing[i].
+    Rows are returned as views of values, without copying.
+
+    Parameters
+    ----------
+    values : np.ndarray
+        All rows concatenated (may be a read-only memmap).
+    offsets : np.ndarray
+        n_rows + 1 start offsets into values.
+    missing : np.ndarray
+        Boolean mask of the rows that were None.
+    """
+
+    def __init__(self, values, offsets, missing):
+        self.values = values
+        self.offsets = offsets
+        self.missing = missing
+
+    @classmethod
+    def from_cells(cls, cells, dtype=np.float64):
+        """
+        Build a ragged column from DataFrame cells (arrays, lists or stringified lists; None or NaN for missing).
+        """
+        arrays = []
+        missing = np.zeros(len(cells), dtype=bool)
+        for position, cell in enumerate(cells):
+            if cell is None or (isinstance(cell, float) and np.isnan(cell)):
+                missing[position] = True
+                arrays.append(np.empty(0, dtype=dtype))
+            else:
+                arrays.append(np.asarray(parse_array(cell), dtype=dtype))
+
+        offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+        np.cumsum([len(array) for array in arrays], out=offsets[1:])
+        values = np.concatenate(arrays) if arrays else np.empty(0, dtype=dtype)
+        return cls(values, offsets, missing)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, position):
+        if self.missing[position]:
+            return None
+        return self.values[self.offsets[position]:self.offsets[position + 1]]
+
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def cells(self):
+        """
+        One view per row in an object array, to put in a DataFrame column.
+        """
+        cells = np.empty(len(self), dtype=object)
+        for position in range(len(self)):
+            cells[position] = self[position]
+        return cells
+
+
+def _column_files(path, col):
+    return {part: os.path.join(path, f"{col}.{part}.npy") for part in ("values", "offsets", "missing")}
+
+
+def save_trace_store(combined_df, path, columns=None, overwrite=True):
+    """
+    Save combined_df as a trace store directory.
+
+    Parameters
+    ----------
+    combined_df : pd.DataFrame
+        DataFrame to save.
+    path : str
+        Store directory.
+    columns : list of str, optional
+        Ragged array columns, default ARRAY_COLUMNS (those missing from combined_df are skipped).
+        Index columns (INDEX_COLUMNS) are stored as int64, the others as float64.
+        All other columns are pickled together in frame.pkl.
+    overwrite : bool, optional
+        Whether to replace an existing store.
+
+    Returns
+    -------
+    path : str
+    """
+    columns = [col for col in (ARRAY_COLUMNS if columns is None else columns) if col in combined_df.columns]
+    if os.path.exists(path):
+        if not overwrite:
+            raise FileExistsError(f"Trace store {path} already exists. Set overwrite=True to replace it.")
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+    dtypes = {}
+    for col in columns:
+        dtype = np.int64 if col in INDEX_COLUMNS else np.float64
+        ragged = RaggedColumn.from_cells(combined_df[col].tolist(), dtype=dtype)
+        files = _column_files(path, col)
+        np.save(files["values"], ragged.values)
+        np.save(files["offsets"], ragged.offsets)
+        np.save(files["missing"], ragged.missing)
+        dtypes[col] = np.dtype(dtype).name
+
+    combined_df.drop(columns=columns).to_pickle(os.path.join(path, FRAME_FILE))
+    manifest = {"version": TRACE_STORE_VERSION, "n_rows": len(combined_df), "columns": dtypes,
+                "column_order": list(combined_df.columns)}
+    with open(os.path.join(path, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+
+    print(f"Trace store saved to {path}")
+    return path
+
+
+def open_trace_columns(path, mmap=True):
+    """
+    Ragged columns of a trace store, memory-mapped read-only unless mmap=False.
+
+    Returns
+    -------
+    columns : dict
+        column name -> RaggedColumn
+    """
+    with open(os.path.join(path, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    if manifest["version"] != TRACE_STORE_VERSION:
+        raise ValueError(f"Trace store {path} has version {manifest['version']}, expected {TRACE_STORE_VERSION}")
+
+    columns = {}
+    for col in manifest["columns"]:
+        files = _column_files(path, col)
+        offsets = np.load(files["offsets"])
+        values = np.load(files["values"], mmap_mode="r" if mmap and offsets[-1] > 0 else None)
+        values = np.asarray(values)  # plain ndarray view of the mapping, its row slices are cheaper than memmaps
+        columns[col] = RaggedColumn(values, offsets, np.load(files["missing"]))
+    return columns
+
+
+def load_trace_store(path, mmap=True):
+    """
+    Load a trace store as a combined_df. The cells of the ragged array columns are read-only views of the
+    memory-mapped buffers, so they can be used by prep_traces_for_fitting and the calculation modules as is.
+
+    input: store directory, mmap (False reads the buffers into memory)
+    output: combined_df
+    """
+    with open(os.path.join(path, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    combined_df = pd.read_pickle(os.path.join(path, FRAME_FILE))
+
+    for col, ragged in open_trace_columns(path, mmap=mmap).items():
+        combined_df[col] = pd.Series(ragged.cells(), index=combined_df.index, dtype=object)
+    combined_df = combined_df[manifest["column_order"]]
+
+    print(f"Loaded trace store with {len(combined_df)} rows and {len(combined_df.columns)} columns")
+    return combined_df
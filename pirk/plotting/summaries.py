@@ -3,9 +3,15 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 
 from pirk.fitting.fitters import prep_traces_for_fitting
+from pirk.fitting.results import fit_curves, fit_results_table
 from pirk.names import *
 
 from pirk.parsing.helpers import add_object_column
+from pirk.parsing.group_index import group_index
+
+# the summary plots select their rows by these columns, see group_index
+SUMMARY_GROUP_COLUMNS = [LABEL_COLUMN, GENOTYPE_COLUMN, TREATMENT_COLUMN]
+
 
 def plot_corr_matrix(pcov, labels):
     lower_triangle = np.tril(pcov)
@@ -59,105 +65,166 @@ def plot_MPF_noMPF(fluro_values):
         ax.legend()
 
 
-# Function to set the global limits for all axes in a list of figures
-def set_global_limits(figures):
-    i = 0
-    for ax in figures[i].get_axes():
-        x_min, x_max = float('inf'), float('-inf')
-        y_min, y_max = float('inf'), float('-inf')
-    for i in range(0, len(figures)):
-
-        for fig in figures:
-            x_min_ax, x_max_ax = ax.get_xlim()
-            y_min_ax, y_max_ax = ax.get_ylim()
-            x_min = min(x_min, x_min_ax)
-            x_max = max(x_max, x_max_ax)
-            y_min = min(y_min, y_min_ax)
-            y_max = max(y_max, y_max_ax)
+def dirk_pirk_plot_data(combined_df, index):
+    """
+    Everything draw_dirk_pirk_fit needs of one fitted trace, as plain arrays (no DataFrame), so it can be
+    sent to a worker process.
+    """
+    curves = fit_curves(combined_df, index)
+    return {
+        TIME_FITTED: curves[TIME_FITTED],
+        TRACE_FITTED: curves[TRACE_FITTED],
+        MODEL_TIME: curves[MODEL_TIME],
+        MODEL_PREDICTION: curves[MODEL_PREDICTION],
+        TIME_CONSTANTS: curves[TIME_CONSTANTS],
+        PIRK_TIMES: combined_df[PIRK_TIMES][index],
+        PIRK_AMPLITUDES: combined_df[PIRK_AMPLITUDES][index]
+    }
 
-        # for fig in figures:
-        #     for ax in fig.get_axes():
-        ax.set_xlim(x_min, x_max)
-        ax.set_ylim(y_min, y_max)
 
+# axes of a fit figure -> the plot data shown on them
+DIRK_PIRK_PLOT_AXES = {
+    "x": [TIME_FITTED, MODEL_TIME, PIRK_TIMES],
+    "signal": [TRACE_FITTED, MODEL_PREDICTION],
+    "gH": [TIME_CONSTANTS],
+    "pirk": [PIRK_AMPLITUDES]
+}
+
+
+def dirk_pirk_plot_limits(plot_data, margin=0.05):
+    """
+    Common axis limits of fit figures, computed in one pass over the plotted data.
+
+    input: plot_data, iterable of dirk_pirk_plot_data dicts; margin, fraction of the range added on both sides
+    output: dict axis name (see DIRK_PIRK_PLOT_AXES) -> (min, max), None if there is no finite data
+    """
+    low = dict.fromkeys(DIRK_PIRK_PLOT_AXES, np.inf)
+    high = dict.fromkeys(DIRK_PIRK_PLOT_AXES, -np.inf)
+    for data in plot_data:
+        for axis, keys in DIRK_PIRK_PLOT_AXES.items():
+            for key in keys:
+                values = np.asarray(data[key], dtype=float)
+                values = values[np.isfinite(values)]
+                if values.size:
+                    low[axis] = min(low[axis], values.min())
+                    high[axis] = max(high[axis], values.max())
+
+    limits = {}
+    for axis in DIRK_PIRK_PLOT_AXES:
+        if np.isfinite(low[axis]):
+            pad = margin * (high[axis] - low[axis]) or margin * max(abs(low[axis]), 1.0)
+            limits[axis] = (low[axis] - pad, high[axis] + pad)
+        else:
+            limits[axis] = None
+    return limits
+
+
+def set_dirk_pirk_limits(limits, ax1, ax2, ax3):
+    """
+    Apply the axis limits of dirk_pirk_plot_limits to the axes of dirk_pirk_axes, None leaves an axis as it is.
+    """
+    for axis, set_limits in (("x", ax1.set_xlim), ("signal", ax1.set_ylim), ("gH", ax2.set_ylim),
+                             ("pirk", ax3.set_ylim)):
+        if limits[axis] is not None:
+            set_limits(*limits[axis])
+
+
+def dirk_pirk_axes(fig, trace_label, title):
+    """
+    The three axes of a fit figure: signal (left), gH+ (right) and relative pirk amplitudes (right, offset).
+    """
+    ax1 = fig.subplots()
+    ax1.set_xlabel('time (s)')
+    ax1.set_ylabel('Signal (a.u.)', color='g')
+    ax1.tick_params(axis='y', labelcolor='g')
+
+    ax2 = ax1.twinx()
+
+    if trace_label == LABEL_ECS:
+        label = ECS_Y_LABEL
+    elif trace_label == LABEL_P700:
+        label = P700_Y_LABEL
+    else:
+        label = FLURO_Y_LABEL
+
+    ax2.set_ylabel(label, color='b')
+    ax2.tick_params(axis='y', labelcolor='b')
+
+    ax3 = ax1.twinx()
+    ax3.set_frame_on(True)
+    ax3.spines['right'].set_position(('outward', 60))
+    ax3.set_ylabel('Relative pirk amplitudes (a.u.)', color='r')
+    ax3.tick_params(axis='y', labelcolor='r')
+    fig.suptitle(title)
+    return ax1, ax2, ax3
 
-def _plot_dirk_pirk_fits(combined_df, index, ax1, ax2, ax3):
-    trace_x, trace_y, pirk_points, dirk_point_indexes = prep_traces_for_fitting(combined_df, index)
 
-    dirk_pirk_x = combined_df[MODEL_TIME][index]
-    dirk_pirk_y = combined_df[MODEL_PREDICTION][index]
-    ax1.plot(dirk_pirk_x, dirk_pirk_y, 'g-', label=MODEL_TIME)
+def draw_dirk_pirk_fit(data, ax1, ax2, ax3):
+    """
+    Draw one fitted trace (a dirk_pirk_plot_data dict) on the axes of dirk_pirk_axes.
+    """
+    dirk_pirk_x = data[MODEL_TIME]
+    ax1.plot(dirk_pirk_x, data[MODEL_PREDICTION], 'g-', label=MODEL_TIME)
 
-    ax1.plot(trace_x, trace_y, color='gray', alpha=0.5)
+    ax1.plot(data[TIME_FITTED], data[TRACE_FITTED], color='gray', alpha=0.5)
 
     # Plot gH_values versus dirk_pirk_x on the right y-axis
+    ax2.plot(dirk_pirk_x, data[TIME_CONSTANTS], 'b-', label=TIME_CONSTANTS)
 
-    gH_values = combined_df[TIME_CONSTANTS][index]
-
-    ax2.plot(dirk_pirk_x, gH_values, 'b-', label=TIME_CONSTANTS)
-
-    # Offset the third y-axis
-    ax3.spines['right'].set_position(('outward', 60))
-    pirk_times = combined_df[PIRK_TIMES][index]
-    relative_pirk_amplitudes = combined_df[PIRK_AMPLITUDES][index]
+    pirk_times = data[PIRK_TIMES]
+    relative_pirk_amplitudes = data[PIRK_AMPLITUDES]
 
     if len(pirk_times) > 0 and len(relative_pirk_amplitudes) > 0:
         ax3.plot(pirk_times, relative_pirk_amplitudes, label=PIRK_AMPLITUDES, color='r', marker='o')
 
 
+def _plot_dirk_pirk_fits(combined_df, index, ax1, ax2, ax3):
+    draw_dirk_pirk_fit(dirk_pirk_plot_data(combined_df, index), ax1, ax2, ax3)
+
+
+def dirk_pirk_fit_conditions(combined_df, trace_label):
+    """
+    The traces of trace_label by condition (genotype and light intensity), as used by the fit figures.
+
+    Returns
+    -------
+    conditions : dict
+        (genotype, light intensity) -> index labels of the rows, in order of first appearance.
+    """
+    rows = group_index(combined_df, SUMMARY_GROUP_COLUMNS)
+    return dict(rows.groups([GENOTYPE_COLUMN, TREATMENT_COLUMN], {LABEL_COLUMN: trace_label}))
+
+
 def plot_all_dirk_pirk_fits(combined_df,trace_label):
+    """
+    One figure per genotype and light intensity with the fits of all its trace_label traces, on common axis
+    limits. Shown interactively per genotype; see pirk.plotting.batch.render_dirk_pirk_fits to write the
+    figures to files instead.
+    """
     # List of genotypes to plot
     genotypes = combined_df[GENOTYPE_COLUMN].unique()
 
     # Unique light intensities across the dataset
     light_intensities = combined_df[TREATMENT_COLUMN].unique()
 
-    figures = []
+    conditions = dirk_pirk_fit_conditions(combined_df, trace_label)
+    plot_data = {condition: [dirk_pirk_plot_data(combined_df, index) for index in indexes]
+                 for condition, indexes in conditions.items()}
+    limits = dirk_pirk_plot_limits(data for condition_data in plot_data.values() for data in condition_data)
 
     # Loop over each genotype and light intensity
     for genotype in genotypes:
         for li in light_intensities:
 
-            fig, ax1 = plt.subplots()
-
-            ax1.set_xlabel('time (s)')
-            ax1.set_ylabel('Signal (a.u.)', color='g')
-            ax1.tick_params(axis='y', labelcolor='g')
-
-            ax2 = ax1.twinx()
-
-            if trace_label == LABEL_ECS:
-                label = ECS_Y_LABEL
-            elif trace_label == LABEL_P700:
-                label = P700_Y_LABEL
-            else:
-                label = FLURO_Y_LABEL
-
-            ax2.set_ylabel(label, color='b')
-            ax2.tick_params(axis='y', labelcolor='b')
-
-            ax3 = ax1.twinx()
-            ax3.set_frame_on(True)
-            ax3.spines['right'].set_position(('outward', 60))
-            ax3.set_ylabel('Relative pirk amplitudes (a.u.)', color='r')
-            ax3.tick_params(axis='y', labelcolor='r')
-            plt.suptitle(f"{genotype}, {TREATMENT_NAME}: {li}")
+            fig = plt.figure()
+            ax1, ax2, ax3 = dirk_pirk_axes(fig, trace_label, f"{genotype}, {TREATMENT_NAME}: {li}")
 
-            # Filter by genotype AND light intensity
-            indexes = combined_df[
-                (combined_df[LABEL_COLUMN] == trace_label) &
-                (combined_df[GENOTYPE_COLUMN] == genotype) &
-                (combined_df[TREATMENT_COLUMN] == li)
-                ].index
-
-            for index in indexes:
-                _plot_dirk_pirk_fits(combined_df, index, ax1, ax2, ax3)
+            for data in plot_data.get((genotype, li), []):
+                draw_dirk_pirk_fit(data, ax1, ax2, ax3)
+            set_dirk_pirk_limits(limits, ax1, ax2, ax3)
 
             plt.tight_layout()
 
-            figures.append(fig)
-
-        set_global_limits(figures)
         plt.show()
 
 
@@ -165,9 +232,12 @@ def plot_all_dirk_pirk_fits(combined_df,trace_label):
 def extract_scaler_values_from_array(combined_df, col_name, from_col_name, protocol_label, value_index):
     """Extract a scalar from an array in a DataFrame column and store it in a new column."""
     add_object_column(combined_df, col_name)
-    indexes = combined_df[combined_df[LABEL_COLUMN] == protocol_label].index
+    indexes = group_index(combined_df, SUMMARY_GROUP_COLUMNS).indexes({LABEL_COLUMN: protocol_label})
     for index in indexes:
-        arr = combined_df[from_col_name][index]
+        if from_col_name in DIRK_PIRK_CURVE_COLUMNS:
+            arr = fit_curves(combined_df, index)[from_col_name]  # compact fits do not store the curves
+        else:
+            arr = combined_df[from_col_name][index]
         if arr is not None and len(arr) > 0:
             try:
                 combined_df.at[index, col_name] = arr[value_index]
@@ -179,43 +249,36 @@ def extract_scaler_values_from_array(combined_df, col_name, from_col_name, proto
 
 
 def plot_extracted_params(combined_df,trace_labels):
-    # === Define all parameters to extract ===
+    # === Extract all parameters from the fit results table ===
+    # plotted name -> column of fit_results_table
     extracted_parameters = {
-        'steady state gH+': [TIME_CONSTANTS, trace_labels, 0],
-        'relaxed gH+': [TIME_CONSTANTS, trace_labels, -1],
-        'steady state pirk': [PIRK_AMPLITUDES, trace_labels, 0],
-        'relaxed pirk': [PIRK_AMPLITUDES, trace_labels, -1],
-        'ECSt': ['dirk_pirk_y', trace_labels, 0],
-        'signal_amplitude': [FIT_PARAMS, trace_labels, 0],
-        'gH_start': [FIT_PARAMS, trace_labels, 1],
-        'gH_end': [FIT_PARAMS, trace_labels, 2],
-        'gH_lifetime': [FIT_PARAMS, trace_labels, 3],
-        'pirk_begin_amplitude': [FIT_PARAMS, trace_labels, 4],
-        'pirk_end_amplitude': [FIT_PARAMS, trace_labels, 5],
-        'pirk_amplitude_recovery_lifetime': [FIT_PARAMS, trace_labels, 6],
-        'slow_phase_amplitude': [FIT_PARAMS, trace_labels, 7],
-        'slow_phase_lifetime': [FIT_PARAMS, trace_labels, 8],
+        STEADY_STATE_GH: STEADY_STATE_GH,
+        RELAXED_GH: RELAXED_GH,
+        STEADY_STATE_PIRK: STEADY_STATE_PIRK,
+        RELAXED_PIRK: RELAXED_PIRK,
+        ECST: ECST,
+        'signal_amplitude': AMPLITUDE,
+        'gH_start': GH_START,
+        'gH_end': GH_END,
+        'gH_lifetime': GH_LIFETIME,
+        'pirk_begin_amplitude': PIRK_BEGIN_AMPLITUDE,
+        'pirk_end_amplitude': PIRK_END_AMPLITUDE,
+        'pirk_amplitude_recovery_lifetime': PIRK_AMPLITUDE_RECOVERY_LIFETIME,
+        'slow_phase_amplitude': OFFSET_AMPLITUDE,
+        'slow_phase_lifetime': OFFSET_LIFETIME,
+        TOTAL_FIT_AMPLITUDE: TOTAL_FIT_AMPLITUDE,
     }
 
     genotypes = combined_df[GENOTYPE_COLUMN].unique()
 
+    rows = group_index(combined_df, SUMMARY_GROUP_COLUMNS)
+    table = fit_results_table(combined_df, rows.indexes({LABEL_COLUMN: trace_labels}))
     parameter_plots = {}
-
-    # === Extract all parameters ===
-    for param, (from_col_name, protocol_label, value_index) in extracted_parameters.items():
-        extract_scaler_values_from_array(combined_df, param, from_col_name, protocol_label, value_index)
-        parameter_plots[param] = [param,GENOTYPE_COLUMN, protocol_label]
-
-    # === Add derived parameter ===
-    add_object_column(combined_df, 'total_fit_amplitude')
-    indexes = combined_df[combined_df['trace_label'] == trace_labels].index
-    for index in indexes:
-        combined_df.at[index, 'total_fit_amplitude'] = (
-            np.array(combined_df['signal_amplitude'][index]) +
-            np.array(combined_df['slow_phase_amplitude'][index])
-        )
-
-    parameter_plots['total_fit_amplitude'] = ['total_fit_amplitude', 'genotype', trace_labels]
+    for param, table_col in extracted_parameters.items():
+        if param not in combined_df.columns:
+            combined_df[param] = np.nan
+        combined_df.loc[table[TRACE_INDEX].values, param] = table[table_col].values
+        parameter_plots[param] = [param, GENOTYPE_COLUMN, trace_labels]
 
     # === Plot parameters ===
     unique_treatments = combined_df[TREATMENT_COLUMN].unique()
@@ -235,11 +298,8 @@ def plot_extracted_params(combined_df,trace_labels):
         # loop over light intensities and genotypes
         for li in combined_df[TREATMENT_COLUMN].unique():
             for genotype in genotypes:  # your 52 genotypes
-                indexes = combined_df[
-                    (combined_df[LABEL_COLUMN] == protocol_label) &
-                    (combined_df[GENOTYPE_COLUMN] == genotype) &
-                    (combined_df[TREATMENT_COLUMN] == li)
-                ].index
+                indexes = rows.indexes({LABEL_COLUMN: protocol_label, GENOTYPE_COLUMN: genotype,
+                                        TREATMENT_COLUMN: li})
 
                 if len(indexes) > 0:
                     x = np.array(combined_df[x_col][indexes])
@@ -0,0 +1,321 @@
+# Chunked, compressed columnar format for combined_df and its fit results.
+# The rows are split into row groups and every column of a row group is a separate compressed file, so a
+# subset of the columns (e.g. FIT_PARAMS and the metadata) of a subset of the rows can be loaded without
+# reading the raw traces and model curves.
+import json
+import os
+import pickle
+import shutil
+import zlib
+
+import numpy as np
+import pandas as pd
+
+from pirk.names import METADATA_COLUMNS
+
+COLUMNAR_EXTENSION = "columnar"
+COLUMNAR_VERSION = 2  # 2: row groups with a sidecar metadata index
+MANIFEST_FILE = "manifest.json"
+METADATA_INDEX_FILE = "metadata_index.pkl.z"
+ROW_GROUP = "_row_group"
+POSITION = "_position"
+DEFAULT_ROW_GROUP_SIZE = 256
+COMPRESSION_LEVEL = 1  # zlib level; the traces are noisy floats, higher levels are much slower for little gain
+
+# How a column is stored
+KIND_NUMERIC = "numeric"  # numpy numeric or bool dtype, one value per row
+KIND_RAGGED = "ragged"  # one 1-D numeric array (or list) per row, concatenated with offsets
+KIND_OBJECT = "object"  # anything else, pickled
+
+
+def _is_missing(cell):
+    return cell is None or (isinstance(cell, float) and np.isnan(cell))
+
+
+def _ragged_arrays(series):
+    """
+    Cells of an object column as 1-D numeric arrays (None if missing), or None if the column is not ragged numeric.
+    """
+    arrays = []
+    for cell in series:
+        if _is_missing(cell):
+            arrays.append(None)
+            continue
+        if not isinstance(cell, (list, tuple, np.ndarray)):
+            return None
+        array = np.asarray(cell)
+        if array.ndim != 1 or (array.size > 0 and array.dtype.kind not in "biuf"):
+            return None
+        arrays.append(array)
+    return arrays
+
+
+def _column_kind(series):
+    if series.dtype != object:
+        return KIND_NUMERIC if series.dtype.kind in "biuf" else KIND_OBJECT, None
+    arrays = _ragged_arrays(series)
+    if arrays is None:
+        return KIND_OBJECT, None
+    present = [array for array in arrays if array is not None and array.size > 0]
+    dtype = np.result_type(*present) if present else np.dtype(np.float64)
+    return KIND_RAGGED, (arrays, dtype)
+
+
+def _write_object(file_path, value, level=COMPRESSION_LEVEL):
+    with open(file_path, "wb") as f:
+        f.write(zlib.compress(pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL), level))
+
+
+def _shuffle(values):
+    """
+    Byte planes of a numeric array (all first bytes, then all second bytes, ...). The sign and exponent bytes of
+    the float traces are nearly constant, so the planes compress better and faster than the interleaved values.
+    """
+    values = np.ascontiguousarray(values)
+    return {"planes": values.view(np.uint8).reshape(-1, values.itemsize).T.copy(), "dtype": values.dtype.str}
+
+
+def _unshuffle(shuffled):
+    return np.ascontiguousarray(shuffled["planes"].T).view(np.dtype(shuffled["dtype"])).reshape(-1)
+
+
+def _read_object(file_path):
+    with open(file_path, "rb") as f:
+        return pickle.loads(zlib.decompress(f.read()))
+
+
+def save_columnar(combined_df, path, row_group_size=DEFAULT_ROW_GROUP_SIZE, overwrite=True, index_columns=None,
+                  compression_level=COMPRESSION_LEVEL):
+    """
+    Save combined_df in the chunked columnar format.
+
+    Parameters
+    ----------
+    combined_df : pd.DataFrame
+        DataFrame to save.
+    path : str
+        Dataset directory.
+    row_group_size : int, optional
+        Number of rows per row group.
+    overwrite : bool, optional
+        Whether to replace an existing dataset.
+    index_columns : list of str, optional
+        Columns of the sidecar index used to select rows without reading the row groups,
+        default METADATA_COLUMNS.
+    compression_level : int, optional
+        zlib level of the numeric chunks, 0 stores them uncompressed (fastest to write and read).
+
+    Returns
+    -------
+    path : str
+
+    Notes
+    -----
+    Numeric columns are stored as arrays, object columns holding 1-D numeric arrays or lists (traces, fit results)
+    as one concatenated array with offsets per row group, all other columns pickled. All chunks are compressed.
+    Ragged cells are loaded back as arrays, missing ragged cells (None or NaN) as None.
+    """
+    if os.path.exists(path):
+        if not overwrite:
+            raise FileExistsError(f"Dataset {path} already exists. Set overwrite=True to replace it.")
+        shutil.rmtree(path)
+    os.makedirs(path)
+
+    n_rows = len(combined_df)
+    row_groups = [(start, min(start + row_group_size, n_rows)) for start in range(0, n_rows, row_group_size)]
+    for group_id in range(len(row_groups)):
+        os.makedirs(os.path.join(path, f"rg{group_id:05d}"))
+        start, stop = row_groups[group_id]
+        _write_object(os.path.join(path, f"rg{group_id:05d}", "index.pkl.z"), combined_df.index[start:stop])
+
+    columns = []
+    for column_id, col in enumerate(combined_df.columns):
+        series = combined_df[col]
+        kind, ragged = _column_kind(series)
+        columns.append({"name": col, "file": f"c{column_id:04d}", "kind": kind, "dtype": str(series.dtype)})
+
+        for group_id, (start, stop) in enumerate(row_groups):
+            file_path = os.path.join(path, f"rg{group_id:05d}", columns[-1]["file"])
+            if kind == KIND_NUMERIC:
+                _write_object(file_path + ".npy.z", {"values": _shuffle(series.values[start:stop])}, compression_level)
+            elif kind == KIND_RAGGED:
+                arrays, dtype = ragged
+                chunk = arrays[start:stop]
+                missing = np.array([array is None for array in chunk], dtype=bool)
+                lengths = [0 if array is None else len(array) for array in chunk]
+                offsets = np.concatenate([[0], np.cumsum(lengths)]).astype(np.int64)
+                values = np.concatenate([array for array in chunk if array is not None] + [np.empty(0)]).astype(dtype)
+                _write_object(file_path + ".npy.z", {"values": _shuffle(values), "offsets": offsets, "missing": missing},
+                              compression_level)
+            else:
+                _write_object(file_path + ".pkl.z", series.iloc[start:stop])
+
+    _write_metadata_index(path, combined_df, row_groups, METADATA_COLUMNS if index_columns is None else index_columns)
+
+    manifest = {"format": COLUMNAR_EXTENSION, "version": COLUMNAR_VERSION, "n_rows": n_rows,
+                "row_groups": row_groups, "columns": columns}
+    with open(os.path.join(path, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+    return path
+
+
+def read_manifest(path):
+    with open(os.path.join(path, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    if manifest.get("format") != COLUMNAR_EXTENSION or manifest["version"] != COLUMNAR_VERSION:
+        raise ValueError(f"{path} is not a version {COLUMNAR_VERSION} columnar dataset")
+    return manifest
+
+
+def _read_column_chunk(path, group_id, column):
+    file_path = os.path.join(path, f"rg{group_id:05d}", column["file"])
+    if column["kind"] == KIND_OBJECT:
+        return _read_object(file_path + ".pkl.z").values
+
+    chunk = _read_object(file_path + ".npy.z")
+    values = _unshuffle(chunk["values"])
+    if column["kind"] == KIND_NUMERIC:
+        return values
+    offsets, missing = chunk["offsets"], chunk["missing"]
+
+    cells = np.empty(len(missing), dtype=object)
+    for position in range(len(missing)):
+        cells[position] = None if missing[position] else values[offsets[position]:offsets[position + 1]]
+    return cells
+
+
+def row_mask(frame, where):
+    """
+    Boolean mask of the rows of frame matching all predicates of where.
+    A predicate is a value (equality), a list, tuple, set or array of values (membership), or a callable
+    taking the column as a Series and returning a boolean mask.
+    """
+    mask = np.ones(len(frame), dtype=bool)
+    for col, predicate in where.items():
+        values = pd.Series(frame[col])
+        if callable(predicate):
+            col_mask = np.asarray(predicate(values), dtype=bool)
+        elif isinstance(predicate, (list, tuple, set, np.ndarray)):
+            col_mask = values.isin(list(predicate)).values
+        else:
+            col_mask = (values == predicate).values
+        mask &= col_mask
+    return mask
+
+
+def _write_metadata_index(path, combined_df, row_groups, index_columns):
+    """
+    Sidecar index: the index columns of every row with its row group and position in the row group.
+    """
+    metadata = combined_df[[col for col in index_columns if col in combined_df.columns]].copy()
+    metadata[ROW_GROUP] = np.repeat(np.arange(len(row_groups)), [stop - start for start, stop in row_groups])
+    metadata[POSITION] = np.concatenate([np.arange(stop - start) for start, stop in row_groups] + [[]]).astype(int)
+    _write_object(os.path.join(path, METADATA_INDEX_FILE), metadata)
+
+
+def build_metadata_index(path, index_columns=None):
+    """
+    (Re)build the sidecar index of a columnar dataset, e.g. to index other columns than METADATA_COLUMNS.
+    """
+    index_columns = METADATA_COLUMNS if index_columns is None else index_columns
+    manifest = read_manifest(path)
+    available = [column["name"] for column in manifest["columns"] if column["name"] in index_columns]
+    combined_df = load_columnar(path, columns=available, use_index=False)
+    _write_metadata_index(path, combined_df, manifest["row_groups"], available)
+
+
+def read_metadata_index(path):
+    """
+    Sidecar index of a columnar dataset, None if it has none.
+    """
+    full_path = os.path.join(path, METADATA_INDEX_FILE)
+    return _read_object(full_path) if os.path.exists(full_path) else None
+
+
+def _scan_row_groups(path, by_name, where, row_groups):
+    """
+    Rows matching where, found by reading the where columns of every row group.
+    Returns: dict row group -> positions, index of the matching rows
+    """
+    selected, index = {}, []
+    for group_id in row_groups:
+        chunks = pd.DataFrame({col: _read_column_chunk(path, group_id, by_name[col]) for col in where})
+        positions = np.flatnonzero(row_mask(chunks, where))
+        if len(positions) > 0:
+            selected[group_id] = positions
+            index.append(_read_object(os.path.join(path, f"rg{group_id:05d}", "index.pkl.z"))[positions])
+    return selected, index
+
+
+def load_columnar(path, columns=None, where=None, row_groups=None, use_index=True):
+    """
+    Load (part of) a columnar dataset. Only the requested columns of the row groups holding requested rows
+    are read.
+
+    Parameters
+    ----------
+    path : str
+        Dataset directory.
+    columns : list of str, optional
+        Columns to load, default all.
+    where : dict, optional
+        column -> predicate; only the rows matching all predicates are returned. A predicate is a value,
+        a list of values, or a callable taking the column (Series) and returning a boolean mask.
+        Predicates on indexed columns (METADATA_COLUMNS by default) are evaluated on the sidecar index without
+        reading any row group; otherwise the where columns of every row group are read first.
+    row_groups : list of int, optional
+        Row groups to read, default all.
+    use_index : bool, optional
+        Use the sidecar index, if the dataset has one.
+
+    Returns
+    -------
+    combined_df : pd.DataFrame
+    """
+    manifest = read_manifest(path)
+    by_name = {column["name"]: column for column in manifest["columns"]}
+    names = list(by_name) if columns is None else list(columns)
+    where = where or {}
+    unknown = [col for col in names + list(where) if col not in by_name]
+    if unknown:
+        raise KeyError(f"Columns {unknown} are not in {path}")
+
+    row_groups = list(range(len(manifest["row_groups"]))) if row_groups is None else list(row_groups)
+    metadata = read_metadata_index(path) if use_index else None
+    if metadata is not None and all(col in metadata.columns for col in where):
+        metadata = metadata[row_mask(metadata, where) & metadata[ROW_GROUP].isin(row_groups).values]
+        selected = {group_id: rows[POSITION].values for group_id, rows in metadata.groupby(ROW_GROUP, sort=True)}
+        index = [metadata.index]
+    elif where:
+        metadata = None
+        selected, index = _scan_row_groups(path, by_name, where, row_groups)
+    else:
+        metadata = None
+        selected = {group_id: None for group_id in row_groups}
+        index = [_read_object(os.path.join(path, f"rg{group_id:05d}", "index.pkl.z")) for group_id in row_groups]
+
+    index = index[0].append(index[1:]) if index else pd.Index([])
+    data = {}
+    for col in names:
+        if metadata is not None and col in metadata.columns:
+            data[col] = metadata[col].values  # served by the sidecar index
+            continue
+        chunks = []
+        for group_id, positions in selected.items():
+            chunk = _read_column_chunk(path, group_id, by_name[col])
+            chunks.append(chunk if positions is None else chunk[positions])
+        data[col] = _concatenate_chunks(chunks, by_name[col])
+
+    combined_df = pd.DataFrame(data, index=index)
+    for col in names:
+        if by_name[col]["kind"] != KIND_RAGGED:
+            combined_df[col] = combined_df[col].astype(by_name[col]["dtype"])
+    return combined_df
+
+
+def _concatenate_chunks(chunks, column):
+    if not chunks:
+        return np.empty(0, dtype=object if column["kind"] != KIND_NUMERIC else column["dtype"])
+    if column["kind"] == KIND_OBJECT:
+        return pd.concat([pd.Series(chunk) for chunk in chunks], ignore_index=True).values
+    return np.concatenate(chunks)
@@ -4,6 +4,8 @@ import numpy as np
 import os
 import pandas as pd
 
+from pirk.reporting.columnar import save_columnar, COLUMNAR_EXTENSION
+
 def save_combined_df(df, filename, path, file_format='pkl', overwrite=True):
     """
     Save a DataFrame to a specified path with optional format.
@@ -17,7 +19,8 @@ def save_combined_df(df, filename, path, file_format='pkl', overwrite=True):
     path : str
         Directory path where the file will be saved.
     file_format : str, optional
-        File format: 'pkl' (pickle) or 'csv'. Default is 'pkl'.
+        File format: 'pkl' (pickle), 'csv' or 'columnar' (chunked compressed columns, see save_columnar;
+        a directory, loadable column by column). Default is 'pkl'.
     overwrite : bool, optional
         Whether to overwrite existing file. Default is True.
 
@@ -30,8 +33,8 @@ def save_combined_df(df, filename, path, file_format='pkl', overwrite=True):
     os.makedirs(path, exist_ok=True)
 
     ext = file_format.lower()
-    if ext not in ['pkl', 'csv']:
-        raise ValueError("file_format must be 'pkl' or 'csv'")
+    if ext not in ['pkl', 'csv', COLUMNAR_EXTENSION]:
+        raise ValueError(f"file_format must be 'pkl', 'csv' or '{COLUMNAR_EXTENSION}'")
 
     full_path = os.path.join(path, f"{filename}.{ext}")
 
@@ -42,6 +45,8 @@ def save_combined_df(df, filename, path, file_format='pkl', overwrite=True):
         df.to_pickle(full_path)
     elif ext == 'csv':
         df.to_csv(full_path, index=False)
+    elif ext == COLUMNAR_EXTENSION:
+        save_columnar(df, full_path)
 
     print(f"DataFrame saved to {full_path}")
     return full_path
@@ -0,0 +1,231 @@
+# Synthetic screens with the same schema as the DataFrame returned by load_combined_df, for benchmarks, load tests
+# and CI. DIRK/PIRK traces are built with the model itself from known parameters, so every fitting engine can be
+# checked for parameter recovery against the ground truth stored in TRUE_FIT_PARAMS.
+import numpy as np
+import pandas as pd
+
+from pirk.calculations.protocols import PHOTORIDES_2_P700_INDICES
+from pirk.fitting.models import construct_dirk_pirk, DirkPirkEvaluator
+from pirk.fitting.results import fit_curves
+from pirk.names import *
+from pirk.parsing.prep_data_fit import prep_traces_for_fitting
+
+DEFAULT_TRUE_PARAMS = {
+    AMPLITUDE: 0.3,
+    GH_START: 10,
+    GH_END: 110,
+    GH_LIFETIME: 0.08,
+    PIRK_BEGIN_AMPLITUDE: 0.05,
+    PIRK_END_AMPLITUDE: 2,
+    PIRK_AMPLITUDE_RECOVERY_LIFETIME: 0.05,
+    OFFSET_AMPLITUDE: 0.25,
+    OFFSET_LIFETIME: 0.05
+}
+
+# dirk period of 0.6 s with the pirks in the first 0.2 s, so the signal has relaxed by the baseline window
+# (BASELINE_BEGIN_TIME to BASELINE_END_TIME) used by prep_traces_for_fitting
+DIRK_DURATION = 0.6
+PIRK_TIMES_SYNTHETIC = (0.02, 0.05, 0.09, 0.14, 0.2)
+
+# PAM protocol: samples per window (Fs, three MPF steps, FoPrime gap and window) and relative ramp intensities
+PAM_PULSES = [50, 60, 60, 60, 40]
+PAM_RAMP_LIGHT = [1.0, 0.8, 0.6]
+PAM_TRACE_LENGTH = 320
+
+# photorides 2.0 P700 protocol
+P700_TRACE_INDICES = PHOTORIDES_2_P700_INDICES
+P700_TRACE_LENGTH = 300
+
+PIRK_LABELS = [LABEL_ECS, LABEL_P700, LABEL_FLURO]
+ALL_LABELS = PIRK_LABELS + [LABEL_PAM, LABEL_PAM_P700]
+
+
+def _to_string(value):
+    if isinstance(value, np.ndarray):
+        value = value.tolist()
+    return str(value)
+
+
+def _pirk_traces(n_traces, trace_length, n_baseline, true_params, param_spread, noise, scale,
+                 steady_state_pirk_amplitude, rng):
+    """
+    Raw DIRK/PIRK traces of one trace label. Returns time axis, traces (2-D), dirk indices, pirk indices, params.
+    """
+    dt = DIRK_DURATION / trace_length
+    time_axis = np.arange(n_baseline + trace_length) * dt
+    x = time_axis[n_baseline:] - time_axis[n_baseline]
+
+    pirk_indices = [int(round(t / dt)) for t in PIRK_TIMES_SYNTHETIC]
+    pirk_points = [0] + [x[i] for i in pirk_indices]
+    model = DirkPirkEvaluator(np.linspace(0, np.max(x), len(x)), pirk_points)
+
+    base_params = np.array([true_params[name] for name in DIRK_PIRK_PARAMETERS], dtype=float)
+    params = base_params * np.exp(param_spread * rng.standard_normal((n_traces, len(base_params))))
+
+    traces = np.empty((n_traces, len(time_axis)))
+    traces[:, n_baseline:] = rng.normal(0, noise, (n_traces, trace_length))
+    for i in range(n_traces):
+        traces[i, n_baseline:] += model(x, *params[i])
+
+    # steady state before the dirk, with one pirk on the last point
+    traces[:, :n_baseline] = traces[:, [n_baseline]] + rng.normal(0, noise, (n_traces, n_baseline))
+    traces[:, n_baseline - 1] += steady_state_pirk_amplitude
+
+    dirk_indices = (n_baseline, n_baseline + trace_length)
+    return time_axis, traces / scale, dirk_indices, [n_baseline + i for i in pirk_indices], params
+
+
+def _pam_traces(n_traces, noise, rng):
+    """
+    PAM traces: Fs, an MPF ramp of Fm' steps following Fm'_corr - m / I, and FoPrime.
+    """
+    indices_fs_end = PAM_PULSES[0] - 1
+    traces = np.full((n_traces, PAM_TRACE_LENGTH), 0.25)
+
+    fs = rng.uniform(0.25, 0.35, n_traces)
+    fm_corr = rng.uniform(0.9, 1.1, n_traces)
+    slope = rng.uniform(0.02, 0.08, n_traces)
+    fo_prime = rng.uniform(0.15, 0.22, n_traces)
+
+    traces[:, :indices_fs_end + 1] = fs[:, None]
+    start = indices_fs_end + 1
+    for i, ramp_light in enumerate(PAM_RAMP_LIGHT, start=1):
+        end = start + PAM_PULSES[i]
+        traces[:, start:end] = (fm_corr - slope / ramp_light)[:, None]
+        start = end
+    fo_begin = start - 1 + PAM_PULSES[len(PAM_RAMP_LIGHT) + 1]
+    traces[:, fo_begin:fo_begin + PAM_PULSES[len(PAM_RAMP_LIGHT) + 1]] = fo_prime[:, None]
+
+    return traces + rng.normal(0, noise, traces.shape)
+
+
+def _p700_traces(n_traces, noise, rng):
+    """
+    P700 traces of the photorides 2.0 protocol: dark level 1 with absorbance dips for steady state and saturation.
+    """
+    traces = np.ones((n_traces, P700_TRACE_LENGTH))
+    windows = [(PSI_SS_BEG, PSI_SS_END, 0.003, 0.008), (PSI_SAT1_BEG, PSI_SAT1_END, 0.01, 0.02),
+               (PSI_SAT2_BEG, PSI_SAT2_END, 0.015, 0.025)]
+    for begin, end, low, high in windows:
+        depth = rng.uniform(low, high, n_traces)
+        traces[:, P700_TRACE_INDICES[begin]:P700_TRACE_INDICES[end]] = (1 - depth)[:, None]
+    return traces + rng.normal(0, noise, traces.shape)
+
+
+def generate_combined_df(n_genotypes=4, n_light_intensities=3, n_replicates=3, trace_labels=None,
+                         trace_length=1000, n_baseline=400, true_params=None, param_spread=0.1, noise=0.005,
+                         protocol_noise=0.002, steady_state_pirk_amplitude=0.1, as_strings=False, seed=0):
+    """
+    Build a synthetic screen with the schema of the DataFrame returned by load_combined_df.
+
+    Parameters
+    ----------
+    n_genotypes, n_light_intensities, n_replicates : int
+        Screen layout; one trace per trace label, genotype, light intensity and replicate.
+    trace_labels : list of str, optional
+        Trace labels to generate, default ALL_LABELS (ECS, P700 and fluro PIRK, PAM and PAM-P700).
+    trace_length : int
+        Number of points in the dirk period of the PIRK traces.
+    n_baseline : int
+        Number of points before the dirk period.
+    true_params : dict, optional
+        Model parameters (see DIRK_PIRK_PARAMETERS), default DEFAULT_TRUE_PARAMS.
+    param_spread : float
+        Log-normal spread of the parameters between traces, 0 gives every trace true_params.
+    noise : float
+        Standard deviation of the noise on the PIRK traces, in the units of the prepared (fitted) trace.
+    protocol_noise : float
+        Standard deviation of the noise on the PAM and PAM-P700 traces.
+    steady_state_pirk_amplitude : float
+        Height of the pirk just before the dirk period, in the units of the prepared trace.
+    as_strings : bool
+        Store the array columns as stringified lists, as in freshly exported screens.
+    seed : int
+        Seed of the random generator.
+
+    Returns
+    -------
+    combined_df : pd.DataFrame
+        One row per trace; TRUE_FIT_PARAMS holds the parameters a PIRK trace was generated with.
+    """
+    rng = np.random.default_rng(seed)
+    trace_labels = ALL_LABELS if trace_labels is None else list(trace_labels)
+    true_params = DEFAULT_TRUE_PARAMS if true_params is None else true_params
+
+    genotypes = ["Col-0"] + [f"mutant-{i}" for i in range(1, n_genotypes)]
+    light_intensities = [int(li) for li in np.linspace(100, 1000, n_light_intensities)]
+    layout = [(genotype, li, replicate) for genotype in genotypes for li in light_intensities
+              for replicate in range(1, n_replicates + 1)]
+    n_traces = len(layout)
+
+    columns = {col: [] for col in [LABEL_COLUMN, GENOTYPE_COLUMN, TREATMENT_COLUMN, REPLICATE_COLUMN, TRACE_COLUMN,
+                                   TIME_COLUMN, DIRK_INDICES_COLUMN, PIRK_POINTS_COLUMN, NUMBER_PULSES, RAMP_LIGHT,
+                                   TRUE_FIT_PARAMS]}
+
+    def add_rows(label, traces, time_axis, dirk_indices, pirk_points, pulses, ramp_light, params):
+        columns[LABEL_COLUMN].extend([label] * n_traces)
+        columns[GENOTYPE_COLUMN].extend(genotype for genotype, _, _ in layout)
+        columns[TREATMENT_COLUMN].extend(li for _, li, _ in layout)
+        columns[REPLICATE_COLUMN].extend(replicate for _, _, replicate in layout)
+        columns[TRACE_COLUMN].extend(traces)
+        columns[TIME_COLUMN].extend([time_axis] * n_traces)
+        columns[DIRK_INDICES_COLUMN].extend([dirk_indices] * n_traces)
+        columns[PIRK_POINTS_COLUMN].extend([pirk_points] * n_traces)
+        columns[NUMBER_PULSES].extend([pulses] * n_traces)
+        columns[RAMP_LIGHT].extend([ramp_light] * n_traces)
+        columns[TRUE_FIT_PARAMS].extend(params if params is not None else [None] * n_traces)
+
+    for label in trace_labels:
+        if label in PIRK_LABELS:
+            scale = 1000 if label in [LABEL_ECS, LABEL_P700] else 1  # undone by prep_traces_for_fitting
+            time_axis, traces, dirk_indices, pirk_points, params = _pirk_traces(
+                n_traces, trace_length, n_baseline, true_params, param_spread, noise, scale,
+                steady_state_pirk_amplitude, rng)
+            add_rows(label, traces, time_axis, dirk_indices, pirk_points, None, None, params)
+        elif label == LABEL_PAM:
+            traces = _pam_traces(n_traces, protocol_noise, rng)
+            add_rows(label, traces, np.arange(PAM_TRACE_LENGTH), None, None, list(PAM_PULSES),
+                     list(PAM_RAMP_LIGHT), None)
+        elif label == LABEL_PAM_P700:
+            traces = _p700_traces(n_traces, protocol_noise, rng)
+            add_rows(label, traces, np.arange(P700_TRACE_LENGTH), None, None, None, None, None)
+        else:
+            raise ValueError(f"Unknown trace label {label}")
+
+    combined_df = pd.DataFrame(columns)
+    if as_strings:
+        for col in [TRACE_COLUMN, TIME_COLUMN, DIRK_INDICES_COLUMN, PIRK_POINTS_COLUMN, NUMBER_PULSES, RAMP_LIGHT]:
+            combined_df[col] = [None if value is None else _to_string(value) for value in combined_df[col]]
+    return combined_df
+
+
+def parameter_recovery(combined_df, indexes=None):
+    """
+    Compare fitted (FIT_PARAMS) with true (TRUE_FIT_PARAMS) parameters of synthetic traces,
+    by default of all fitted synthetic PIRK traces.
+
+    Returns
+    -------
+    recovery : pd.DataFrame
+        Per trace: the relative error of every parameter ("<name>_rel_err") and "curve_rmse", the RMSE between
+        the fitted and the true model curve (parameters such as the pirk begin amplitude are poorly identifiable,
+        the curve is not).
+    """
+    if indexes is None:
+        fitted = combined_df[FIT_PARAMS].map(lambda fit: fit is not None and len(fit) > 0)
+        indexes = combined_df.index[combined_df[TRUE_FIT_PARAMS].notna() & fitted]
+
+    rows = {}
+    for index in indexes:
+        true = np.asarray(combined_df.at[index, TRUE_FIT_PARAMS], dtype=float)
+        fit = np.asarray(combined_df.at[index, FIT_PARAMS], dtype=float)
+        trace_x, _, pirk_points, _ = prep_traces_for_fitting(combined_df, index)
+        x_total = np.linspace(0, np.max(trace_x), len(trace_x))
+
+        row = {f"{name}_rel_err": abs(f - t) / abs(t) for name, f, t in zip(DIRK_PIRK_PARAMETERS, fit, true)}
+        true_curve = construct_dirk_pirk(x_total, pirk_points, *true)[1]
+        fitted_curve = fit_curves(combined_df, index)[MODEL_PREDICTION]
+        row["curve_rmse"] = np.sqrt(np.mean((fitted_curve - true_curve) ** 2))
+        rows[index] = row
+
+    return pd.DataFrame.from_dict(rows, orient="index")
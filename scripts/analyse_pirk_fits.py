@@ -1,12 +1,28 @@
-from pirk.names import DEFAULT_OUTPUT_PATH, FILE_NAME, FILE_NAME_PIRK_FITS, LABEL_ECS,LABEL_P700
+import pandas as pd
+
+from pirk.names import DEFAULT_OUTPUT_PATH, FILE_NAME, FILE_NAME_PIRK_FITS, LABEL_ECS,LABEL_P700, LABEL_COLUMN, \
+    FIT_PARAMS, METADATA_COLUMNS, DIRK_PIRK_PARAMETERS, GENOTYPE_COLUMN, TREATMENT_COLUMN
 from pirk.plotting.summaries import plot_extracted_params, plot_all_dirk_pirk_fits
+from pirk.plotting.batch import render_dirk_pirk_fits
 from pirk.reporting.export import save_combined_df
 from scripts.load_data import load_combined_df
 
-combined_df = load_combined_df(DEFAULT_OUTPUT_PATH,FILE_NAME_PIRK_FITS)
+# Only the fitted parameters and the metadata of the P700 traces are read from the columnar fit results,
+# the raw traces and model curves stay on disk (saved with file_format='columnar' by run_fit_pirk.py)
+p700_df = load_combined_df(DEFAULT_OUTPUT_PATH, FILE_NAME_PIRK_FITS + '.columnar',
+                           columns=[FIT_PARAMS] + METADATA_COLUMNS, where={LABEL_COLUMN: LABEL_P700})
+
+fitted = p700_df[p700_df[FIT_PARAMS].map(lambda fit: fit is not None and len(fit) == len(DIRK_PIRK_PARAMETERS))]
+fit_params = pd.DataFrame(fitted[FIT_PARAMS].tolist(), columns=DIRK_PIRK_PARAMETERS, index=fitted.index)
+fit_params = pd.concat([fitted[[GENOTYPE_COLUMN, TREATMENT_COLUMN]], fit_params], axis=1)
+print(fit_params.groupby([GENOTYPE_COLUMN, TREATMENT_COLUMN]).median().round(3))
 
+# The fit plots need the traces and model curves, load everything
+# combined_df = load_combined_df(DEFAULT_OUTPUT_PATH,FILE_NAME_PIRK_FITS + '.columnar')
 # plot_all_dirk_pirk_fits(combined_df,LABEL_ECS)
-plot_all_dirk_pirk_fits(combined_df,LABEL_P700)
+# plot_all_dirk_pirk_fits(combined_df,LABEL_P700)
+# or write all figures to files, rendered in parallel without a display:
+# render_dirk_pirk_fits(combined_df, LABEL_ECS, DEFAULT_OUTPUT_PATH + 'fit_figures')
 
 # plot_extracted_params(combined_df,LABEL_ECS)
 # save_combined_df(combined_df, FILE_NAME_PIRK_FITS, DEFAULT_OUTPUT_PATH, file_format='pkl', overwrite=True)
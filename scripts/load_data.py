@@ -2,13 +2,33 @@ import os
 
 import pandas as pd
 
+from pirk.parsing.loader import materialize_array_columns
+from pirk.reporting.columnar import load_columnar, row_mask, COLUMNAR_EXTENSION
 
-def load_combined_df(path,file_name):
+
+def load_combined_df(path,file_name, materialize_arrays=True, columns=None, where=None):
+    """
+    Load combined_df from a pickle, or from a columnar dataset (file name ending in .columnar, see
+    save_combined_df). where maps columns to a value, a list of values or a callable (Series -> boolean mask).
+    Only the given columns of the rows matching where are read from a columnar dataset, the rows are selected
+    on its sidecar index of METADATA_COLUMNS; a pickle is loaded completely and then filtered.
+    """
 
     full_path = os.path.join(path, file_name)
 
     # Load DataFrame
-    combined_df = pd.read_pickle(full_path)
+    if full_path.rstrip(os.sep).endswith("." + COLUMNAR_EXTENSION):
+        combined_df = load_columnar(full_path, columns=columns, where=where)
+    else:
+        combined_df = pd.read_pickle(full_path)
+        if where:
+            combined_df = combined_df[row_mask(combined_df, where)]
+        if columns is not None:
+            combined_df = combined_df[list(columns)]
+
+    # Parse the stringified trace columns once, instead of every time a row is used
+    if materialize_arrays:
+        materialize_array_columns(combined_df)
 
     # Optional: print summary
     print(f"Loaded DataFrame with {len(combined_df)} rows and {len(combined_df.columns)} columns")
@@ -1,4 +1,4 @@
-from pirk.calculations.pam import calculate_fluorescence_values
+from pirk.calculations.pam import calculate_fluorescence_batch
 from pirk.parsing.helpers import add_object_column
 from pirk.reporting.export import save_combined_df
 
@@ -15,7 +15,6 @@ for col in columns_to_add:
 
 indexes = combined_df[(combined_df[LABEL_COLUMN] == LABEL_PAM)].index
 
-for index in [indexes[0]]:#indexes:
-    calculate_fluorescence_values(combined_df, index,plot_all=True)
+calculate_fluorescence_batch(combined_df, indexes)
 
 # save_combined_df(combined_df, FILE_NAME_PAM_FITS, DEFAULT_OUTPUT_PATH, file_format='pkl', overwrite=True)
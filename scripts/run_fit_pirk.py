@@ -11,18 +11,7 @@ from pirk.names import *
 combined_df = load_combined_df(DEFAULT_DATA_PATH,FILE_NAME)
 
 
-columns_to_add = [
-    FIT_PARAMS,
-    PIRK_TIMES,
-    PIRK_AMPLITUDES,
-    STEADY_STATE_PIRK_TIME,
-    STEADY_STATE_PIRK_AMPLITUDE,
-    TIME_CONSTANTS,
-    MODEL_TIME,
-    MODEL_PREDICTION,
-    TIME_FITTED,
-    TRACE_FITTED
-    ]
+columns_to_add = DIRK_PIRK_RESULT_COLUMNS
 
 
 for col in columns_to_add:
@@ -62,21 +51,16 @@ plot_dirk_pirk_fit(combined_df, index, postprocessed,
                    trace_y=combined_df.at[index,TRACE_FITTED])
 
 
+# Fit all traces in parallel, the results are written into combined_df.
+# On macOS/Windows the script needs an `if __name__ == "__main__":` guard when workers > 1.
+# from pirk.fitting.batch import fit_pirk_dirk_batch
+#
 # trace_to_fit_list = [LABEL_ECS,LABEL_P700,LABEL_FLURO]
 #
 # indexes = combined_df[combined_df[LABEL_COLUMN].isin(trace_to_fit_list)].index
-# #
-# for index in indexes:
-#     fit, pcov, perr, postprocessed = fit_pirk_dirk(combined_df, index, guess_dict)
-#
-#     # Optional reporting
-#     report_dirk_pirk_fit(combined_df, index, guess_dict, fit, pcov,
-#                          trace_y=combined_df.at[index, TRACE_FITTED],
-#                          dirk_pirk_y=postprocessed[MODEL_PREDICTION])
 #
-#     # # Optional plotting
-#     # plot_dirk_pirk_fit(combined_df, index, postprocessed,
-#     #                    trace_x=combined_df.at[index, TIME_FITTED],
-#     #                    trace_y=combined_df.at[index, TRACE_FITTED])
+# # every completed fit is journaled, rerun with resume=True to continue an interrupted run
+# results = fit_pirk_dirk_batch(combined_df, indexes, guess_dict, workers=None, analytic_jacobian=True, warm_start=True,
+#                               journal=DEFAULT_OUTPUT_PATH + FILE_NAME_PIRK_FITS + '_journal.jsonl', resume=True)
 #
-# save_combined_df(combined_df, FILE_NAME_PIRK_FITS, DEFAULT_OUTPUT_PATH, file_format='pkl', overwrite=True)
\ No newline at end of file
+# save_combined_df(combined_df, FILE_NAME_PIRK_FITS, DEFAULT_OUTPUT_PATH, file_format='columnar', overwrite=True)
@@ -0,0 +1,85 @@
+import numpy as np
+import pytest
+from scipy.stats import linregress
+
+from pirk.calculations.p700_pam import calculate_ps1_batch, PSI_COLUMNS
+from pirk.calculations.pam import calculate_fluorescence_batch, calculate_fluorescence_params, calculate_indices, \
+    PAM_COLUMNS
+from pirk.calculations.pirk import calculate_steady_state_pirk_batch
+from pirk.calculations.protocols import ProtocolRegistry, PROTOCOLS, PHOTORIDES_2_P700
+from pirk.fitting.fitters import fit_fm_values
+from pirk.names import *
+from pirk.parsing.loader import extract_Fluro_paras, parse_array
+from pirk.synthetic import generate_combined_df, P700_TRACE_INDICES, PIRK_LABELS
+
+
+def _reference_psi(trace, idx):
+    absorbance = np.log10(np.mean(trace[idx[PSI_DARK_BEG]:idx[PSI_DARK_END]]) / trace)
+
+    def top_mean(beg, end):
+        values = np.sort(absorbance[beg:end])
+        return 1000 * np.mean(values[int((end - beg) * 0.8):])
+
+    ss = 1000 * np.mean(absorbance[idx[PSI_SS_BEG]:idx[PSI_SS_END]])
+    sat1 = top_mean(idx[PSI_SAT1_BEG], idx[PSI_SAT1_END])
+    sat2 = top_mean(idx[PSI_SAT2_BEG], idx[PSI_SAT2_END])
+    return [ss / sat2, sat2, (sat1 - ss) / sat2, 1 - sat1 / sat2]
+
+
+def test_calculate_ps1_batch_matches_single_trace():
+    df = generate_combined_df(n_genotypes=2, n_light_intensities=2, n_replicates=2, trace_labels=[LABEL_PAM_P700])
+    df.at[0, TRACE_COLUMN] = df.at[0, TRACE_COLUMN][:280]  # a second protocol length
+    calculate_ps1_batch(df, df.index, P700_TRACE_INDICES)
+
+    for index in df.index:
+        expected = _reference_psi(df.at[index, TRACE_COLUMN], P700_TRACE_INDICES)
+        np.testing.assert_allclose(df.loc[index, PSI_COLUMNS].astype(float), expected)
+
+
+def test_calculate_fluorescence_batch_matches_single_trace():
+    df = generate_combined_df(n_genotypes=2, n_light_intensities=2, n_replicates=2, trace_labels=[LABEL_PAM])
+    calculate_fluorescence_batch(df, df.index)
+
+    for index in df.index:
+        trace = df.at[index, TRACE_COLUMN]
+        ramp_lights = df.at[index, RAMP_LIGHT]
+        indices = calculate_indices(df.at[index, NUMBER_PULSES], ramp_lights)
+        _, intercept = fit_fm_values(trace, indices, ramp_lights)
+        expected = calculate_fluorescence_params(extract_Fluro_paras(trace, indices, ramp_lights), intercept)
+        np.testing.assert_allclose(df.loc[index, PAM_COLUMNS].astype(float), list(expected.values()))
+
+
+def test_calculate_steady_state_pirk_batch_matches_linregress():
+    df = generate_combined_df(n_genotypes=1, n_light_intensities=2, n_replicates=2, trace_labels=PIRK_LABELS)
+    results = calculate_steady_state_pirk_batch(df, df.index)
+
+    for index in df.index:
+        x, y = df.at[index, TIME_COLUMN], df.at[index, TRACE_COLUMN]
+        dirk_begin = df.at[index, DIRK_INDICES_COLUMN][0]
+        fitlin = linregress(x[dirk_begin - 10:dirk_begin - 1], y[dirk_begin - 10:dirk_begin - 1])
+        amplitude = y[dirk_begin - 1] - (fitlin.slope * x[dirk_begin - 1] + fitlin.intercept)
+        np.testing.assert_allclose(results.loc[index, [STEADY_STATE_PIRK_TIME, STEADY_STATE_PIRK_AMPLITUDE,
+                                                       STEADY_STATE_PIRK_BASELINE_SLOPE]],
+                                   [x[dirk_begin - 1], amplitude, fitlin.slope], rtol=1e-9, atol=1e-12)
+
+
+def test_protocol_registry_groups_and_validates_rows():
+    df = generate_combined_df(n_genotypes=1, n_light_intensities=2, n_replicates=2, trace_labels=[LABEL_PAM],
+                              as_strings=True)
+    registry = ProtocolRegistry()
+    groups = registry.group_pam_rows(df, df.index)
+    assert len(groups) == 1  # all rows share one layout, validated once
+    (protocol, length), (group_indexes, _) = next(iter(groups.items()))
+    assert protocol is registry.pam([50, 60, 60, 60, 40], [1.0, 0.8, 0.6])
+    assert group_indexes == list(df.index)
+
+    with pytest.raises(ValueError):
+        registry.pam([50, 60, 60], [1.0, 0.8, 0.6])  # a pulse count missing
+    with pytest.raises(ValueError):
+        registry.register_p700("broken", {**P700_TRACE_INDICES, PSI_SAT2_END: 200})  # empty window
+    df.at[0, TRACE_COLUMN] = str(parse_array(df.at[0, TRACE_COLUMN])[:50].tolist())
+    with pytest.raises(ValueError, match="at least"):
+        calculate_fluorescence_batch(df, df.index)
+    with pytest.raises(KeyError):
+        registry.p700("unknown")
+    assert registry.p700(P700_TRACE_INDICES).trace_indices == PROTOCOLS.p700(PHOTORIDES_2_P700).trace_indices
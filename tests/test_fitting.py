@@ -0,0 +1,301 @@
+import itertools
+import os
+import pickle
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pytest
+
+from pirk.fitting.batch import fit_pirk_dirk_batch, warm_start_groups, warm_start_guess, prepare_fit_tasks
+from pirk.fitting.cache import FitCache
+from pirk.fitting.journal import FitJournal
+from pirk.fitting.fitters import fit_pirk_dirk, space_filling_starts, run_multistart_dirk_pirk_fit
+from pirk.fitting.results import fit_curves, expand_fit_results, compact_fit_results, fit_results_table
+from pirk.fitting.models import construct_dirk_pirk, DirkPirkEvaluator, SegmentPlan
+from pirk.names import *
+from pirk.plotting.batch import render_dirk_pirk_fits
+from pirk.plotting.summaries import dirk_pirk_plot_data, dirk_pirk_plot_limits
+from pirk.parsing.helpers import add_object_column
+from pirk.synthetic import generate_combined_df, parameter_recovery
+
+X_TOTAL = np.linspace(0, 2.0, 2000)
+PIRK_POINTS = [0, 0.1, 0.25, 0.4, 0.7, 1.1, 1.6]
+PARAMS = [0.3, 10, 110, 0.08, 0.05, 2, 0.05, 0.25, 0.05]
+
+
+def test_segment_plan_evaluator_matches_construct_dirk_pirk():
+    expected = construct_dirk_pirk(X_TOTAL, PIRK_POINTS, *PARAMS)
+    result = DirkPirkEvaluator(SegmentPlan(X_TOTAL, PIRK_POINTS)).construct(*PARAMS)
+
+    for exp, res in zip(expected, result):
+        np.testing.assert_allclose(res, exp, rtol=1e-12, atol=1e-12)
+
+
+def test_evaluator_reuses_buffers():
+    model = DirkPirkEvaluator(X_TOTAL, PIRK_POINTS)
+    first = model(X_TOTAL, *PARAMS)
+    second = model(X_TOTAL, *[p * 1.1 for p in PARAMS])
+    assert first is second
+
+
+def test_analytic_jacobian_matches_finite_differences():
+    model = DirkPirkEvaluator(X_TOTAL, PIRK_POINTS)
+    params = np.array(PARAMS, dtype=float)
+    jac = model.jacobian(X_TOTAL, *params).copy()
+
+    for k in range(len(params)):
+        step = 1e-6 * max(abs(params[k]), 1.0)
+        upper, lower = params.copy(), params.copy()
+        upper[k] += step
+        lower[k] -= step
+        numeric = (model(X_TOTAL, *upper).copy() - model(X_TOTAL, *lower).copy()) / (2 * step)
+        np.testing.assert_allclose(jac[:, k], numeric, atol=1e-6 * max(np.max(np.abs(numeric)), 1.0))
+
+
+GUESS_DICT = dict(zip(DIRK_PIRK_PARAMETERS, [0.35, 12, 100, 0.1, 0.06, 1.5, 0.06, 0.2, 0.06]))
+
+
+def _synthetic_ecs_df(n_traces, seed=0):
+    return generate_combined_df(n_genotypes=1, n_light_intensities=1, n_replicates=n_traces,
+                                trace_labels=[LABEL_ECS], seed=seed)
+
+
+def test_fit_pirk_dirk_batch_matches_serial_fits():
+    batch_df = _synthetic_ecs_df(4)
+    results = fit_pirk_dirk_batch(batch_df, batch_df.index, GUESS_DICT, workers=2)
+
+    serial_df = _synthetic_ecs_df(4)
+    for col in DIRK_PIRK_RESULT_COLUMNS:
+        add_object_column(serial_df, col)
+    for index in serial_df.index:
+        fit_pirk_dirk(serial_df, index, GUESS_DICT)
+
+    assert sorted(results) == list(batch_df.index)
+    for index in batch_df.index:
+        np.testing.assert_allclose(batch_df.at[index, FIT_PARAMS], serial_df.at[index, FIT_PARAMS])
+        np.testing.assert_allclose(batch_df.at[index, MODEL_PREDICTION], serial_df.at[index, MODEL_PREDICTION])
+        assert batch_df.at[index, PIRK_AMPLITUDES] == serial_df.at[index, PIRK_AMPLITUDES]
+        # the stored traces are writable copies, not the read-only prepared trace cache arrays
+        assert batch_df.at[index, TRACE_FITTED].flags.writeable
+
+
+def test_batch_fits_repeated_indexes_once(tmp_path):
+    df = _synthetic_ecs_df(2)
+    results = fit_pirk_dirk_batch(df, [1, 0, 1], GUESS_DICT, workers=1, journal=str(tmp_path / "run.jsonl"))
+
+    assert list(results) == [1, 0]
+    assert sorted(FitJournal(str(tmp_path / "run.jsonl")).completed_fits()) == [0, 1]
+
+
+def test_compact_batch_rebuilds_the_stored_curves():
+    full_df = _synthetic_ecs_df(3)
+    fit_pirk_dirk_batch(full_df, full_df.index, GUESS_DICT, workers=1)
+    compact_df = _synthetic_ecs_df(3)
+    fit_pirk_dirk_batch(compact_df, compact_df.index, GUESS_DICT, workers=1, compact=True)
+
+    assert not set(DIRK_PIRK_CURVE_COLUMNS) & set(compact_df.columns)
+    assert len(pickle.dumps(compact_df)) < len(pickle.dumps(full_df))
+    for index in full_df.index:
+        curves = fit_curves(compact_df, index)
+        for col in DIRK_PIRK_CURVE_COLUMNS:
+            np.testing.assert_allclose(curves[col], full_df.at[index, col])
+
+    expanded_df = expand_fit_results(compact_fit_results(full_df.copy()))
+    np.testing.assert_allclose(expanded_df.at[0, MODEL_PREDICTION], full_df.at[0, MODEL_PREDICTION])
+
+
+def test_compact_refit_replaces_the_curves_of_a_full_fit():
+    df = _synthetic_ecs_df(2)
+    fit_pirk_dirk_batch(df, df.index, GUESS_DICT, workers=1)
+    old_prediction = np.array(df.at[0, MODEL_PREDICTION])
+    df.at[0, TRACE_COLUMN] = df.at[0, TRACE_COLUMN] * 2
+    results = fit_pirk_dirk_batch(df, [0], GUESS_DICT, workers=1, compact=True)
+
+    assert not set(DIRK_PIRK_CURVE_COLUMNS) & set(results[0][3])
+    assert all(len(df.at[0, col]) == 0 for col in DIRK_PIRK_CURVE_COLUMNS)
+    curves = fit_curves(df, 0)
+    refit_df = _synthetic_ecs_df(2)
+    refit_df.at[0, TRACE_COLUMN] = refit_df.at[0, TRACE_COLUMN] * 2
+    fit_pirk_dirk_batch(refit_df, [0], GUESS_DICT, workers=1)
+    for col in DIRK_PIRK_CURVE_COLUMNS:
+        np.testing.assert_allclose(curves[col], refit_df.at[0, col])
+    assert not np.allclose(curves[MODEL_PREDICTION], old_prediction)
+
+
+def test_fit_results_table_matches_the_object_columns():
+    df = _synthetic_ecs_df(3)
+    fit_pirk_dirk_batch(df, df.index, GUESS_DICT, workers=1)
+    table = fit_results_table(df)
+
+    assert table.index.names == METADATA_COLUMNS
+    assert (table.drop(columns=[TRACE_INDEX, FIT_SUCCESS]).dtypes == np.float64).all()
+    for position, index in enumerate(df.index):
+        row = table.iloc[position]
+        np.testing.assert_allclose(row[DIRK_PIRK_PARAMETERS].values.astype(float), df.at[index, FIT_PARAMS])
+        np.testing.assert_allclose(row[GH_START + STD_ERROR_SUFFIX],
+                                   np.sqrt(df.at[index, FIT_COVARIANCE][1, 1]))
+        assert row[RELAXED_GH] == df.at[index, TIME_CONSTANTS][-1]
+        assert row[RELAXED_PIRK] == df.at[index, PIRK_AMPLITUDES][-1]
+        rmse = np.sqrt(np.mean((df.at[index, TRACE_FITTED] - df.at[index, MODEL_PREDICTION]) ** 2))
+        np.testing.assert_allclose(row[FIT_RMSE], rmse)
+
+    # frames fitted before the summaries were stored get them from the curves
+    old_df = df.drop(columns=DIRK_PIRK_SUMMARY_COLUMNS + [FIT_COVARIANCE, FIT_SUCCESS])
+    np.testing.assert_allclose(fit_results_table(old_df)[ECST], table[ECST])
+
+
+def test_render_dirk_pirk_fits_writes_one_figure_per_condition(tmp_path):
+    df = generate_combined_df(n_genotypes=2, n_light_intensities=2, n_replicates=2, trace_labels=[LABEL_ECS])
+    fit_pirk_dirk_batch(df, df.index, GUESS_DICT, workers=1, compact=True)
+
+    paths = render_dirk_pirk_fits(df, LABEL_ECS, str(tmp_path), workers=2)
+    assert len(paths) == 4 and len(set(paths)) == 4
+    assert all(os.path.getsize(path) > 0 for path in paths)
+
+    limits = dirk_pirk_plot_limits(dirk_pirk_plot_data(df, index) for index in df.index)
+    assert limits["x"][0] < 0 < limits["x"][1]
+    assert limits["gH"][0] < min(df[STEADY_STATE_GH]) and max(df[RELAXED_GH]) < limits["gH"][1]
+
+    # genotypes that only differ in characters replaced in file names would overwrite each other's figures
+    df[GENOTYPE_COLUMN] = df[GENOTYPE_COLUMN].map({"Col-0": "a/b", "mutant-1": "a b"})
+    with pytest.raises(ValueError, match="same figure file"):
+        render_dirk_pirk_fits(df, LABEL_ECS, str(tmp_path / "clash"), workers=1)
+
+
+def test_fit_cache_reuses_results_and_evicts(tmp_path):
+    cache = FitCache(str(tmp_path / "fits"))
+    df = _synthetic_ecs_df(3)
+    fit_pirk_dirk_batch(df, df.index, GUESS_DICT, workers=1, cache=cache)
+    assert len(cache) == 3 and cache.hits == 0
+
+    cached_df = _synthetic_ecs_df(3)
+    fit_pirk_dirk_batch(cached_df, cached_df.index, GUESS_DICT, workers=1, cache=cache)
+    assert cache.hits == 3
+    for index in df.index:
+        np.testing.assert_array_equal(cached_df.at[index, FIT_PARAMS], df.at[index, FIT_PARAMS])
+
+    changed_guess = dict(GUESS_DICT, **{AMPLITUDE: 0.4})
+    fit_pirk_dirk(cached_df, 0, changed_guess, cache=cache)
+    assert len(cache) == 4
+
+    cache.evict(max_bytes=cache.size // 2)
+    assert 0 < len(cache) < 4
+
+
+def test_resume_from_journal_restores_completed_fits(tmp_path):
+    journal_path = str(tmp_path / "run.jsonl")
+    df = _synthetic_ecs_df(4)
+    fit_pirk_dirk_batch(df, df.index[:2], GUESS_DICT, workers=1, journal=journal_path)
+
+    resumed_df = _synthetic_ecs_df(4)
+    results = fit_pirk_dirk_batch(resumed_df, resumed_df.index, GUESS_DICT, workers=1, journal=journal_path,
+                                  resume=True)
+
+    completed = FitJournal(journal_path).completed_fits()
+    assert sorted(completed) == sorted(results) == list(resumed_df.index)
+    for index in df.index[:2]:
+        np.testing.assert_array_equal(resumed_df.at[index, FIT_PARAMS], df.at[index, FIT_PARAMS])
+        np.testing.assert_allclose(resumed_df.at[index, MODEL_PREDICTION], df.at[index, MODEL_PREDICTION])
+        assert resumed_df.at[index, PIRK_AMPLITUDES] == df.at[index, PIRK_AMPLITUDES]
+
+
+def test_space_filling_starts_cover_every_stratum():
+    p0 = np.array(PARAMS)
+    starts = space_filling_starts(p0, n_starts=16, spread=1.0, seed=1)
+
+    np.testing.assert_array_equal(starts[0], p0)
+    unit = (np.log10(starts[1:] / p0) + 1) / 2
+    assert np.all((unit >= 0) & (unit <= 1))
+    for column in ((np.log10(starts / p0) + 1) / 2 * 16).T:
+        assert len(np.unique(np.floor(column[1:]))) == 15
+
+
+def test_multistart_fit_recovers_parameters():
+    trace_y = construct_dirk_pirk(X_TOTAL, PIRK_POINTS, *PARAMS)[1]
+    p0 = [GUESS_DICT[name] for name in DIRK_PIRK_PARAMETERS]
+    fit, pcov, perr, fit_success = run_multistart_dirk_pirk_fit(X_TOTAL, trace_y, p0, PIRK_POINTS,
+                                                                analytic_jacobian=True)
+    assert fit_success
+    np.testing.assert_allclose(DirkPirkEvaluator(X_TOTAL, PIRK_POINTS)(X_TOTAL, *fit), trace_y, atol=1e-6)
+
+
+class _LastFirstExecutor(ThreadPoolExecutor):
+    """
+    Thread pool on which, of every n_tasks fits, the ones submitted first finish last.
+    """
+
+    def __init__(self, n_tasks):
+        super().__init__(max_workers=n_tasks)
+        self.delays = itertools.cycle(0.1 * np.arange(n_tasks, 0, -1))
+
+    def submit(self, fn, *args, **kwargs):
+        delay = next(self.delays)
+        return super().submit(lambda: time.sleep(delay) or fn(*args, **kwargs))
+
+
+def test_multistart_fit_on_a_thread_pool():
+    trace_y = construct_dirk_pirk(X_TOTAL, PIRK_POINTS, *PARAMS)[1]
+    p0 = [GUESS_DICT[name] for name in DIRK_PIRK_PARAMETERS]
+    noisy_y = trace_y + np.random.default_rng(0).normal(0, 0.01, len(trace_y))
+
+    for y in (trace_y, noisy_y):
+        serial = run_multistart_dirk_pirk_fit(X_TOTAL, y, p0, PIRK_POINTS, analytic_jacobian=True, n_fits=4)
+        # the same fit as without an executor, whatever order the starts finish in
+        for executor in (ThreadPoolExecutor(max_workers=4), _LastFirstExecutor(4)):
+            with executor:
+                for _ in range(3):
+                    fit, pcov, perr, fit_success = run_multistart_dirk_pirk_fit(X_TOTAL, y, p0, PIRK_POINTS,
+                                                                                analytic_jacobian=True, n_fits=4,
+                                                                                executor=executor)
+                    assert fit_success == serial[3]
+                    np.testing.assert_array_equal(fit, serial[0])
+                    np.testing.assert_array_equal(pcov, serial[1])
+        np.testing.assert_allclose(DirkPirkEvaluator(X_TOTAL, PIRK_POINTS)(X_TOTAL, *fit), y, atol=0.05)
+
+
+def test_warm_start_groups_and_guess():
+    df = _synthetic_ecs_df(4)
+    df.loc[[1, 3], GENOTYPE_COLUMN] = "mutant"
+    groups = warm_start_groups(df, prepare_fit_tasks(df, df.index, GUESS_DICT))
+
+    assert {key: [task[0] for task in tasks] for key, tasks in groups.items()} == {
+        (LABEL_ECS, "Col-0", 100): [0, 2],
+        (LABEL_ECS, "mutant", 100): [1, 3]
+    }
+    assert warm_start_guess([], [1, 2]) == [1, 2]
+    assert warm_start_guess([[1, 2], [3, 4], [5, 9]], [0, 0]) == [3, 4]
+
+
+def test_warm_started_batch_fits_every_trace():
+    df = _synthetic_ecs_df(4)
+    poor_guess = dict.fromkeys(DIRK_PIRK_PARAMETERS, 1.0)
+    fit_pirk_dirk_batch(df, df.index, poor_guess, workers=2, warm_start=True, analytic_jacobian=True)
+
+    fits = np.stack(df[FIT_PARAMS].values)
+    np.testing.assert_allclose(fits[:, 0], PARAMS[0], rtol=0.2)
+
+
+def test_synthetic_screen_parameters_are_recovered():
+    df = generate_combined_df(n_genotypes=2, n_light_intensities=1, n_replicates=2, trace_labels=[LABEL_ECS],
+                              noise=0, seed=1)
+    fit_pirk_dirk_batch(df, df.index, GUESS_DICT, workers=1, analytic_jacobian=True)
+
+    recovery = parameter_recovery(df)
+    assert len(recovery) == len(df)
+    assert recovery["curve_rmse"].max() < 1e-3
+    assert recovery["gH_end_rel_err"].max() < 0.05
+
+
+def test_importing_fitters_loads_no_plotting_library():
+    # a fresh interpreter, the test session itself has imported matplotlib already
+    code = ("import sys, time; start = time.perf_counter(); import pirk.fitting.fitters, pirk.fitting.batch; "
+            "print(time.perf_counter() - start); "
+            "print([m for m in ('matplotlib', 'seaborn', 'plotly') if m in sys.modules])")
+    elapsed, loaded = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True,
+                                     cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+                                     ).stdout.split("\n")[:2]
+    assert loaded == "[]"
+    assert float(elapsed) < 10  # generous, only meant to catch a heavy import creeping back in
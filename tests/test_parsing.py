@@ -0,0 +1,194 @@
+import json
+import os
+
+import numpy as np
+import pytest
+
+from pirk.names import *
+from pirk.parsing.helpers import find_closest_index, find_closest_indices
+from pirk.parsing.group_index import group_index, invalidate_group_index
+from pirk.parsing.loader import parse_array, parse_indices, materialize_array_columns
+from pirk.calculations.pirk import find_steady_state_pirk_amplitudes
+from pirk.parsing.prep_data_fit import prep_traces_for_fitting, prepared_trace, prepared_trace_cache, \
+    invalidate_prepared_traces, prep_traces_batch
+from pirk.parsing.trace_store import save_trace_store, load_trace_store
+from pirk.reporting.columnar import save_columnar, load_columnar
+from pirk.synthetic import generate_combined_df, PIRK_LABELS
+
+
+def test_parse_array_fast_path_matches_literal_eval():
+    assert parse_array("[0.5, None, 1e-3, -2.0]").tolist() == [0.5, 1e-3, -2.0]
+    assert parse_array("[400, 1400]").dtype == np.int64
+    assert parse_array("[]").size == 0
+    assert parse_array("[(1, 2)]").tolist() == [[1, 2]]  # not a flat list, falls back to literal_eval
+    assert parse_indices("(400, 1400)") == (400, 1400)
+
+
+def test_find_closest_indices_matches_scalar_lookup():
+    rng = np.random.default_rng(0)
+    axes = [np.sort(np.round(rng.uniform(-1, 3, n), 2)) for n in rng.integers(1, 40, 30)]
+    for axis in axes:
+        targets = np.concatenate([axis, (axis[:-1] + axis[1:]) / 2, rng.uniform(-2, 4, 20)])  # hits, ties, outside
+        assert find_closest_indices(axis, targets).tolist() == [find_closest_index(axis, t) for t in targets]
+
+    lengths = np.array([len(axis) for axis in axes])
+    padded = np.full((len(axes), lengths.max()), np.nan)
+    for row, axis in enumerate(axes):
+        padded[row, :len(axis)] = axis
+    targets = rng.uniform(-2, 4, (len(axes), 5))
+    targets[:, 0] = [(axis[0] + axis[-1]) / 2 for axis in axes]
+    assert find_closest_indices(padded, targets, lengths).tolist() == \
+        [[find_closest_index(axis, t) for t in row_targets] for axis, row_targets in zip(axes, targets)]
+    assert find_closest_indices(padded, 0.5, lengths).tolist() == [find_closest_index(axis, 0.5) for axis in axes]
+
+    # rows of very different scale in one array
+    axes = [np.sort(rng.uniform(0, 1e8, 50)), 1e-6 * np.arange(50), 1e6 + 1e-6 * np.arange(50)]
+    targets = np.stack([rng.choice(axis, 40) + rng.normal(0, 1e-7, 40) for axis in axes])
+    assert find_closest_indices(np.stack(axes), targets).tolist() == \
+        [[find_closest_index(axis, t) for t in row_targets] for axis, row_targets in zip(axes, targets)]
+    with pytest.raises(ValueError):
+        find_closest_indices([], 0.5)
+
+
+def test_materialize_array_columns_matches_stringified_df():
+    strings_df = generate_combined_df(n_genotypes=1, n_light_intensities=1, n_replicates=2,
+                                      trace_labels=[LABEL_ECS], as_strings=True)
+    arrays_df = materialize_array_columns(strings_df.copy())
+    arrays_df.at[1, PIRK_POINTS_COLUMN] = None
+    materialize_array_columns(arrays_df)
+
+    assert arrays_df.at[0, TRACE_COLUMN].dtype == np.float64
+    assert arrays_df.at[0, DIRK_INDICES_COLUMN].dtype == np.int64
+    assert arrays_df.at[1, PIRK_POINTS_COLUMN] is None
+    for expected, materialized in zip(prep_traces_for_fitting(strings_df, 0), prep_traces_for_fitting(arrays_df, 0)):
+        np.testing.assert_allclose(materialized, expected)
+
+
+def test_trace_store_round_trip(tmp_path):
+    df = generate_combined_df(n_genotypes=1, n_light_intensities=1, n_replicates=3, trace_labels=[LABEL_ECS, LABEL_PAM])
+    save_trace_store(df, str(tmp_path / "store"))
+    loaded = load_trace_store(str(tmp_path / "store"))
+
+    assert list(loaded.columns) == list(df.columns)
+    assert loaded.at[3, PIRK_POINTS_COLUMN] is None  # PAM rows have no pirk points
+    assert not loaded.at[0, TRACE_COLUMN].flags.writeable
+    for index in df.index:
+        np.testing.assert_array_equal(loaded.at[index, TRACE_COLUMN], df.at[index, TRACE_COLUMN])
+    for expected, stored in zip(prep_traces_for_fitting(df, 0), prep_traces_for_fitting(loaded, 0)):
+        np.testing.assert_allclose(stored, expected)
+
+
+def test_columnar_round_trip_and_partial_load(tmp_path):
+    df = generate_combined_df(n_genotypes=2, n_light_intensities=1, n_replicates=3, trace_labels=[LABEL_ECS, LABEL_P700])
+    df[FIT_PARAMS] = [np.arange(9.0) + index for index in df.index]
+    df.at[2, FIT_PARAMS] = None
+    save_columnar(df, str(tmp_path / "results.columnar"), row_group_size=4)
+
+    loaded = load_columnar(str(tmp_path / "results.columnar"))
+    assert list(loaded.columns) == list(df.columns)
+    assert loaded.at[2, FIT_PARAMS] is None
+    np.testing.assert_array_equal(loaded.at[11, TRACE_COLUMN], df.at[11, TRACE_COLUMN])
+    assert loaded[GENOTYPE_COLUMN].tolist() == df[GENOTYPE_COLUMN].tolist()
+
+    subset = load_columnar(str(tmp_path / "results.columnar"), columns=[FIT_PARAMS, GENOTYPE_COLUMN],
+                           where={LABEL_COLUMN: LABEL_P700, GENOTYPE_COLUMN: ["mutant-1"]})
+    assert list(subset.columns) == [FIT_PARAMS, GENOTYPE_COLUMN]
+    assert subset.index.tolist() == df.index[(df[LABEL_COLUMN] == LABEL_P700) & (df[GENOTYPE_COLUMN] == "mutant-1")].tolist()
+    np.testing.assert_array_equal(subset.at[9, FIT_PARAMS], df.at[9, FIT_PARAMS])
+
+
+def test_columnar_where_uses_sidecar_index(tmp_path):
+    df = generate_combined_df(n_genotypes=3, n_light_intensities=2, n_replicates=2, trace_labels=[LABEL_ECS, LABEL_PAM])
+    path = str(tmp_path / "screen.columnar")
+    save_columnar(df, path, row_group_size=5)
+    where = {LABEL_COLUMN: LABEL_ECS, GENOTYPE_COLUMN: "Col-0", TREATMENT_COLUMN: lambda li: li > 500}
+    expected = df[(df[LABEL_COLUMN] == LABEL_ECS) & (df[GENOTYPE_COLUMN] == "Col-0") & (df[TREATMENT_COLUMN] > 500)]
+
+    indexed = load_columnar(path, where=where)
+    scanned = load_columnar(path, where=where, use_index=False)
+    assert indexed.index.tolist() == scanned.index.tolist() == expected.index.tolist()
+    for index in expected.index:
+        np.testing.assert_array_equal(indexed.at[index, TRACE_COLUMN], expected.at[index, TRACE_COLUMN])
+        assert indexed.at[index, REPLICATE_COLUMN] == expected.at[index, REPLICATE_COLUMN]
+
+    # the metadata of the whole screen is served by the sidecar index alone
+    os.remove(os.path.join(path, "rg00000", "c0000.pkl.z"))
+    assert load_columnar(path, columns=METADATA_COLUMNS)[GENOTYPE_COLUMN].tolist() == df[GENOTYPE_COLUMN].tolist()
+
+    # datasets written in the layout without the sidecar index are rejected
+    manifest_path = os.path.join(path, "manifest.json")
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    with open(manifest_path, "w") as f:
+        json.dump(dict(manifest, version=1), f)
+    with pytest.raises(ValueError, match="is not a version 2 columnar dataset"):
+        load_columnar(path)
+
+
+def test_prepared_traces_are_cached_and_invalidated():
+    df = generate_combined_df(n_genotypes=1, n_light_intensities=1, n_replicates=2, trace_labels=[LABEL_ECS])
+    cache = prepared_trace_cache(df)
+
+    first = prep_traces_for_fitting(df, 0)
+    assert prep_traces_for_fitting(df, 0)[1] is first[1]
+    assert (cache.hits, cache.misses) == (1, 1)
+    for expected, cached in zip(prep_traces_for_fitting(df, 0, use_cache=False), first):
+        np.testing.assert_array_equal(cached, expected)
+    assert prepared_trace(df, 0).steady_state_pirk() == find_steady_state_pirk_amplitudes(df, 0)
+
+    df.at[0, TRACE_COLUMN] = df.at[0, TRACE_COLUMN] * 2  # a new cell is detected
+    np.testing.assert_allclose(prep_traces_for_fitting(df, 0)[1], 2 * first[1])
+
+    df.at[0, TRACE_COLUMN][:] = df.at[1, TRACE_COLUMN]  # an in-place change needs explicit invalidation
+    invalidate_prepared_traces(df, [0])
+    np.testing.assert_array_equal(prep_traces_for_fitting(df, 0)[1], prep_traces_for_fitting(df, 1)[1])
+
+
+def test_prep_traces_batch_matches_single_traces():
+    df = generate_combined_df(n_genotypes=1, n_light_intensities=2, n_replicates=2, trace_labels=PIRK_LABELS)
+    df.at[1, DIRK_INDICES_COLUMN] = (400, 1100)  # a shorter trace is padded
+    df.at[2, PIRK_POINTS_COLUMN] = df.at[2, PIRK_POINTS_COLUMN][:2]
+    batch = prep_traces_batch(df)
+
+    assert batch.trace_x.shape == (len(df), 1000)
+    assert batch.lengths[1] == 700 and np.isnan(batch.trace_y[1, 700:]).all()
+    for position, index in enumerate(batch.indexes):
+        trace_x, trace_y, pirk_points, dirk_point_indexes = prep_traces_for_fitting(df, index, use_cache=False)
+        batch_x, batch_y, batch_pirk_points, batch_dirk_point_indexes = batch.trace(position)
+        np.testing.assert_array_equal(batch_x, trace_x)
+        np.testing.assert_allclose(batch_y, trace_y, atol=1e-9)
+        np.testing.assert_allclose(batch_pirk_points, pirk_points)
+        assert batch_dirk_point_indexes == list(dirk_point_indexes)
+
+    assert len(prep_traces_batch(df, trace_label=LABEL_P700)) == len(df) // len(PIRK_LABELS)
+
+
+def test_group_index_matches_boolean_masks():
+    df = generate_combined_df(n_genotypes=3, n_light_intensities=2, n_replicates=2, trace_labels=PIRK_LABELS)
+    df.index = df.index * 10
+    rows = group_index(df)
+    assert group_index(df) is rows
+
+    for label in PIRK_LABELS:
+        for genotype in df[GENOTYPE_COLUMN].unique():
+            mask = (df[LABEL_COLUMN] == label) & (df[GENOTYPE_COLUMN] == genotype)
+            assert list(rows.indexes({GENOTYPE_COLUMN: genotype, LABEL_COLUMN: label})) == list(df.index[mask])
+    assert len(rows.indexes({GENOTYPE_COLUMN: "missing"})) == 0
+    assert rows.values(TREATMENT_COLUMN, {LABEL_COLUMN: LABEL_ECS}) == list(df[TREATMENT_COLUMN].unique())
+
+    groups = dict(rows.groups([TREATMENT_COLUMN, LABEL_COLUMN]))
+    assert len(groups) == 2 * len(PIRK_LABELS)
+    assert sum(len(indexes) for indexes in groups.values()) == len(df)
+
+    df.loc[df.index[0], GENOTYPE_COLUMN] = "renamed"  # in-place change needs explicit invalidation
+    invalidate_group_index(df)
+    assert list(group_index(df).indexes({GENOTYPE_COLUMN: "renamed"})) == [df.index[0]]
+
+    # replacing a column is picked up without invalidation, reading the same columns again keeps the index
+    rows = group_index(df)
+    assert group_index(df) is rows
+    df[GENOTYPE_COLUMN] = df[GENOTYPE_COLUMN].replace({"renamed": "Col-0", "mutant-1": "mutant-x"})
+    assert "mutant-x" in group_index(df).values(GENOTYPE_COLUMN)
+    assert "renamed" not in group_index(df).values(GENOTYPE_COLUMN)
+    df[TREATMENT_COLUMN] = df[TREATMENT_COLUMN] * 2
+    assert group_index(df).values(TREATMENT_COLUMN) == list(df[TREATMENT_COLUMN].unique())